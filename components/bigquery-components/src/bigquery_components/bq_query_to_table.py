@@ -12,7 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from kfp.v2.dsl import component
+from kfp.v2.dsl import Metrics, Output, component
 
 
 @component(
@@ -23,10 +23,16 @@ def bq_query_to_table(
     query: str,
     bq_client_project_id: str,
     destination_project_id: str,
+    metrics: Output[Metrics],
     dataset_id: str = None,
     table_id: str = None,
     dataset_location: str = "EU",
     query_job_config: dict = None,
+    preflight_dry_run: bool = False,
+    maximum_bytes_billed: int = None,
+    skip_if_unchanged: bool = False,
+    time_partitioning: dict = None,
+    clustering_fields: list = None,
 ) -> None:
     """
     Run query & create a new BigQuery table
@@ -34,6 +40,9 @@ def bq_query_to_table(
         query (str): SQL query to execute, results are saved in a BigQuery table
         bq_client_project_id (str): project id that will be used by the bq client
         destination_project_id (str): project id where BQ table will be created
+        metrics (Output[Metrics]): bytes processed and billed, slot time and cache
+            hit of the query job (and bytes estimated by the dry run if any), this
+            parameter will be passed automatically by the orchestrator
         dataset_id (str): dataset id where BQ table will be created
         table_id (str): table name (without project id and dataset id)
         dataset_location (str): bq dataset location
@@ -41,11 +50,33 @@ def bq_query_to_table(
         required by the bq query operation. No need to specify destination param
         See available parameters here
         https://googleapis.dev/python/bigquery/latest/generated/google.cloud.bigquery.job.QueryJobConfig.html
+        preflight_dry_run (bool): estimate the bytes processed by the query with a
+            dry run before running it, and do not run it if the estimate exceeds
+            `maximum_bytes_billed`. Defaults to False.
+        maximum_bytes_billed (int): bytes billed above which the query fails
+            (without incurring a charge). Takes precedence over
+            `maximum_bytes_billed` in `query_job_config`. No limit if None.
+        skip_if_unchanged (bool): skip the query if the destination table was
+            created by the same query (and job config) from source tables which
+            have not been modified since. A fingerprint of the query, job config
+            and last modified time and size of the source tables is stored in the
+            `query_fingerprint` label of the destination table. Only use it for
+            queries whose results do not depend on the time they run at (e.g.
+            CURRENT_DATE). Defaults to False.
+        time_partitioning (dict): partitioning of the destination table, with the
+            arguments of `bigquery.TimePartitioning` e.g. {"type_": "DAY",
+            "field": "trip_date"}. Takes precedence over `time_partitioning` in
+            `query_job_config`. Not partitioned if None.
+        clustering_fields (list): columns by which the destination table is
+            clustered. Takes precedence over `clustering_fields` in
+            `query_job_config`. Not clustered if None.
     Returns:
         None
     """
-    from google.cloud.exceptions import GoogleCloudError
+    from google.cloud.exceptions import GoogleCloudError, NotFound
     from google.cloud import bigquery
+    import hashlib
+    import json
     import logging
 
     logging.getLogger().setLevel(logging.INFO)
@@ -56,11 +87,78 @@ def bq_query_to_table(
         dest_table_ref = None
     if query_job_config is None:
         query_job_config = {}
-    job_config = bigquery.QueryJobConfig(destination=dest_table_ref, **query_job_config)
+    if maximum_bytes_billed is not None:
+        query_job_config = {
+            **query_job_config,
+            "maximum_bytes_billed": maximum_bytes_billed,
+        }
+    if time_partitioning is not None:
+        query_job_config = {**query_job_config, "time_partitioning": time_partitioning}
+    if clustering_fields is not None:
+        query_job_config = {**query_job_config, "clustering_fields": clustering_fields}
+
+    def to_job_config(**kwargs):
+        if kwargs.get("time_partitioning") is not None:
+            kwargs["time_partitioning"] = bigquery.TimePartitioning(
+                **kwargs["time_partitioning"]
+            )
+        return bigquery.QueryJobConfig(destination=dest_table_ref, **kwargs)
+
+    job_config = to_job_config(**query_job_config)
 
     bq_client = bigquery.client.Client(
         project=bq_client_project_id, location=dataset_location
     )
+
+    if skip_if_unchanged and dest_table_ref is None:
+        logging.warning("skip_if_unchanged requires a destination table, ignored")
+        skip_if_unchanged = False
+
+    if preflight_dry_run or skip_if_unchanged:
+        dry_run_config = to_job_config(
+            **{**query_job_config, "dry_run": True, "use_query_cache": False}
+        )
+        dry_run_job = bq_client.query(query, job_config=dry_run_config)
+
+    fingerprint = None
+    if skip_if_unchanged:
+        fingerprint = hashlib.sha256(query.encode())
+        fingerprint.update(json.dumps(query_job_config, sort_keys=True).encode())
+        for table_ref in sorted(dry_run_job.referenced_tables or [], key=str):
+            table = bq_client.get_table(table_ref)
+            logging.info(
+                f"Source table {table_ref}: modified {table.modified}, "
+                f"{table.num_bytes} bytes"
+            )
+            fingerprint.update(
+                f"{table_ref}|{table.modified}|{table.num_bytes}".encode()
+            )
+        # label values are limited to 63 characters
+        fingerprint = fingerprint.hexdigest()[:32]
+        try:
+            labels = bq_client.get_table(dest_table_ref).labels or {}
+        except NotFound:
+            labels = {}
+        if labels.get("query_fingerprint") == fingerprint:
+            logging.info(
+                f"BQ table {dest_table_ref} is up to date (fingerprint "
+                f"{fingerprint}), skip query"
+            )
+            metrics.log_metric("skipped", 1.0)
+            return
+        metrics.log_metric("skipped", 0.0)
+
+    if preflight_dry_run:
+        estimated_bytes = dry_run_job.total_bytes_processed
+        logging.info(f"Dry run: the query will process {estimated_bytes} bytes")
+        metrics.log_metric("estimatedBytesProcessed", estimated_bytes)
+        budget = query_job_config.get("maximum_bytes_billed")
+        if budget is not None and estimated_bytes > int(budget):
+            raise ValueError(
+                f"The query would process {estimated_bytes} bytes, more than "
+                f"maximum_bytes_billed ({budget} bytes)"
+            )
+
     query_job = bq_client.query(query, job_config=job_config)
 
     try:
@@ -71,3 +169,19 @@ def bq_query_to_table(
         logging.error(query_job.error_result)
         logging.error(query_job.errors)
         raise e
+
+    logging.info(
+        f"Query job {query_job.job_id}: {query_job.total_bytes_processed} bytes "
+        f"processed, {query_job.total_bytes_billed} bytes billed, "
+        f"{query_job.slot_millis} slot ms, cache hit: {query_job.cache_hit}"
+    )
+    metrics.log_metric("totalBytesProcessed", query_job.total_bytes_processed or 0)
+    metrics.log_metric("totalBytesBilled", query_job.total_bytes_billed or 0)
+    metrics.log_metric("slotMillis", query_job.slot_millis or 0)
+    metrics.log_metric("cacheHit", float(bool(query_job.cache_hit)))
+
+    if fingerprint is not None:
+        logging.info(f"Label BQ table {dest_table_ref} with fingerprint {fingerprint}")
+        table = bq_client.get_table(dest_table_ref)
+        table.labels = {**(table.labels or {}), "query_fingerprint": fingerprint}
+        bq_client.update_table(table, ["labels"])
@@ -29,6 +29,9 @@ def extract_bq_to_dataset(
     dataset_location: str = "EU",
     extract_job_config: dict = None,
     skip_if_exists: bool = True,
+    sharded: bool = False,
+    destination_format: str = None,
+    compression: str = None,
 ):
     """
     Extract BQ table in GCS.
@@ -45,6 +48,24 @@ def extract_bq_to_dataset(
             See available parameters here
             https://googleapis.dev/python/bigquery/latest/generated/google.cloud.bigquery.job.ExtractJobConfig.html # noqa
         destination_gcs_uri (str): GCS URI to use for saving query results (optional).
+        skip_if_exists (bool): skip the extraction if the destination already exists.
+            Defaults to True.
+        sharded (bool): export the table to multiple files in the dataset directory
+            using a wildcard URI. This is required for tables larger than 1 GB.
+            A manifest (file pattern, format, shard URIs and sizes, number of rows)
+            is recorded in the metadata of the dataset. Defaults to False.
+        destination_format (str): exported file format, one of "CSV", "AVRO" or
+            "PARQUET" (the formats read by the training scripts). Takes
+            precedence over `destination_format` in `extract_job_config`.
+            Defaults to "CSV".
+        compression (str): compression of the exported files. Supported values
+            depend on the format: "GZIP" (CSV, Parquet), "SNAPPY" (Avro,
+            Parquet), "DEFLATE" (Avro), "ZSTD" (Parquet) or "NONE". Takes
+            precedence over `compression` in `extract_job_config`.
+            Defaults to "NONE".
+
+    The format and compression are recorded in the metadata of the dataset
+    (`format` and `compression`) so that downstream readers can pick a decoder.
 
     Returns:
         Outputs (NamedTuple (str, list)): Output dataset directory and its  GCS uri.
@@ -55,29 +76,87 @@ def extract_bq_to_dataset(
     from google.cloud.exceptions import GoogleCloudError
     from google.cloud import bigquery
 
+    FILE_EXTENSIONS = {
+        "CSV": "csv",
+        "AVRO": "avro",
+        "PARQUET": "parquet",
+    }
+    SUPPORTED_COMPRESSIONS = {
+        "CSV": ["NONE", "GZIP"],
+        "AVRO": ["NONE", "DEFLATE", "SNAPPY"],
+        "PARQUET": ["NONE", "GZIP", "SNAPPY", "ZSTD"],
+    }
+
+    def build_manifest(file_pattern: str, num_rows: int = None) -> dict:
+        """List the exported shards in the dataset directory."""
+        shards = [
+            {"uri": f"{dataset.uri}/{p.name}", "size_bytes": p.stat().st_size}
+            for p in sorted(Path(dataset.path).glob(file_pattern))
+        ]
+        return {
+            "file_pattern": file_pattern,
+            "format": destination_format,
+            "compression": compression,
+            "num_rows": num_rows,
+            "num_shards": len(shards),
+            "size_bytes": sum(s["size_bytes"] for s in shards),
+            "shards": shards,
+        }
+
     # set uri of output dataset if destination_gcs_uri is provided
     if destination_gcs_uri:
         dataset.uri = destination_gcs_uri
 
+    if extract_job_config is None:
+        extract_job_config = {}
+    destination_format = (
+        destination_format or extract_job_config.get("destination_format") or "CSV"
+    ).upper()
+    compression = (
+        compression or extract_job_config.get("compression") or "NONE"
+    ).upper()
+    if destination_format not in SUPPORTED_COMPRESSIONS:
+        raise ValueError(
+            f"Destination format {destination_format} not supported, use one of "
+            f"{list(SUPPORTED_COMPRESSIONS)}"
+        )
+    if compression not in SUPPORTED_COMPRESSIONS[destination_format]:
+        raise ValueError(
+            f"Compression {compression} not supported for {destination_format}, "
+            f"use one of {SUPPORTED_COMPRESSIONS[destination_format]}"
+        )
+    extract_job_config = dict(
+        extract_job_config,
+        destination_format=destination_format,
+        compression=compression,
+    )
+    dataset.metadata["format"] = destination_format
+    dataset.metadata["compression"] = compression
+
+    file_extension = FILE_EXTENSIONS[destination_format]
+    if compression == "GZIP" and destination_format != "PARQUET":
+        file_extension += ".gz"
+    file_pattern = f"part-*.{file_extension}"
+    destination_uri = f"{dataset.uri}/{file_pattern}" if sharded else dataset.uri
+
     logging.info(f"Checking if destination exists: {dataset.path}")
     if Path(dataset.path).exists() and skip_if_exists:
         logging.info("Destination already exists, skipping table extraction!")
+        if sharded:
+            dataset.metadata["manifest"] = build_manifest(file_pattern)
         return
 
     full_table_id = f"{source_project_id}.{dataset_id}.{table_name}"
     table = bigquery.table.Table(table_ref=full_table_id)
-
-    if extract_job_config is None:
-        extract_job_config = {}
     job_config = bigquery.job.ExtractJobConfig(**extract_job_config)
 
-    logging.info(f"Extract table {table} to {dataset.uri}")
+    logging.info(f"Extract table {table} to {destination_uri}")
     client = bigquery.client.Client(
         project=bq_client_project_id, location=dataset_location
     )
     extract_job = client.extract_table(
         table,
-        dataset.uri,
+        destination_uri,
         job_config=job_config,
     )
 
@@ -89,3 +168,12 @@ def extract_bq_to_dataset(
         logging.error(extract_job.error_result)
         logging.error(extract_job.errors)
         raise e
+
+    if sharded:
+        num_rows = client.get_table(full_table_id).num_rows
+        manifest = build_manifest(file_pattern, num_rows)
+        logging.info(
+            f"Extracted {num_rows} rows to {manifest['num_shards']} shards "
+            f"({manifest['size_bytes']} bytes)"
+        )
+        dataset.metadata["manifest"] = manifest
@@ -0,0 +1,236 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import mock
+
+import google.cloud.bigquery  # noqa
+import pytest
+from google.cloud.exceptions import NotFound
+from kfp.v2.dsl import Metrics
+
+import bigquery_components
+
+bq_query_to_table = bigquery_components.bq_query_to_table.python_func
+
+
+SOURCE_TABLE = "my-project-id.my-dataset.my-source"
+DESTINATION_TABLE = "my-project-id.my-dataset.my-table"
+
+
+def mock_query(estimated_bytes: int, tables: dict = None):
+    """
+    Create a side effect for `Client.query` which returns the statistics of a dry
+    run for dry run jobs, and of a finished job otherwise.
+
+    Args:
+        estimated_bytes (int): bytes processed by the dry run
+        tables (dict): mock tables by table id, the destination table is added
+            when the query runs
+
+    Returns:
+        Callable: side effect returning mock query jobs
+    """
+
+    def query(query, job_config):
+        if job_config.dry_run:
+            return mock.Mock(
+                total_bytes_processed=estimated_bytes,
+                referenced_tables=[SOURCE_TABLE],
+            )
+        if tables is not None:
+            tables.setdefault(str(job_config.destination), mock.Mock(labels=None))
+        return mock.Mock(
+            job_id="my-job",
+            total_bytes_processed=1000,
+            total_bytes_billed=10485760,
+            slot_millis=42,
+            cache_hit=False,
+        )
+
+    return query
+
+
+def run(tmpdir, estimated_bytes: int = 1000, tables: dict = None, **kwargs):
+    """
+    Run the component with a mocked client.
+
+    Args:
+        tmpdir: directory of the metrics artifact
+        estimated_bytes (int): bytes processed by the dry run
+        tables (dict): mock tables by table id returned by `Client.get_table`
+        kwargs: arguments of the component
+
+    Returns:
+        tuple: mocked client and metrics artifact
+    """
+
+    def get_table(table_ref):
+        if str(table_ref) not in tables:
+            raise NotFound(f"Not found: Table {table_ref}")
+        return tables[str(table_ref)]
+
+    metrics = Metrics(uri=f"{tmpdir}/metrics")
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        mock_client.return_value.query.side_effect = mock_query(estimated_bytes, tables)
+        mock_client.return_value.get_table.side_effect = get_table
+        bq_query_to_table(
+            query="SELECT 1",
+            bq_client_project_id="my-project-id",
+            destination_project_id="my-project-id",
+            metrics=metrics,
+            dataset_id="my-dataset",
+            table_id="my-table",
+            **kwargs,
+        )
+    return mock_client, metrics
+
+
+def test_bq_query_to_table_job_statistics(tmpdir):
+    """
+    Asserts that the query runs without a dry run by default, and that the
+    statistics of the job are recorded in the metrics.
+    """
+    mock_client, metrics = run(tmpdir, query_job_config={"use_query_cache": True})
+
+    mock_client.return_value.query.assert_called_once()
+    job_config = mock_client.return_value.query.call_args[1]["job_config"]
+    assert not job_config.dry_run
+    assert job_config.maximum_bytes_billed is None
+    assert metrics.metadata["totalBytesProcessed"] == 1000
+    assert metrics.metadata["totalBytesBilled"] == 10485760
+    assert metrics.metadata["slotMillis"] == 42
+    assert metrics.metadata["cacheHit"] == 0.0
+    assert "estimatedBytesProcessed" not in metrics.metadata
+
+
+@pytest.mark.parametrize("maximum_bytes_billed", [None, 10**6])
+def test_bq_query_to_table_preflight_dry_run(tmpdir, maximum_bytes_billed):
+    """
+    Asserts that the dry run estimate is recorded in the metrics before the query
+    runs, and that the budget is set on the query job.
+    """
+    mock_client, metrics = run(
+        tmpdir,
+        estimated_bytes=2000,
+        preflight_dry_run=True,
+        maximum_bytes_billed=maximum_bytes_billed,
+    )
+
+    dry_run, query = mock_client.return_value.query.call_args_list
+    assert dry_run[1]["job_config"].dry_run
+    assert not dry_run[1]["job_config"].use_query_cache
+    assert not query[1]["job_config"].dry_run
+    assert query[1]["job_config"].maximum_bytes_billed == maximum_bytes_billed
+    assert metrics.metadata["estimatedBytesProcessed"] == 2000
+    assert metrics.metadata["totalBytesProcessed"] == 1000
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {"maximum_bytes_billed": 10**6},
+        {"query_job_config": {"maximum_bytes_billed": 10**6}},
+    ],
+)
+def test_bq_query_to_table_over_budget(tmpdir, kwargs):
+    """
+    Asserts that a query whose dry run exceeds the budget is not run.
+    """
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        mock_client.return_value.query.side_effect = mock_query(10**9)
+        with pytest.raises(ValueError, match="more than maximum_bytes_billed"):
+            bq_query_to_table(
+                query="SELECT 1",
+                bq_client_project_id="my-project-id",
+                destination_project_id="my-project-id",
+                metrics=Metrics(uri=f"{tmpdir}/metrics"),
+                preflight_dry_run=True,
+                **kwargs,
+            )
+
+        # only the dry run was submitted
+        mock_client.return_value.query.assert_called_once()
+
+
+def test_bq_query_to_table_skip_if_unchanged(tmpdir):
+    """
+    Asserts that the query is skipped while neither the query nor the source
+    tables change, and that the destination table is labelled with the
+    fingerprint of the query and source tables.
+    """
+    tables = {SOURCE_TABLE: mock.Mock(modified="2023-01-01", num_bytes=100)}
+
+    # the destination table does not exist yet
+    mock_client, metrics = run(tmpdir, tables=tables, skip_if_unchanged=True)
+    assert mock_client.return_value.query.call_count == 2
+    assert metrics.metadata["skipped"] == 0.0
+    fingerprint = tables[DESTINATION_TABLE].labels["query_fingerprint"]
+    mock_client.return_value.update_table.assert_called_once_with(
+        tables[DESTINATION_TABLE], ["labels"]
+    )
+
+    # neither the query nor the source table changed: only the dry run runs
+    mock_client, metrics = run(tmpdir, tables=tables, skip_if_unchanged=True)
+    assert mock_client.return_value.query.call_count == 1
+    assert metrics.metadata["skipped"] == 1.0
+    mock_client.return_value.update_table.assert_not_called()
+
+    # the source table was modified
+    tables[SOURCE_TABLE].modified = "2023-01-02"
+    mock_client, metrics = run(tmpdir, tables=tables, skip_if_unchanged=True)
+    assert mock_client.return_value.query.call_count == 2
+    assert tables[DESTINATION_TABLE].labels["query_fingerprint"] != fingerprint
+
+    # the query changed
+    fingerprint = tables[DESTINATION_TABLE].labels["query_fingerprint"]
+    mock_client, metrics = run(
+        tmpdir,
+        tables=tables,
+        skip_if_unchanged=True,
+        query_job_config={"use_query_cache": False},
+    )
+    assert mock_client.return_value.query.call_count == 2
+    assert tables[DESTINATION_TABLE].labels["query_fingerprint"] != fingerprint
+
+
+@pytest.mark.parametrize(
+    "kwargs",
+    [
+        {
+            "time_partitioning": {"type_": "DAY", "field": "trip_date"},
+            "clustering_fields": ["payment_type", "company"],
+        },
+        {
+            "query_job_config": {
+                "time_partitioning": {"type_": "DAY", "field": "trip_date"},
+                "clustering_fields": ["payment_type", "company"],
+            }
+        },
+    ],
+)
+def test_bq_query_to_table_partitioning(tmpdir, kwargs):
+    """
+    Asserts that the destination table is partitioned and clustered as specified,
+    for both the dry run and the query job.
+    """
+    mock_client, metrics = run(tmpdir, preflight_dry_run=True, **kwargs)
+
+    for call in mock_client.return_value.query.call_args_list:
+        job_config = call[1]["job_config"]
+        assert isinstance(
+            job_config.time_partitioning, google.cloud.bigquery.TimePartitioning
+        )
+        assert job_config.time_partitioning.type_ == "DAY"
+        assert job_config.time_partitioning.field == "trip_date"
+        assert job_config.clustering_fields == ["payment_type", "company"]
@@ -0,0 +1,199 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from pathlib import Path
+from unittest import mock
+
+import google.cloud.bigquery  # noqa
+import pytest
+from kfp.v2.dsl import Dataset
+
+import bigquery_components
+
+extract_bq_to_dataset = bigquery_components.extract_bq_to_dataset.python_func
+
+
+def mock_extract_table(shard_sizes: list):
+    """
+    Create a side effect for `Client.extract_table` which writes one file per shard
+    to the directory of the wildcard destination URI (a local directory stands in
+    for GCS).
+
+    Args:
+        shard_sizes (list): size in bytes of each shard
+
+    Returns:
+        Callable: side effect writing the shards
+    """
+
+    def extract_table(table, destination_uri, job_config):
+        directory, file_pattern = destination_uri.rsplit("/", 1)
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        for i, size in enumerate(shard_sizes):
+            shard = file_pattern.replace("*", f"{i:012}")
+            (Path(directory) / shard).write_bytes(b"x" * size)
+        return mock.Mock()
+
+    return extract_table
+
+
+def test_extract_bq_to_dataset_sharded(tmpdir):
+    """
+    Asserts that a sharded extraction uses a wildcard URI and records a manifest of
+    the exported shards in the dataset metadata.
+    """
+    dataset = Dataset(uri=str(tmpdir / "dataset"))
+
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        mock_client.return_value.extract_table.side_effect = mock_extract_table(
+            [10, 20, 30]
+        )
+        mock_client.return_value.get_table.return_value.num_rows = 42
+
+        extract_bq_to_dataset(
+            bq_client_project_id="my-project-id",
+            source_project_id="my-project-id",
+            dataset_id="my-dataset",
+            table_name="my-table",
+            dataset=dataset,
+            sharded=True,
+        )
+
+        _, destination_uri = mock_client.return_value.extract_table.call_args[0]
+        assert destination_uri == f"{tmpdir}/dataset/part-*.csv"
+
+    manifest = dataset.metadata["manifest"]
+    assert manifest["file_pattern"] == "part-*.csv"
+    assert manifest["format"] == "CSV"
+    assert manifest["num_rows"] == 42
+    assert manifest["num_shards"] == 3
+    assert manifest["size_bytes"] == 60
+    assert manifest["shards"] == [
+        {"uri": f"{tmpdir}/dataset/part-{i:012}.csv", "size_bytes": size}
+        for i, size in enumerate([10, 20, 30])
+    ]
+
+
+def test_extract_bq_to_dataset_sharded_skip_if_exists(tmpdir):
+    """
+    Asserts that the manifest is rebuilt from the existing shards when the
+    extraction is skipped.
+    """
+    dataset = Dataset(uri=str(tmpdir / "dataset"))
+    mock_extract_table([5, 5])(None, f"{dataset.uri}/part-*.csv", None)
+
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        extract_bq_to_dataset(
+            bq_client_project_id="my-project-id",
+            source_project_id="my-project-id",
+            dataset_id="my-dataset",
+            table_name="my-table",
+            dataset=dataset,
+            sharded=True,
+        )
+
+        mock_client.return_value.extract_table.assert_not_called()
+
+    assert dataset.metadata["manifest"]["num_shards"] == 2
+    assert dataset.metadata["manifest"]["size_bytes"] == 10
+
+
+def test_extract_bq_to_dataset_single_file(tmpdir):
+    """
+    Asserts that the table is extracted to the dataset URI when not sharded.
+    """
+    dataset = Dataset(uri=str(tmpdir / "dataset"))
+
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        extract_bq_to_dataset(
+            bq_client_project_id="my-project-id",
+            source_project_id="my-project-id",
+            dataset_id="my-dataset",
+            table_name="my-table",
+            dataset=dataset,
+        )
+
+        _, destination_uri = mock_client.return_value.extract_table.call_args[0]
+        assert destination_uri == dataset.uri
+
+    assert "manifest" not in dataset.metadata
+
+
+@pytest.mark.parametrize(
+    "destination_format,compression,file_pattern",
+    [
+        ("CSV", "GZIP", "part-*.csv.gz"),
+        ("AVRO", "SNAPPY", "part-*.avro"),
+        ("PARQUET", "SNAPPY", "part-*.parquet"),
+        ("parquet", None, "part-*.parquet"),
+    ],
+)
+def test_extract_bq_to_dataset_format(
+    tmpdir, destination_format, compression, file_pattern
+):
+    """
+    Asserts that the destination format and compression are set on the extract job
+    and recorded in the dataset metadata.
+    """
+    dataset = Dataset(uri=str(tmpdir / "dataset"))
+
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        mock_client.return_value.extract_table.side_effect = mock_extract_table([1])
+
+        extract_bq_to_dataset(
+            bq_client_project_id="my-project-id",
+            source_project_id="my-project-id",
+            dataset_id="my-dataset",
+            table_name="my-table",
+            dataset=dataset,
+            sharded=True,
+            destination_format=destination_format,
+            compression=compression,
+            extract_job_config={"compression": "NONE", "print_header": True},
+        )
+
+        job_config = mock_client.return_value.extract_table.call_args[1]["job_config"]
+
+    assert job_config.destination_format == destination_format.upper()
+    assert job_config.compression == (compression or "NONE")
+    assert job_config.print_header
+    assert dataset.metadata["format"] == destination_format.upper()
+    assert dataset.metadata["compression"] == (compression or "NONE")
+    assert dataset.metadata["manifest"]["file_pattern"] == file_pattern
+
+
+@pytest.mark.parametrize(
+    "destination_format,compression",
+    [("AVRO", "GZIP"), ("NEWLINE_DELIMITED_JSON", None)],
+)
+def test_extract_bq_to_dataset_unsupported_format(
+    tmpdir, destination_format, compression
+):
+    """
+    Asserts that an unsupported format, or combination of format and compression,
+    is rejected before the extract job is submitted.
+    """
+    with mock.patch("google.cloud.bigquery.client.Client") as mock_client:
+        with pytest.raises(ValueError):
+            extract_bq_to_dataset(
+                bq_client_project_id="my-project-id",
+                source_project_id="my-project-id",
+                dataset_id="my-dataset",
+                table_name="my-table",
+                dataset=Dataset(uri=str(tmpdir / "dataset")),
+                destination_format=destination_format,
+                compression=compression,
+            )
+
+        mock_client.return_value.extract_table.assert_not_called()
@@ -41,6 +41,7 @@ def custom_train_job(
     accelerator_type: str = "ACCELERATOR_TYPE_UNSPECIFIED",
     accelerator_count: int = 0,
     parent_model: str = None,
+    restart_job_on_worker_restart: bool = False,
 ):
     """Run a custom training job using a training script.
 
@@ -59,6 +60,15 @@ def custom_train_job(
     to the provided path and the model to the correct path based on:
     https://cloud.google.com/vertex-ai/docs/training/code-requirements.
 
+    If the train script also writes its training throughput (e.g. examples per
+    second, time blocked on input, peak RSS) to `throughput.json` next to the
+    metrics file, the numeric totals are logged as metrics too.
+
+    If a dataset was extracted to multiple files (i.e. its metadata contains a
+    `manifest`), the wildcard pattern of its shards is passed instead of its path
+    e.g. `<train_data.path>/part-*.csv` so that the train script can read the shards
+    in parallel.
+
     Args:
         train_script_uri (str): gs:// uri to python train script. See:
             https://cloud.google.com/vertex-ai/docs/training/code-requirements.
@@ -84,6 +94,10 @@ def custom_train_job(
         parent_model (str): Resource URI of existing parent model (optional). If `None`,
             a new model will be uploaded. Otherwise, a new model version for the parent
             model will be uploaded.
+        restart_job_on_worker_restart (bool): Restart the whole job when a worker
+            restarts e.g. after a preemption. The train script should back up its
+            training state to the `AIP_CHECKPOINT_DIR` environment variable so
+            that training resumes instead of starting over.
     Returns:
         parent_model (str): Resource URI of the parent model (empty string if the
             trained model is the first model version of its kind).
@@ -94,6 +108,13 @@ def custom_train_job(
     import time
     import google.cloud.aiplatform as aip
 
+    def data_path(dataset: Dataset) -> str:
+        """Path of a dataset, or the wildcard pattern of its shards if sharded."""
+        manifest = dataset.metadata.get("manifest")
+        if manifest:
+            return os.path.join(dataset.path, manifest["file_pattern"])
+        return dataset.path
+
     logging.info(f"Using train script: {train_script_uri}")
     script_path = "/gcs/" + train_script_uri[5:]
     if not os.path.exists(script_path):
@@ -113,9 +134,9 @@ def custom_train_job(
         model_serving_container_image_uri=serving_container_uri,
     )
     cmd_args = [
-        f"--train_data={train_data.path}",
-        f"--valid_data={valid_data.path}",
-        f"--test_data={test_data.path}",
+        f"--train_data={data_path(train_data)}",
+        f"--valid_data={data_path(valid_data)}",
+        f"--test_data={data_path(test_data)}",
         f"--metrics={metrics.path}",
         f"--hparams={json.dumps(hparams if hparams else {})}",
     ]
@@ -128,6 +149,7 @@ def custom_train_job(
         machine_type=machine_type,
         accelerator_type=accelerator_type,
         accelerator_count=accelerator_count,
+        restart_job_on_worker_restart=restart_job_on_worker_restart,
     )
 
     resource_name = f"{uploaded_model.resource_name}@{uploaded_model.version_id}"
@@ -143,3 +165,15 @@ def custom_train_job(
     for k, v in parsed_metrics.items():
         if type(v) is float:
             metrics.log_metric(k, v)
+
+    throughput_path = os.path.join(os.path.dirname(metrics.path), "throughput.json")
+    try:
+        with open(throughput_path, "r") as fp:
+            throughput = json.load(fp)
+    except FileNotFoundError:
+        logging.info("No training throughput written by the train script")
+        throughput = {}
+    logging.info(f"Training throughput: {throughput}")
+    for k, v in throughput.items():
+        if type(v) is float:
+            metrics.log_metric(k, v)
@@ -0,0 +1,107 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from unittest import mock
+
+import google.cloud.aiplatform  # noqa
+from kfp.v2.dsl import Artifact, Dataset, Metrics
+
+import vertex_components
+
+custom_train_job = vertex_components.custom_train_job.python_func
+
+
+def test_custom_train_job_sharded_data(tmpdir):
+    """
+    Asserts that the wildcard pattern of sharded datasets is passed to the train
+    script, and the path of single file datasets is passed unchanged.
+    """
+    manifest = {"file_pattern": "part-*.parquet"}
+    train_data = Dataset(uri=f"{tmpdir}/train", metadata={"manifest": manifest})
+    valid_data = Dataset(uri=f"{tmpdir}/valid", metadata={"manifest": manifest})
+    test_data = Dataset(uri=f"{tmpdir}/test")
+    metrics = Metrics(uri=f"{tmpdir}/metrics")
+    with open(metrics.path, "w") as fp:
+        json.dump({"problemType": "regression", "rootMeanSquaredError": 0.1}, fp)
+
+    with mock.patch(
+        "google.cloud.aiplatform.CustomTrainingJob"
+    ) as mock_job, mock.patch("os.path.exists", return_value=True):
+        custom_train_job(
+            train_script_uri="gs://my-bucket/train.py",
+            train_data=train_data,
+            valid_data=valid_data,
+            test_data=test_data,
+            project_id="my-project-id",
+            project_location="europe-west4",
+            model_display_name="my-model",
+            train_container_uri="my-train-container",
+            serving_container_uri="my-serving-container",
+            model=Artifact(uri=f"{tmpdir}/model"),
+            metrics=metrics,
+            staging_bucket="gs://my-bucket",
+        )
+
+        args = mock_job.return_value.run.call_args[1]["args"]
+
+    assert args[:3] == [
+        f"--train_data={tmpdir}/train/part-*.parquet",
+        f"--valid_data={tmpdir}/valid/part-*.parquet",
+        f"--test_data={tmpdir}/test",
+    ]
+    assert metrics.metadata["rootMeanSquaredError"] == 0.1
+
+
+def test_custom_train_job_throughput(tmpdir):
+    """
+    Asserts that the numeric totals of the training throughput written next to
+    the metrics file are logged as metrics.
+    """
+    metrics = Metrics(uri=f"{tmpdir}/metrics")
+    with open(metrics.path, "w") as fp:
+        json.dump({"problemType": "regression", "rootMeanSquaredError": 0.1}, fp)
+    with open(f"{tmpdir}/throughput.json", "w") as fp:
+        json.dump(
+            {
+                "unit": "epoch",
+                "epochs": [{"epoch": 0, "examplesPerSecond": 1000.0}],
+                "examplesPerSecond": 1000.0,
+                "inputStallFraction": 0.25,
+            },
+            fp,
+        )
+
+    with mock.patch("google.cloud.aiplatform.CustomTrainingJob"), mock.patch(
+        "os.path.exists", return_value=True
+    ):
+        custom_train_job(
+            train_script_uri="gs://my-bucket/train.py",
+            train_data=Dataset(uri=f"{tmpdir}/train"),
+            valid_data=Dataset(uri=f"{tmpdir}/valid"),
+            test_data=Dataset(uri=f"{tmpdir}/test"),
+            project_id="my-project-id",
+            project_location="europe-west4",
+            model_display_name="my-model",
+            train_container_uri="my-train-container",
+            serving_container_uri="my-serving-container",
+            model=Artifact(uri=f"{tmpdir}/model"),
+            metrics=metrics,
+            staging_bucket="gs://my-bucket",
+        )
+
+    assert metrics.metadata["rootMeanSquaredError"] == 0.1
+    assert metrics.metadata["examplesPerSecond"] == 1000.0
+    assert metrics.metadata["inputStallFraction"] == 0.25
+    assert "epochs" not in metrics.metadata
@@ -1,17 +1,25 @@
 import argparse
+import collections
+import gzip
+import hashlib
 import os
 import json
 import logging
-import sys
+import resource
+import time
 
+import numpy as np
 import tensorflow as tf
 from pathlib import Path
 from tensorflow.data import Dataset
 from tensorflow.keras import Input, Model, optimizers
 from tensorflow.keras.layers import Dense, Normalization, StringLookup, Concatenate
+from tensorflow.keras.layers import Layer
 
 # used for monitoring during prediction time
 TRAINING_DATASET_INFO = "training_dataset.json"
+# training throughput per epoch, saved next to the metrics file
+THROUGHPUT_FILE = "throughput.json"
 # numeric/categorical features in Chicago trips dataset to be preprocessed
 NUM_COLS = ["dayofweek", "hourofday", "trip_distance", "trip_miles", "trip_seconds"]
 ORD_COLS = ["company"]
@@ -32,32 +40,373 @@ DEFAULT_HPARAMS = dict(
     distribute_strategy="single",
     early_stopping_epochs=5,
     label="total_fare",
+    feature_stats_cache=True,
+    shuffle_buffer_size=1000,
+    num_parallel_reads=None,
+    cache=None,
+    input_throughput_batches=0,
+    throughput_monitor=False,
+    tfrecord_shards=0,
+    steps_per_epoch=None,
+    mixed_precision=None,
+    jit_compile=False,
+    scale_batch_size=False,
+    warmup_steps=0,
+    checkpoint_steps=None,
+    serving_export="keras",
 )
 
+# number of rows per batch when computing the feature statistics
+STATS_BATCH_SIZE = 10000
+# default maximum number of files read in parallel, each with its own reader and
+# buffers (a large sharded export has hundreds of files)
+MAX_PARALLEL_READS = 16
+# feature statistics and TFRecord files cached in the cache directory, see
+# `cache_path`
+FEATURE_STATS_FILE = "feature_stats.json"
+TFRECORD_DIR = "tfrecord"
+# written last by the conversion to TFRecord files, once all files are complete
+TFRECORD_SUCCESS_FILE = "_SUCCESS"
+# number of rows serialized in each record of the TFRecord files
+TFRECORD_BATCH_SIZE = 10000
+# the workers wait for the chief to convert the data to TFRecord files for this
+# time plus the time to convert the CSV files at the given (low) rate
+TFRECORD_WAIT_SECONDS = 300
+TFRECORD_WAIT_BYTES_PER_SECOND = 1 << 20
+# minimum number of threads running the ops sent to a worker or parameter server
+# by the chief: with a single thread (the default on 1 CPU), a blocking op (e.g.
+# reading the next batch) starves the others and training hangs
+SERVER_INTER_OP_THREADS = 2
+
 logging.getLogger().setLevel(logging.INFO)
 
 
-def create_dataset(input_data: Path, label_name: str, model_params: dict) -> Dataset:
-    """Create a TF Dataset from input csv files.
+def get_compression_type(path: str) -> str:
+    """Detect the compression of a CSV file from its header.
+    Args:
+        path (str): path of a CSV file
+    Returns:
+        compression_type (str): "GZIP" for gzip compressed files, otherwise ""
+    """
+    with tf.io.gfile.GFile(path, "rb") as fp:
+        header = fp.read(4)
+    if header.startswith(b"\x1f\x8b"):
+        return "GZIP"
+    if header.startswith((b"PAR1", b"Obj\x01")):
+        raise RuntimeError(f"{path} is not a CSV file, export the data as CSV")
+    return ""
+
+
+def list_files(input_data: Path) -> list:
+    """List the data files of a single file, a directory of shards or a wildcard
+    pattern of shards. Files starting with an underscore are ignored."""
+    file_pattern = str(input_data)
+    if tf.io.gfile.isdir(file_pattern):
+        file_pattern = str(input_data / "*")
+    return [
+        f for f in tf.io.gfile.glob(file_pattern) if not Path(f).name.startswith("_")
+    ]
+
+
+def read_csv_header(path: str, compression_type: str) -> list:
+    """Read the column names from the header of a (gzip compressed) CSV file."""
+    with tf.io.gfile.GFile(path, "rb") as fp:
+        if compression_type == "GZIP":
+            fp = gzip.GzipFile(fileobj=fp)
+        return fp.readline().decode().strip().split(",")
+
+
+def parallel_reads(files: list, model_params: dict) -> int:
+    """Number of files read in parallel: `num_parallel_reads` if set in the model
+    parameters, otherwise all files up to MAX_PARALLEL_READS."""
+    return model_params.get("num_parallel_reads") or min(len(files), MAX_PARALLEL_READS)
+
+
+def csv_columns(path: str, compression_type: str, label_name: str) -> tuple:
+    """Select the columns of the features and the label in CSV files, which are
+    the only ones parsed, with explicit types.
+    Args:
+        path (str): path of a CSV file
+        compression_type (str): compression of the file, see `get_compression_type`
+        label_name (str): Name of column containing the labels
+    Returns:
+        selected, names, dtypes (list, list, list): indices, names and types of
+            the selected columns in the order of the file
+    """
+    column_names = read_csv_header(path, compression_type)
+    selected = sorted(
+        column_names.index(name)
+        for name in NUM_COLS + ORD_COLS + OHE_COLS + [label_name]
+    )
+    names = [column_names[i] for i in selected]
+    dtypes = [
+        tf.string if name in ORD_COLS + OHE_COLS else tf.float32 for name in names
+    ]
+    return selected, names, dtypes
+
+
+def read_csv_rows(files: list, label_name: str, model_params: dict) -> tuple:
+    """Read the rows of CSV files.
+    Args:
+        files (list): paths of (gzip compressed) CSV files
+        label_name (str): Name of column containing the labels
+        model_params (dict): model parameters
+    Returns:
+        rows, parse (Dataset, Callable): dataset of rows (tuples of columns) and a
+            function to turn a batch of rows into a (features, labels) tuple
+    """
+    compression_type = get_compression_type(files[0])
+    selected, names, record_defaults = csv_columns(
+        files[0], compression_type, label_name
+    )
+
+    def read_file(filename: tf.Tensor) -> Dataset:
+        return tf.data.experimental.CsvDataset(
+            filename,
+            record_defaults=record_defaults,
+            header=True,
+            select_cols=selected,
+            compression_type=compression_type,
+        )
+
+    def parse(*columns) -> tuple:
+        features = collections.OrderedDict(zip(names, columns))
+        return features, features.pop(label_name)
+
+    logging.info(f"Reading {len(files)} CSV file(s)...")
+    rows = Dataset.from_tensor_slices(files).interleave(
+        read_file,
+        cycle_length=parallel_reads(files, model_params),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=True,
+    )
+    return rows, parse
+
+
+def example_spec() -> dict:
+    """Parsing spec of the features in a `tf.train.Example`."""
+    return collections.OrderedDict(
+        (
+            (name, tf.io.FixedLenFeature([], tf.string))
+            if name in ORD_COLS + OHE_COLS
+            else (name, tf.io.FixedLenFeature([], tf.float32))
+        )
+        for name in NUM_COLS + ORD_COLS + OHE_COLS
+    )
+
+
+def to_example(row: dict) -> tf.train.Example:
+    """Convert a row (bytes or float by column name) to a `tf.train.Example`."""
+    feature = {
+        name: (
+            tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+            if isinstance(value, bytes)
+            else tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+        )
+        for name, value in row.items()
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def record_dtypes(label_name: str) -> dict:
+    """Types of the columns of the batches of rows in the TFRecord files written
+    by `convert_to_tfrecord`: the features, then the label."""
+    dtypes = collections.OrderedDict(
+        (name, spec.dtype) for name, spec in example_spec().items()
+    )
+    dtypes[label_name] = tf.float32
+    return dtypes
+
+
+def read_tfrecord_rows(files: list, label_name: str, model_params: dict) -> tuple:
+    """Read the rows of TFRecord files written by `convert_to_tfrecord`.
     Args:
-        input_data (Input[Dataset]): Train/Valid data in CSV format
+        files (list): paths of gzip compressed TFRecord files
         label_name (str): Name of column containing the labels
         model_params (dict): model parameters
-        file_pattern (str): Read data from one or more files. If empty, then
-            training and validation data is read from single file respectively.
-            For multiple files, use a pattern e.g. "files-*.csv".
+    Returns:
+        rows, parse (Dataset, Callable): dataset of rows (dicts of columns) and a
+            function to turn a batch of rows into a (features, labels) tuple
+    """
+    dtypes = record_dtypes(label_name)
+
+    def read_batch(record: tf.Tensor) -> dict:
+        columns = tf.io.parse_tensor(record, tf.string)
+        return collections.OrderedDict(
+            (name, tf.ensure_shape(tf.io.parse_tensor(columns[i], dtype), [None]))
+            for i, (name, dtype) in enumerate(dtypes.items())
+        )
+
+    def parse(columns: dict) -> tuple:
+        features = collections.OrderedDict(columns)
+        return features, features.pop(label_name)
+
+    logging.info(f"Reading {len(files)} TFRecord file(s)...")
+    rows = (
+        tf.data.TFRecordDataset(
+            files,
+            compression_type="GZIP",
+            num_parallel_reads=parallel_reads(files, model_params),
+        )
+        .map(read_batch, num_parallel_calls=tf.data.AUTOTUNE, deterministic=True)
+        .unbatch()
+    )
+    return rows, parse
+
+
+def tfrecord_files(input_data: Path, cache_dir: str) -> list:
+    """List the TFRecord files converted from the CSV files of a dataset, or an
+    empty list if they have not been (completely) converted."""
+    tfrecord_dir = cache_path(cache_dir, input_data, TFRECORD_DIR)
+    if not tf.io.gfile.exists(f"{tfrecord_dir}/{TFRECORD_SUCCESS_FILE}"):
+        return []
+    return sorted(tf.io.gfile.glob(f"{tfrecord_dir}/*.tfrecord.gz"))
+
+
+def convert_to_tfrecord(
+    input_data: Path, label_name: str, num_shards: int, cache_dir: str
+) -> str:
+    """Convert the CSV files of a dataset once to gzip compressed TFRecord files
+    in the cache directory. Each record is a batch of rows: the tensors of its
+    columns serialized with `tf.io.serialize_tensor`, so that the rows are
+    serialized and parsed by vectorized ops. The conversion is skipped if the CSV
+    files have not changed since the last conversion.
+    Args:
+        input_data (Path): CSV data, see `create_dataset`
+        label_name (str): Name of column containing the labels
+        num_shards (int): number of TFRecord files
+        cache_dir (str): cache directory, see `cache_path`
+    Returns:
+        tfrecord_dir (str): directory of the TFRecord files
+    """
+    tfrecord_dir = cache_path(cache_dir, input_data, TFRECORD_DIR)
+    if tfrecord_files(input_data, cache_dir):
+        logging.info(f"Using existing TFRecord files: {tfrecord_dir}")
+        return tfrecord_dir
+
+    logging.info(f"Converting {input_data} to {num_shards} TFRecord file(s)...")
+    files = list_files(input_data)
+    compression_type = get_compression_type(files[0])
+    selected, names, dtypes = csv_columns(files[0], compression_type, label_name)
+    if tf.io.gfile.exists(tfrecord_dir):
+        tf.io.gfile.rmtree(tfrecord_dir)
+    tf.io.gfile.makedirs(tfrecord_dir)
+
+    # the CSV lines are parsed by batches (unlike `read_csv_rows` which parses one
+    # row at a time), the lines of the data must not contain quoted line breaks
+    record_defaults = [tf.constant([], dtype) for dtype in dtypes]
+    order = [names.index(name) for name in record_dtypes(label_name)]
+
+    def serialize(lines: tf.Tensor) -> tf.Tensor:
+        columns = tf.io.decode_csv(lines, record_defaults, select_cols=selected)
+        return tf.io.serialize_tensor(
+            tf.stack([tf.io.serialize_tensor(columns[i]) for i in order])
+        )
+
+    records = (
+        tf.data.Dataset.from_tensor_slices(files)
+        .flat_map(
+            lambda path: tf.data.TextLineDataset(
+                path, compression_type=compression_type
+            ).skip(1)
+        )
+        .batch(TFRECORD_BATCH_SIZE)
+        .map(serialize, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    options = tf.io.TFRecordOptions(compression_type="GZIP")
+    writers = [
+        tf.io.TFRecordWriter(
+            f"{tfrecord_dir}/part-{i:05}-of-{num_shards:05}.tfrecord.gz", options
+        )
+        for i in range(num_shards)
+    ]
+    # batches of rows are written to the shards in turn
+    for i, record in enumerate(records):
+        writers[i % num_shards].write(record.numpy())
+    for writer in writers:
+        writer.close()
+
+    # written last, so that an interrupted conversion is not used
+    with tf.io.gfile.GFile(f"{tfrecord_dir}/{TFRECORD_SUCCESS_FILE}", "w") as fp:
+        fp.write("")
+    return tfrecord_dir
+
+
+def wait_for_tfrecord(
+    input_data: Path, cache_dir: str, timeout: float = None, interval: float = 10
+) -> list:
+    """Wait until the chief has converted the CSV files of a dataset to TFRecord
+    files, i.e. until the file written last by `convert_to_tfrecord` exists.
+    Args:
+        input_data (Path): CSV data, see `create_dataset`
+        cache_dir (str): cache directory, see `cache_path`
+        timeout (float): maximum number of seconds to wait, by default
+            TFRECORD_WAIT_SECONDS plus the time to convert the CSV files at
+            TFRECORD_WAIT_BYTES_PER_SECOND
+        interval (float): number of seconds between checks
+    Returns:
+        files (list): TFRecord files
+    """
+    if timeout is None:
+        size = sum(tf.io.gfile.stat(f).length for f in list_files(input_data))
+        timeout = TFRECORD_WAIT_SECONDS + size / TFRECORD_WAIT_BYTES_PER_SECOND
+    deadline = time.monotonic() + timeout
+    files = tfrecord_files(input_data, cache_dir)
+    while not files:
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"TFRecord files of {input_data} not converted after {timeout:.0f}s"
+            )
+        logging.info(f"Waiting for the TFRecord files of {input_data}...")
+        time.sleep(interval)
+        files = tfrecord_files(input_data, cache_dir)
+    return files
+
+
+def create_dataset(
+    input_data: Path,
+    label_name: str,
+    model_params: dict,
+    repeat: bool = False,
+    input_context: tf.distribute.InputContext = None,
+    shuffle: bool = True,
+    cache_dir: str = None,
+) -> Dataset:
+    """Create a TF Dataset from input csv files, or from the TFRecord files they
+    were converted to by `convert_to_tfrecord` if these are up to date.
+    Args:
+        input_data (Input[Dataset]): Train/Valid data in CSV format, optionally
+            compressed with gzip (detected from the file header). Read data from
+            a single file, a directory of shards or a wildcard pattern of shards
+            e.g. "part-*.csv". Shards are read in parallel.
+        label_name (str): Name of column containing the labels
+        model_params (dict): model parameters, the input pipeline is tuned with
+            `num_parallel_reads` (number of files read in parallel, all files
+            up to MAX_PARALLEL_READS by default), `shuffle_buffer_size`, and
+            `cache` ("memory" to cache the rows in memory, or a local directory
+            to cache them on disk, during the first epoch)
+        repeat (bool): repeat the data indefinitely (to train with a fixed number
+            of steps per epoch), otherwise the dataset is a single pass over the
+            data i.e. one epoch
+        input_context (tf.distribute.InputContext): input pipeline of the worker
+            reading the dataset, if the dataset is sharded between workers: by file
+            if there are at least as many files as workers, by row otherwise
+        shuffle (bool): reshuffle the rows in each pass over the data, otherwise
+            the rows are read in a deterministic order (e.g. for evaluation)
+        cache_dir (str): cache directory of the TFRecord files, see `cache_path`.
+            The CSV files are read if None
     Returns:
         dataset (TF Dataset): TF dataset where each element is a (features, labels)
             tuple that corresponds to a batch of CSV rows
     """
 
-    # shuffle & shuffle_buffer_size added to rearrange input data
-    # passed into model training
-    # num_rows_for_inference is for auto detection of datatypes
-    # while creating the dataset.
-    # If a float column has a high proportion of integer values (0/1 etc),
-    # the method wrongly detects it as a tf.int32 which fails during training time,
-    # hence the high hardcoded value (default is 100)
+    logging.info(f"Creating dataset from {input_data}...")
+    files = tfrecord_files(input_data, cache_dir) if cache_dir else []
+    read_rows = read_tfrecord_rows
+    if not files:
+        files = list_files(input_data)
+        read_rows = read_csv_rows
 
     # Apply data sharding: Sharded elements are produced by the dataset
     # Each worker will process the whole dataset and discard the portion that is
@@ -68,23 +417,80 @@ def create_dataset(input_data: Path, label_name: str, model_params: dict) -> Dat
         tf.data.experimental.AutoShardPolicy.DATA
     )
 
-    logging.info(f"Creating dataset from CSV file(s) at {input_data}...")
-    created_dataset = tf.data.experimental.make_csv_dataset(
-        file_pattern=str(input_data),
-        batch_size=model_params["batch_size"],
-        label_name=label_name,
-        num_epochs=model_params["epochs"],
-        shuffle=True,
-        shuffle_buffer_size=1000,
-        num_rows_for_inference=20000,
+    # Unless the dataset is sharded explicitly: with at least as many files as
+    # workers, each worker only reads its own files like with the FILE auto-shard
+    # policy, otherwise it discards the rows of the other workers as above (the
+    # FILE policy fails when there are fewer files than workers).
+    num_shards, shard_id = 1, 0
+    if input_context is not None:
+        num_shards = input_context.num_input_pipelines
+        shard_id = input_context.input_pipeline_id
+    if num_shards > 1:
+        data_options.experimental_distribute.auto_shard_policy = (
+            tf.data.experimental.AutoShardPolicy.OFF
+        )
+        if len(files) >= num_shards:
+            logging.info(f"Reading files of shard {shard_id} of {num_shards}")
+            files, num_shards = files[shard_id::num_shards], 1
+    rows, parse = read_rows(files, label_name, model_params)
+    if num_shards > 1:
+        logging.info(f"Reading rows of shard {shard_id} of {num_shards}")
+        rows = rows.shard(num_shards, shard_id)
+
+    cache = model_params.get("cache")
+    if cache:
+        if cache == "memory":
+            cache_file = ""
+        else:
+            # each dataset (train, valid, ...) needs its own cache file
+            cache_id = hashlib.sha256(str(input_data).encode()).hexdigest()[:16]
+            tf.io.gfile.makedirs(cache)
+            cache_file = os.path.join(cache, cache_id)
+        logging.info(f"Caching dataset in {cache_file or 'memory'}")
+        rows = rows.cache(cache_file)
+
+    # rows are reshuffled in each pass over the data
+    if shuffle:
+        rows = rows.shuffle(model_params.get("shuffle_buffer_size", 1000))
+    if repeat:
+        rows = rows.repeat()
+
+    created_dataset = (
+        rows.batch(model_params["batch_size"])
+        .map(parse, num_parallel_calls=tf.data.AUTOTUNE)
+        .prefetch(tf.data.AUTOTUNE)
     )
     return created_dataset.with_options(data_options)
 
 
+def measure_throughput(dataset: Dataset, num_batches: int) -> float:
+    """Measure the throughput of an input pipeline by reading batches without
+    training, to compare it with the throughput of training.
+    Args:
+        dataset (Dataset): batched dataset of (features, label) tuples
+        num_batches (int): number of batches to read
+    Returns:
+        throughput (float): examples per second
+    """
+    # the first batch is excluded as it includes the start-up of the pipeline
+    iterator = iter(dataset.repeat().take(num_batches + 1))
+    next(iterator)
+    examples = 0
+    start = time.perf_counter()
+    for _, labels in iterator:
+        examples += int(tf.shape(labels)[0])
+    throughput = examples / max(time.perf_counter() - start, 1e-9)
+    logging.info(f"Input pipeline throughput: {throughput:.0f} examples/sec")
+    return throughput
+
+
 def get_distribution_strategy(distribute_strategy: str) -> tf.distribute.Strategy:
     """Set distribute strategy based on input string.
     Args:
-        distribute_strategy (str): single, mirror or multi
+        distribute_strategy (str): single, default, mirror, multi or
+            parameter_server. With parameter_server, the workers and parameter
+            servers run a server until the job ends and this function never
+            returns, only the chief gets a strategy
     Returns:
         strategy (tf.distribute.Strategy): distribution strategy
     """
@@ -96,53 +502,258 @@ def get_distribution_strategy(distribute_strategy: str) -> tf.distribute.Strateg
             strategy = tf.distribute.OneDeviceStrategy(device="/gpu:0")
         else:
             strategy = tf.distribute.OneDeviceStrategy(device="/cpu:0")
+    # Single machine, ops placed by TensorFlow (on the first GPU if any): unlike
+    # `OneDeviceStrategy`, supports backing up the training state
+    elif distribute_strategy == "default":
+        strategy = tf.distribute.get_strategy()
     # Single machine, multiple compute device
     elif distribute_strategy == "mirror":
         strategy = tf.distribute.MirroredStrategy()
     # Multiple machine, multiple compute device
     elif distribute_strategy == "multi":
         strategy = tf.distribute.MultiWorkerMirroredStrategy()
+    # Multiple machines, variables on parameter servers (asynchronous training):
+    # the chief coordinates the training steps run by the workers
+    elif distribute_strategy == "parameter_server":
+        cluster_resolver = tf.distribute.cluster_resolver.TFConfigClusterResolver()
+        if cluster_resolver.task_type in ("worker", "ps"):
+            run_server(cluster_resolver)
+        strategy = tf.distribute.experimental.ParameterServerStrategy(cluster_resolver)
     else:
         raise RuntimeError(f"Distribute strategy: {distribute_strategy} not supported")
     return strategy
 
 
-def normalization(name: str, dataset: Dataset) -> Normalization:
+def run_server(cluster_resolver: tf.distribute.cluster_resolver.ClusterResolver):
+    """Run the server of a worker or parameter server, which runs the functions sent
+    by the chief until the job ends.
+    Args:
+        cluster_resolver (ClusterResolver): cluster and task of the server
+    """
+    logging.info(f"Starting {cluster_resolver.task_type} server...")
+    config = tf.compat.v1.ConfigProto(
+        inter_op_parallelism_threads=max(os.cpu_count() or 1, SERVER_INTER_OP_THREADS)
+    )
+    server = tf.distribute.Server(
+        cluster_resolver.cluster_spec(),
+        job_name=cluster_resolver.task_type,
+        task_index=cluster_resolver.task_id,
+        protocol=cluster_resolver.rpc_layer or "grpc",
+        config=config,
+        start=True,
+    )
+    server.join()
+
+
+def compute_feature_stats(dataset: Dataset) -> dict:
+    """Compute the statistics of all features in a single pass over the dataset:
+    mean and variance of numerical features and vocabulary (sorted by descending
+    frequency) of categorical features.
+    Args:
+        dataset (Dataset): batched dataset of (features, label) tuples
+    Returns:
+        stats (dict): mean and variance or vocabulary by feature name
+    """
+    logging.info("Computing feature statistics in a single pass...")
+    counts = {name: 0 for name in NUM_COLS}
+    means = {name: 0.0 for name in NUM_COLS}
+    m2s = {name: 0.0 for name in NUM_COLS}
+    vocab_counts = {name: collections.Counter() for name in ORD_COLS + OHE_COLS}
+    for features, _ in dataset:
+        for name in NUM_COLS:
+            # merge mean and sum of squared deviations of batch (Chan et al.)
+            values = features[name].numpy().astype(np.float64)
+            count, mean = len(values), values.mean()
+            delta = mean - means[name]
+            total = counts[name] + count
+            m2s[name] += ((values - mean) ** 2).sum()
+            m2s[name] += delta**2 * counts[name] * count / total
+            means[name] += delta * count / total
+            counts[name] = total
+        for name, counter in vocab_counts.items():
+            tokens, token_counts = np.unique(features[name].numpy(), return_counts=True)
+            counter.update(dict(zip(tokens, token_counts.tolist())))
+
+    stats = {
+        name: {
+            "mean": float(means[name]),
+            "variance": float(m2s[name] / max(counts[name], 1)),
+        }
+        for name in NUM_COLS
+    }
+    for name, counter in vocab_counts.items():
+        tokens = sorted(counter, key=lambda token: (-counter[token], token))
+        stats[name] = {"vocabulary": [token.decode() for token in tokens]}
+    return stats
+
+
+def dataset_fingerprint(files: list) -> str:
+    """Fingerprint of the content of a dataset, computed from the path, size and
+    modification time of its files and the names of the features.
+    Args:
+        files (list): paths of the data files
+    Returns:
+        fingerprint (str): hex digest
+    """
+    digest = hashlib.sha256(json.dumps([NUM_COLS, ORD_COLS, OHE_COLS]).encode())
+    for f in sorted(files):
+        stat = tf.io.gfile.stat(f)
+        digest.update(f"{f}:{stat.length}:{stat.mtime_nsec}".encode())
+    return digest.hexdigest()
+
+
+def cache_path(cache_dir: str, input_data: Path, name: str) -> str:
+    """Path of a file derived from a dataset (e.g. cached statistics) in the cache
+    directory, which is keyed by the fingerprint of the data files. The cache is
+    never written next to the data, which is an input of the training job.
+    Args:
+        cache_dir (str): cache directory, e.g. in the output directory of the job
+        input_data (Path): data, see `create_dataset`
+        name (str): name of the derived file
+    Returns:
+        path (str): path of the derived file
+    """
+    return f"{cache_dir}/{dataset_fingerprint(list_files(input_data))}/{name}"
+
+
+def get_feature_stats(
+    input_data: Path,
+    label_name: str,
+    model_params: dict,
+    cache_dir: str = None,
+    write_cache: bool = True,
+) -> dict:
+    """Get the feature statistics of the training data. If `feature_stats_cache`
+    is set in the model parameters, the statistics are cached in `cache_dir` and
+    reused as long as the fingerprint of the data is unchanged.
+    Args:
+        input_data (Path): training data, see `create_dataset`
+        label_name (str): name of column containing the labels
+        model_params (dict): model parameters
+        cache_dir (str): cache directory, see `cache_path`. No cache if None
+        write_cache (bool): write the statistics to the cache if they are
+            computed. With multiple workers, only the chief writes the cache, so
+            that the workers do not write the same file concurrently
+    Returns:
+        stats (dict): mean and variance or vocabulary by feature name
+    """
+    use_cache = model_params.get("feature_stats_cache", False) and cache_dir
+    if use_cache:
+        path = cache_path(cache_dir, input_data, FEATURE_STATS_FILE)
+        if tf.io.gfile.exists(path):
+            logging.info(f"Using cached feature statistics: {path}")
+            with tf.io.gfile.GFile(path, "r") as fp:
+                return json.load(fp)
+
+    # a single epoch of larger batches is enough to compute the statistics
+    stats_ds = create_dataset(
+        input_data,
+        label_name,
+        {**model_params, "batch_size": STATS_BATCH_SIZE, "cache": None},
+        cache_dir=cache_dir,
+    )
+    stats = compute_feature_stats(stats_ds)
+
+    if use_cache and write_cache:
+        logging.info(f"Caching feature statistics: {path}")
+        # written to a temporary file first, so that the cache is never read
+        # partially written
+        tf.io.gfile.makedirs(os.path.dirname(path))
+        with tf.io.gfile.GFile(f"{path}.tmp", "w") as fp:
+            json.dump(stats, fp)
+        tf.io.gfile.rename(f"{path}.tmp", path, overwrite=True)
+    return stats
+
+
+def normalization(name: str, stats: dict) -> Normalization:
     """Create a Normalization layer for a feature.
     Args:
         name (str): name of feature to be normalized
-        dataset (Dataset): dataset to adapt layer
+        stats (dict): feature statistics, see `compute_feature_stats`
     Returns:
-        normalization layer (Normalization): adapted normalization layer
-            of shape (?,1)
+        normalization layer (Normalization): normalization layer initialised with
+            the mean and variance of the feature, of shape (?,1)
     """
     logging.info(f"Normalizing numerical input '{name}'...")
-    x = Normalization(axis=None, name=f"normalize_{name}")
-    x.adapt(dataset.map(lambda y, _: y[name]))
-    return x
+    return Normalization(
+        axis=None,
+        mean=stats[name]["mean"],
+        variance=stats[name]["variance"],
+        name=f"normalize_{name}",
+    )
 
 
-def str_lookup(name: str, dataset: Dataset, output_mode: str) -> StringLookup:
+def str_lookup(name: str, stats: dict, output_mode: str) -> StringLookup:
     """Create a StringLookup layer for a feature.
     Args:
         name (str): name of feature to be encoded
-        dataset (Dataset): dataset to adapt layer
+        stats (dict): feature statistics, see `compute_feature_stats`
         output_mode (str): argument for StringLookup layer (e.g. 'one_hot', 'int')
     Returns:
-        StringLookup layer (StringLookup): adapted StringLookup layer of shape (?,X)
+        StringLookup layer (StringLookup): StringLookup layer initialised with the
+            vocabulary of the feature, of shape (?,X)
     """
     logging.info(f"Encoding categorical input '{name}' ({output_mode})...")
-    x = StringLookup(output_mode=output_mode, name=f"str_lookup_{output_mode}_{name}")
-    x.adapt(dataset.map(lambda y, _: y[name]))
-    logging.info(f"Vocabulary: {x.get_vocabulary()}")
-    return x
+    vocabulary = stats[name]["vocabulary"]
+    logging.info(f"Vocabulary: {vocabulary}")
+    return StringLookup(
+        vocabulary=vocabulary,
+        output_mode=output_mode,
+        name=f"str_lookup_{output_mode}_{name}",
+    )
 
 
-def build_and_compile_model(dataset: Dataset, model_params: dict) -> Model:
+class WarmUp(tf.keras.optimizers.schedules.LearningRateSchedule):
+    """Learning rate increasing linearly from 0 to `learning_rate` during the
+    first `warmup_steps` steps, then constant. Large batches trained with a
+    learning rate scaled by the number of replicas diverge without a warm up.
+    """
+
+    def __init__(self, learning_rate: float, warmup_steps: int):
+        super().__init__()
+        self.learning_rate = learning_rate
+        self.warmup_steps = warmup_steps
+
+    def __call__(self, step):
+        warmup = tf.cast(step + 1, tf.float32) / self.warmup_steps
+        return self.learning_rate * tf.minimum(1.0, warmup)
+
+    def get_config(self):
+        return {"learning_rate": self.learning_rate, "warmup_steps": self.warmup_steps}
+
+
+class XlaCompiled(Layer):
+    """Stack of layers compiled with XLA during training. The whole training step
+    cannot be compiled (`Model.compile(jit_compile=True)`) because XLA does not
+    support the string ops of the preprocessing layers. Inference is not compiled,
+    so that the exported model does not require XLA to be served.
+    """
+
+    def __init__(self, layers: list, **kwargs):
+        super().__init__(**kwargs)
+        self.block = tf.keras.Sequential(layers)
+        self.jit_block = tf.function(self.block, jit_compile=True)
+
+    def build(self, input_shape):
+        # the variables must exist before the compiled function is traced
+        self.block.build(input_shape)
+        super().build(input_shape)
+
+    def call(self, inputs, training=None):
+        if training:
+            return self.jit_block(inputs)
+        return self.block(inputs)
+
+
+def build_and_compile_model(feature_stats: dict, model_params: dict) -> Model:
     """Build and compile model.
     Args:
-        dataset (Dataset): training dataset
-        model_params (dict): model parameters
+        feature_stats (dict): statistics of the training data, see
+            `compute_feature_stats`
+        model_params (dict): model parameters, including `mixed_precision` (None,
+            "mixed_float16" for GPUs or "mixed_bfloat16" for TPUs and recent CPUs)
+            to compute the hidden layers in 16 bits, and `jit_compile` to compile
+            the hidden layers with XLA during training
     Returns:
         model (Model): built and compiled model
     """
@@ -160,9 +771,11 @@ def build_and_compile_model(dataset: Dataset, model_params: dict) -> Model:
     exp_ins = {n: tf.expand_dims(i, axis=-1) for n, i in all_ins.items()}
 
     # preprocess expanded inputs
-    num_encoded = [normalization(n, dataset)(exp_ins[n]) for n in NUM_COLS]
-    ord_encoded = [str_lookup(n, dataset, "int")(exp_ins[n]) for n in ORD_COLS]
-    ohe_encoded = [str_lookup(n, dataset, "one_hot")(exp_ins[n]) for n in OHE_COLS]
+    num_encoded = [normalization(n, feature_stats)(exp_ins[n]) for n in NUM_COLS]
+    ord_encoded = [str_lookup(n, feature_stats, "int")(exp_ins[n]) for n in ORD_COLS]
+    ohe_encoded = [
+        str_lookup(n, feature_stats, "one_hot")(exp_ins[n]) for n in OHE_COLS
+    ]
 
     # ensure ordinal encoded layers is of type float32 (like the other layers)
     ord_encoded = [tf.cast(x, tf.float32) for x in ord_encoded]
@@ -170,16 +783,40 @@ def build_and_compile_model(dataset: Dataset, model_params: dict) -> Model:
     # concat encoded inputs and add dense layers including output layer
     x = num_encoded + ord_encoded + ohe_encoded
     x = Concatenate()(x)
-    for units, activation in model_params["hidden_units"]:
-        x = Dense(units, activation=activation)(x)
-    x = Dense(1, name="output", activation="linear")(x)
+
+    # with mixed precision, only the hidden layers compute in 16 bits: the
+    # preprocessing layers (large raw values) and the output layer stay in float32
+    policy = model_params.get("mixed_precision")
+    if policy:
+        logging.info(f"Use mixed precision policy {policy}")
+    hidden = [
+        Dense(units, activation=activation, dtype=policy)
+        for units, activation in model_params["hidden_units"]
+    ]
+    if model_params.get("jit_compile"):
+        logging.info("Compile the hidden layers with XLA")
+        x = XlaCompiled(hidden, name="hidden")(x)
+    else:
+        for layer in hidden:
+            x = layer(x)
+    x = Dense(1, name="output", activation="linear", dtype="float32")(x)
 
     model = Model(inputs=all_ins, outputs=x, name="nn_model")
     model.summary()
 
     logging.info(f"Use optimizer {model_params['optimizer']}")
-    optimizer = optimizers.get(model_params["optimizer"])
-    optimizer.learning_rate = model_params["learning_rate"]
+    learning_rate = model_params["learning_rate"]
+    if model_params.get("warmup_steps"):
+        learning_rate = WarmUp(learning_rate, model_params["warmup_steps"])
+    optimizer = optimizers.get(
+        {
+            "class_name": model_params["optimizer"],
+            "config": {"learning_rate": learning_rate},
+        }
+    )
+    if policy == "mixed_float16":
+        # scale the loss so that small float16 gradients do not underflow
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
 
     model.compile(
         loss=model_params["loss_fn"],
@@ -190,6 +827,397 @@ def build_and_compile_model(dataset: Dataset, model_params: dict) -> Model:
     return model
 
 
+def vocabulary_tables(feature_stats: dict) -> dict:
+    """Create a static lookup table of the vocabulary of each categorical feature,
+    mapping values to their index in the vocabulary plus one (0 for unknown values
+    like the OOV index of `StringLookup`).
+    Args:
+        feature_stats (dict): statistics of the training data
+    Returns:
+        tables (dict): lookup table by feature name
+    """
+    tables = {}
+    for name in ORD_COLS + OHE_COLS:
+        vocabulary = feature_stats[name]["vocabulary"]
+        initializer = tf.lookup.KeyValueTensorInitializer(
+            tf.constant(vocabulary, tf.string),
+            tf.range(1, len(vocabulary) + 1, dtype=tf.int64),
+        )
+        tables[name] = tf.lookup.StaticHashTable(initializer, default_value=0)
+    return tables
+
+
+def encode_features(features: dict, feature_stats: dict, tables: dict) -> tf.Tensor:
+    """Encode a batch of features like the preprocessing layers of the model, with
+    the statistics of the training data as constants.
+    Args:
+        features (dict): batch of features (tensors of shape `(batch,)`)
+        feature_stats (dict): statistics of the training data
+        tables (dict): lookup tables of the vocabularies (see `vocabulary_tables`)
+    Returns:
+        encoded (tf.Tensor): encoded features, the input of the dense layers
+    """
+    encoded = []
+    for name in NUM_COLS:
+        mean = tf.constant(feature_stats[name]["mean"], tf.float32)
+        std = tf.constant(np.sqrt(feature_stats[name]["variance"]), tf.float32)
+        x = tf.cast(features[name], tf.float32)[:, None]
+        encoded.append((x - mean) / tf.maximum(std, tf.keras.backend.epsilon()))
+    for name in ORD_COLS:
+        indices = tables[name].lookup(features[name])
+        encoded.append(tf.cast(indices, tf.float32)[:, None])
+    for name in OHE_COLS:
+        indices = tables[name].lookup(features[name])
+        depth = len(feature_stats[name]["vocabulary"]) + 1
+        encoded.append(tf.one_hot(indices, depth, dtype=tf.float32))
+    return tf.concat(encoded, axis=1)
+
+
+def export_serving_model(tf_model: Model, feature_stats: dict, export_dir: str):
+    """Export a SavedModel optimized for serving: the preprocessing layers are
+    replaced by operations on constants and static lookup tables (see
+    `encode_features`), the weights of the dense layers are frozen into constants,
+    and training-only state (e.g. the optimizer) is dropped. The signatures are:
+    - `serving_default`: same inputs (a batch of each feature) and outputs as the
+      default signature of the Keras model
+    - `serving_examples`: a batch of serialized `tf.train.Example`
+    Args:
+        tf_model (Model): trained model built by `build_and_compile_model`
+        feature_stats (dict): statistics of the training data
+        export_dir (str): directory of the SavedModel
+    """
+    from tensorflow.python.framework.convert_to_constants import (
+        convert_variables_to_constants_v2,
+    )
+
+    # dense layers of the model, from the concatenated encoded features
+    concatenate = next(
+        layer for layer in tf_model.layers if isinstance(layer, Concatenate)
+    )
+    dense = Model(concatenate.output, tf_model.output)
+    output_name = tf_model.output_names[0]
+
+    @tf.function(input_signature=[tf.TensorSpec(concatenate.output.shape)])
+    def predict(encoded):
+        return dense(encoded, training=False)
+
+    frozen_function = convert_variables_to_constants_v2(predict.get_concrete_function())
+    tables = vocabulary_tables(feature_stats)
+
+    def frozen_predict(features: dict) -> tf.Tensor:
+        # the frozen function returns its outputs flattened (in a list)
+        encoded = encode_features(features, feature_stats, tables)
+        return tf.nest.flatten(frozen_function(encoded))[0]
+
+    input_signature = {
+        name: tf.TensorSpec([None], spec.dtype, name=name)
+        for name, spec in example_spec().items()
+    }
+
+    @tf.function(input_signature=[input_signature])
+    def serve_features(features):
+        return {output_name: frozen_predict(features)}
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.string, name="examples")])
+    def serve_examples(serialized):
+        features = tf.io.parse_example(serialized, example_spec())
+        return {output_name: frozen_predict(features)}
+
+    module = tf.Module()
+    module.tables = tables
+    module.serve_features = serve_features
+    module.serve_examples = serve_examples
+    logging.info(f"Export serving model to: {export_dir}")
+    tf.saved_model.save(
+        module,
+        export_dir,
+        signatures={
+            "serving_default": serve_features.get_concrete_function(),
+            "serving_examples": serve_examples.get_concrete_function(),
+        },
+    )
+
+
+class RegressionMetrics:
+    """Accumulator of regression metrics over chunks of labels and predictions.
+    Each chunk is reduced in a single vectorized pass to a handful of sums, so the
+    memory use does not depend on the size of the test set. Kept in sync with the
+    other training scripts, which are uploaded to Vertex AI as single files.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum_squared_error = 0.0
+        self.sum_absolute_error = 0.0
+        self.sum_absolute_percentage_error = 0.0
+        self.sum_squared_log_error = 0.0
+        # running mean and sum of squared deviations of the labels for R squared
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, y_true, y_pred) -> None:
+        """Add a chunk of labels and predictions (negative predictions are
+        clipped to zero for the squared log error)."""
+        y_true = np.asarray(y_true, dtype=np.float64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+        if not len(y_true):
+            return
+        error = y_pred - y_true
+        abs_error = np.abs(error)
+        log_error = np.log1p(np.clip(y_pred, 0, None)) - np.log1p(y_true)
+        self.sum_squared_error += error @ error
+        self.sum_absolute_error += abs_error.sum()
+        self.sum_absolute_percentage_error += (
+            abs_error / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)
+        ).sum()
+        self.sum_squared_log_error += log_error @ log_error
+
+        # merge mean and sum of squared deviations of chunk (Chan et al.)
+        count = len(y_true)
+        mean = y_true.mean()
+        deviation = y_true - mean
+        delta = mean - self.mean
+        total = self.count + count
+        self.m2 += deviation @ deviation + delta**2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+
+    def result(self) -> dict:
+        """Metrics in the schema of Vertex AI regression model evaluations."""
+        n = max(self.count, 1)
+        return {
+            "problemType": "regression",
+            "rootMeanSquaredError": float(np.sqrt(self.sum_squared_error / n)),
+            "meanAbsoluteError": float(self.sum_absolute_error / n),
+            "meanAbsolutePercentageError": float(
+                self.sum_absolute_percentage_error / n
+            ),
+            "rSquared": (
+                float(1 - self.sum_squared_error / self.m2) if self.m2 else None
+            ),
+            "rootMeanSquaredLogError": float(np.sqrt(self.sum_squared_log_error / n)),
+        }
+
+
+def evaluate_model(tf_model: Model, test_ds: Dataset) -> dict:
+    """Compute the regression metrics of the model on the test data, batch by
+    batch. The model is called outside of the distribution strategy: with `multi`,
+    `predict_on_batch` would gather the predictions of the batches of all workers.
+    Args:
+        tf_model (Model): trained model
+        test_ds (Dataset): test dataset, not sharded between workers
+    Returns:
+        metrics (dict): regression metrics of the test data
+    """
+    predict = tf.function(lambda features: tf_model(features, training=False))
+    test_metrics = RegressionMetrics()
+    for features, labels in test_ds:
+        test_metrics.update(labels.numpy(), predict(features).numpy())
+    return test_metrics.result()
+
+
+def fit_model(
+    tf_model: tf.keras.Model,
+    train_ds: Dataset,
+    valid_ds: Dataset,
+    model_params: dict,
+    checkpoint_dir: str = None,
+    callbacks: list = None,
+) -> tf.keras.callbacks.History:
+    """Fit the model for `epochs` epochs with early stopping, backing up the
+    training state to resume training if it is interrupted (e.g. preemption).
+    Args:
+        tf_model (tf.keras.Model): compiled model
+        train_ds (Dataset): train dataset, a single pass over the data unless
+            `steps_per_epoch` is set in which case it must be repeated
+        valid_ds (Dataset): validation dataset, evaluated once after each epoch
+            (if not None)
+        model_params (dict): model parameters, the training state is backed up at
+            the end of each epoch, or every `checkpoint_steps` steps (requires
+            `steps_per_epoch` and TF >= 2.11)
+        checkpoint_dir (str): directory of the backup of the training state. If a
+            backup exists, training resumes from it. The backup is deleted when
+            training completes. No backup if None
+        callbacks (list): additional Keras callbacks
+    Returns:
+        history (tf.keras.callbacks.History): training history
+    """
+    logging.info("Use early stopping")
+    callbacks = [
+        tf.keras.callbacks.EarlyStopping(
+            monitor="loss", mode="min", patience=model_params["early_stopping_epochs"]
+        ),
+        *(callbacks or []),
+    ]
+
+    if checkpoint_dir and isinstance(
+        tf_model.distribute_strategy, tf.distribute.OneDeviceStrategy
+    ):
+        logging.warning(
+            "BackupAndRestore does not support the single strategy, the training "
+            "state is not backed up (use the default strategy instead)"
+        )
+    elif checkpoint_dir and isinstance(
+        tf_model.distribute_strategy, tf.distribute.experimental.ParameterServerStrategy
+    ):
+        logging.warning(
+            "BackupAndRestore does not support parameter servers, the training "
+            "state is not backed up"
+        )
+    elif checkpoint_dir:
+        logging.info(f"Back up training state to: {checkpoint_dir}")
+        backup_args = {}
+        if model_params.get("checkpoint_steps"):
+            # the step to resume from is only known with a fixed number of steps
+            if model_params.get("steps_per_epoch"):
+                backup_args["save_freq"] = model_params["checkpoint_steps"]
+            else:
+                logging.warning("checkpoint_steps requires steps_per_epoch, ignored")
+        # stable API since TF 2.8
+        backup_and_restore = getattr(tf.keras.callbacks, "BackupAndRestore", None)
+        if backup_and_restore is None:
+            backup_and_restore = tf.keras.callbacks.experimental.BackupAndRestore
+        callbacks.append(backup_and_restore(checkpoint_dir, **backup_args))
+
+    logging.info("Fit model...")
+    return tf_model.fit(
+        train_ds,
+        epochs=model_params["epochs"],
+        steps_per_epoch=model_params.get("steps_per_epoch"),
+        validation_data=valid_ds,
+        callbacks=callbacks,
+    )
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB (Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class ThroughputMonitor(tf.keras.callbacks.Callback):
+    """Keras callback recording for each epoch the wall time, the examples per
+    second, the time blocked on input versus compute, and the peak RSS.
+
+    The input is read inside the training step, so the train dataset must be
+    wrapped with `timed`, which records when each batch is delivered to the
+    training step: the time from the start of the step until then is blocked on
+    input, the rest is compute. The first training step, which includes the
+    tracing of the training function, is not timed: its examples are counted but
+    not in the examples per second.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.epochs = []
+        self._traced = False
+        self._training = False
+        self._step_start = None
+        self._delivered = None
+        # sizes of the batches delivered but not trained on yet, one per step
+        self._batches = collections.deque()
+
+    def timed(self, dataset: Dataset) -> Dataset:
+        """Record the delivery of each batch of a dataset of (features, labels).
+        Args:
+            dataset (Dataset): train dataset
+        Returns:
+            dataset (Dataset): same batches, recorded when they are delivered
+        """
+
+        def record(features, labels):
+            delivered = tf.py_function(
+                self._on_batch_delivered, [tf.shape(labels)[0]], tf.float64
+            )
+            with tf.control_dependencies([delivered]):
+                return tf.nest.map_structure(tf.identity, (features, labels))
+
+        # not parallel and after prefetching, so that it runs when the training
+        # step gets the next batch
+        return dataset.map(record)
+
+    def _on_batch_delivered(self, num_examples: tf.Tensor) -> float:
+        now = time.perf_counter()
+        if self._training:
+            self._epoch["examples"] += int(num_examples)
+            self._batches.append(int(num_examples))
+            self._delivered = now
+        return now
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._epoch = dict(
+            epoch=epoch, steps=0, examples=0, timed_examples=0, input=0.0, compute=0.0
+        )
+        self._training = True
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+        self._delivered = None
+
+    def on_train_batch_end(self, batch, logs=None):
+        step_end = time.perf_counter()
+        self._epoch["steps"] += 1
+        num_examples = self._batches.popleft() if self._batches else 0
+        if not self._traced:
+            self._traced = True
+            return
+        self._epoch["timed_examples"] += num_examples
+        # batches prefetched before the step started did not block it
+        blocked = 0.0
+        if self._delivered is not None:
+            blocked = min(
+                max(self._delivered - self._step_start, 0.0),
+                step_end - self._step_start,
+            )
+        self._epoch["input"] += blocked
+        self._epoch["compute"] += step_end - self._step_start - blocked
+
+    def on_test_begin(self, logs=None):
+        self._training = False
+
+    def on_epoch_end(self, epoch, logs=None):
+        self._training = False
+        busy = self._epoch["input"] + self._epoch["compute"]
+        self.epochs.append(
+            {
+                "epoch": epoch,
+                "seconds": time.perf_counter() - self._epoch_start,
+                "steps": self._epoch["steps"],
+                "examples": self._epoch["examples"],
+                "timedExamples": self._epoch["timed_examples"],
+                "examplesPerSecond": self._epoch["timed_examples"] / max(busy, 1e-9),
+                "inputSeconds": self._epoch["input"],
+                "computeSeconds": self._epoch["compute"],
+                "peakRssMb": peak_rss_mb(),
+            }
+        )
+        logging.info(
+            f"Epoch {epoch}: {self.epochs[-1]['seconds']:.2f}s, "
+            f"{self.epochs[-1]['examplesPerSecond']:.0f} examples/s, "
+            f"{self._epoch['input']:.2f}s blocked on input"
+        )
+
+    def result(self) -> dict:
+        """Throughput of each epoch and of the whole training.
+        Returns:
+            throughput (dict): `epochs` (list of dicts) and totals
+        """
+        input_seconds = sum(epoch["inputSeconds"] for epoch in self.epochs)
+        compute_seconds = sum(epoch["computeSeconds"] for epoch in self.epochs)
+        busy = max(input_seconds + compute_seconds, 1e-9)
+        return {
+            "unit": "epoch",
+            "epochs": self.epochs,
+            "trainingSeconds": float(sum(epoch["seconds"] for epoch in self.epochs)),
+            "examplesPerSecond": sum(epoch["timedExamples"] for epoch in self.epochs)
+            / busy,
+            "inputSeconds": float(input_seconds),
+            "computeSeconds": float(compute_seconds),
+            "inputStallFraction": input_seconds / busy,
+            "peakRssMb": peak_rss_mb(),
+        }
+
+
 def _is_chief(strategy: tf.distribute.Strategy) -> bool:
     """Determine whether current worker is the chief (master). See more info:
     - https://www.tensorflow.org/tutorials/distribute/multi_worker_with_keras
@@ -203,6 +1231,28 @@ def _is_chief(strategy: tf.distribute.Strategy) -> bool:
     return (cr is None) or (cr.task_type == "chief" and cr.task_id == 0)
 
 
+def _input_context(strategy: tf.distribute.Strategy) -> tf.distribute.InputContext:
+    """Input pipeline of the current worker when training with multiple workers
+    (the chief and the other workers). See more info:
+    - https://www.tensorflow.org/tutorials/distribute/input#sharding
+    Args:
+        strategy (tf.distribute.Strategy): strategy
+    Returns:
+        input_context (tf.distribute.InputContext): input pipeline of the worker,
+            or None if not training with multiple workers
+    """
+    cr = strategy.cluster_resolver
+    if cr is None or cr.task_type not in ("chief", "worker"):
+        return None
+    cluster_spec = cr.cluster_spec().as_dict()
+    num_chiefs = len(cluster_spec.get("chief", []))
+    return tf.distribute.InputContext(
+        num_input_pipelines=num_chiefs + len(cluster_spec.get("worker", [])),
+        input_pipeline_id=cr.task_id + (num_chiefs if cr.task_type == "worker" else 0),
+        num_replicas_in_sync=strategy.num_replicas_in_sync,
+    )
+
+
 def _get_temp_dir(dirpath, task_id):
     base_dirpath = "workertemp_" + str(task_id)
     temp_dir = os.path.join(dirpath, base_dirpath)
@@ -210,90 +1260,220 @@ def _get_temp_dir(dirpath, task_id):
     return temp_dir
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--train_data", type=str, required=True)
-parser.add_argument("--valid_data", type=str, required=True)
-parser.add_argument("--test_data", type=str, required=True)
-parser.add_argument("--model", default=os.getenv("AIP_MODEL_DIR"), type=str, help="")
-parser.add_argument("--metrics", type=str, required=True)
-parser.add_argument("--hparams", default={}, type=json.loads)
-args = parser.parse_args()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_data", type=str, required=True)
+    parser.add_argument("--valid_data", type=str, required=True)
+    parser.add_argument("--test_data", type=str, required=True)
+    parser.add_argument(
+        "--model", default=os.getenv("AIP_MODEL_DIR"), type=str, help=""
+    )
+    parser.add_argument("--metrics", type=str, required=True)
+    parser.add_argument("--hparams", default={}, type=json.loads)
+    parser.add_argument(
+        "--checkpoint_dir",
+        default=os.getenv("AIP_CHECKPOINT_DIR"),
+        type=str,
+        help="Directory of the backup of the training state, to resume training "
+        "if the job is restarted e.g. on preemptible machines.",
+    )
+    parser.add_argument(
+        "--cache_dir",
+        type=str,
+        help="Directory of the data derived from the input data (e.g. feature "
+        "statistics), keyed by the fingerprint of the data files. Defaults to the "
+        "`cache` directory next to the model, in the output directory of the job.",
+    )
+    args = parser.parse_args()
+
+    if args.model.startswith("gs://"):
+        args.model = "/gcs/" + args.model[5:]
+    args.model = Path(args.model)
+    if args.checkpoint_dir and args.checkpoint_dir.startswith("gs://"):
+        args.checkpoint_dir = "/gcs/" + args.checkpoint_dir[5:]
+    if args.cache_dir and args.cache_dir.startswith("gs://"):
+        args.cache_dir = "/gcs/" + args.cache_dir[5:]
+    cache_dir = args.cache_dir or str(args.model.parent / "cache")
+
+    # merge dictionaries by overwriting default_model_params if provided in model_params
+    hparams = {**DEFAULT_HPARAMS, **args.hparams}
+    logging.info(f"Using model hyper-parameters: {hparams}")
+    label = hparams["label"]
 
-if args.model.startswith("gs://"):
-    args.model = Path("/gcs/" + args.model[5:])
+    # Set distribute strategy before any TF operations
+    strategy = get_distribution_strategy(hparams["distribute_strategy"])
+    parameter_servers = isinstance(
+        strategy, tf.distribute.experimental.ParameterServerStrategy
+    )
+    if parameter_servers and not hparams["steps_per_epoch"]:
+        raise ValueError("steps_per_epoch is required with parameter servers")
 
-# merge dictionaries by overwriting default_model_params if provided in model_params
-hparams = {**DEFAULT_HPARAMS, **args.hparams}
-logging.info(f"Using model hyper-parameters: {hparams}")
-label = hparams["label"]
+    tfrecord_cache_dir = None
+    if hparams["tfrecord_shards"]:
+        # the train and valid data are read once per epoch, so they are converted
+        # once to TFRecord files which are cheaper to parse than CSV files. Only
+        # the chief converts them, the other workers wait for the conversion so
+        # that all read the same files
+        tfrecord_cache_dir = cache_dir
+        for input_data in (args.train_data, args.valid_data):
+            if _is_chief(strategy):
+                convert_to_tfrecord(
+                    Path(input_data), label, hparams["tfrecord_shards"], cache_dir
+                )
+            else:
+                wait_for_tfrecord(Path(input_data), cache_dir)
 
-# Set distribute strategy before any TF operations
-strategy = get_distribution_strategy(hparams["distribute_strategy"])
+    if hparams["scale_batch_size"]:
+        # `batch_size` is per replica: the global batch size and the learning rate
+        # are scaled linearly with the number of replicas
+        replicas = strategy.num_replicas_in_sync
+        hparams["batch_size"] *= replicas
+        hparams["learning_rate"] *= replicas
+        logging.info(
+            f"Scaled batch size to {hparams['batch_size']} and learning rate to "
+            f"{hparams['learning_rate']} for {replicas} replicas"
+        )
 
-train_ds = create_dataset(Path(args.train_data), label, hparams)
-valid_ds = create_dataset(Path(args.valid_data), label, hparams)
-test_ds = create_dataset(Path(args.test_data), label, hparams)
+    # each pass over the train dataset is one epoch, unless `steps_per_epoch` is
+    # set in which case the train dataset is repeated indefinitely
+    input_context = None
+    if isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        input_context = _input_context(strategy)
+    train_ds = create_dataset(
+        Path(args.train_data),
+        label,
+        hparams,
+        repeat=bool(hparams["steps_per_epoch"]),
+        input_context=input_context,
+        cache_dir=tfrecord_cache_dir,
+    )
+    valid_ds = create_dataset(
+        Path(args.valid_data),
+        label,
+        hparams,
+        input_context=input_context,
+        cache_dir=tfrecord_cache_dir,
+    )
+    # the test data is read once, so it is never cached
+    test_ds = create_dataset(
+        Path(args.test_data), label, {**hparams, "cache": None}, shuffle=False
+    )
 
-train_features = list(train_ds.element_spec[0].keys())
-valid_features = list(valid_ds.element_spec[0].keys())
-logging.info(f"Training feature names: {train_features}")
-logging.info(f"Validation feature names: {valid_features}")
+    train_features = list(train_ds.element_spec[0].keys())
+    valid_features = list(valid_ds.element_spec[0].keys())
+    logging.info(f"Training feature names: {train_features}")
+    logging.info(f"Validation feature names: {valid_features}")
 
-if len(train_features) != len(valid_features):
-    raise RuntimeError(f"No. of training features != # validation features")
+    if len(train_features) != len(valid_features):
+        raise RuntimeError(f"No. of training features != # validation features")
 
-with strategy.scope():
-    tf_model = build_and_compile_model(train_ds, hparams)
+    feature_stats = get_feature_stats(
+        Path(args.train_data),
+        label,
+        hparams,
+        cache_dir=cache_dir,
+        write_cache=_is_chief(strategy),
+    )
 
-logging.info("Use early stopping")
-callback = tf.keras.callbacks.EarlyStopping(
-    monitor="loss", mode="min", patience=hparams["early_stopping_epochs"]
-)
+    if hparams["input_throughput_batches"]:
+        # measured on an uncached dataset so that the cache is filled by training
+        measure_throughput(
+            create_dataset(
+                Path(args.train_data),
+                label,
+                {**hparams, "cache": None},
+                cache_dir=tfrecord_cache_dir,
+            ),
+            hparams["input_throughput_batches"],
+        )
+
+    if parameter_servers:
+        # the chief dispatches the training steps to the workers with a
+        # `ClusterCoordinator`, created by Keras. Each worker creates its own shard
+        # of the train data, which is repeated as the chief does not know when
+        # a worker reaches the end of its shard
+        train_ds = tf.keras.utils.experimental.DatasetCreator(
+            lambda input_context: create_dataset(
+                Path(args.train_data),
+                label,
+                hparams,
+                repeat=True,
+                input_context=input_context,
+                cache_dir=tfrecord_cache_dir,
+            )
+        )
+        logging.warning("Validation is not supported with parameter servers")
+        valid_ds = None
+
+    # timing the delivery of each batch runs a Python function per batch, so the
+    # training throughput is only recorded on request
+    monitor = None
+    if hparams["throughput_monitor"] and parameter_servers:
+        logging.warning("Training throughput is not recorded with parameter servers")
+    elif hparams["throughput_monitor"]:
+        monitor = ThroughputMonitor()
+        train_ds = monitor.timed(train_ds)
+
+    with strategy.scope():
+        tf_model = build_and_compile_model(feature_stats, hparams)
+
+    history = fit_model(
+        tf_model,
+        train_ds,
+        valid_ds,
+        hparams,
+        checkpoint_dir=args.checkpoint_dir,
+        callbacks=[monitor] if monitor else None,
+    )
+
+    # likewise all workers must save the model, the other workers save it to a
+    # temporary directory, see
+    # https://www.tensorflow.org/tutorials/distribute/multi_worker_with_keras#model_saving_and_loading  # noqa: E501
+    if not _is_chief(strategy):
+        temp_dir = _get_temp_dir(
+            str(args.model.parent), strategy.cluster_resolver.task_id
+        )
+        tf_model.save(os.path.join(temp_dir, args.model.name), save_format="tf")
+        tf.io.gfile.rmtree(temp_dir)
+        # only persist output files if current worker is chief
+        logging.info("not chief node, exiting now")
+        return
+
+    logging.info("Evaluate model on test data...")
+    metrics = evaluate_model(tf_model, test_ds)
+
+    logging.info(f"Save model to: {args.model}")
+    args.model.mkdir(parents=True)
+    if hparams["serving_export"] == "optimized":
+        export_serving_model(tf_model, feature_stats, str(args.model))
+    else:
+        tf_model.save(str(args.model), save_format="tf")
+
+    logging.info(f"Save metrics to: {args.metrics}")
+    with open(args.metrics, "w") as fp:
+        json.dump(metrics, fp)
+
+    if monitor:
+        path = os.path.join(os.path.dirname(args.metrics), THROUGHPUT_FILE)
+        logging.info(f"Save training throughput to: {path}")
+        with open(path, "w") as fp:
+            json.dump(monitor.result(), fp)
+
+    # Persist URIs of training file(s) for model monitoring in batch predictions
+    # See https://cloud.google.com/python/docs/reference/aiplatform/latest/google.cloud.aiplatform_v1beta1.types.ModelMonitoringObjectiveConfig.TrainingDataset  # noqa: E501
+    # for the expected schema.
+    path = args.model / TRAINING_DATASET_INFO
+    training_dataset_for_monitoring = {
+        "gcsSource": {"uris": [args.train_data]},
+        "dataFormat": "csv",
+        "targetField": label,
+    }
+    logging.info(f"Save training dataset info for model monitoring: {path}")
+    logging.info(f"Training dataset: {training_dataset_for_monitoring}")
+
+    with open(path, "w") as fp:
+        json.dump(training_dataset_for_monitoring, fp)
 
-logging.info("Fit model...")
-history = tf_model.fit(
-    train_ds,
-    batch_size=hparams["batch_size"],
-    epochs=hparams["epochs"],
-    validation_data=valid_ds,
-    callbacks=[callback],
-)
 
-# only persist output files if current worker is chief
-if not _is_chief(strategy):
-    logging.info("not chief node, exiting now")
-    sys.exit()
-
-logging.info(f"Save model to: {args.model}")
-args.model.mkdir(parents=True)
-tf_model.save(str(args.model), save_format="tf")
-
-logging.info(f"Save metrics to: {args.metrics}")
-eval_metrics = dict(zip(tf_model.metrics_names, tf_model.evaluate(test_ds)))
-
-metrics = {
-    "problemType": "regression",
-    "rootMeanSquaredError": eval_metrics["root_mean_squared_error"],
-    "meanAbsoluteError": eval_metrics["mean_absolute_error"],
-    "meanAbsolutePercentageError": eval_metrics["mean_absolute_percentage_error"],
-    "rSquared": None,
-    "rootMeanSquaredLogError": eval_metrics["mean_squared_logarithmic_error"],
-}
-
-with open(args.metrics, "w") as fp:
-    json.dump(metrics, fp)
-
-# Persist URIs of training file(s) for model monitoring in batch predictions
-# See https://cloud.google.com/python/docs/reference/aiplatform/latest/google.cloud.aiplatform_v1beta1.types.ModelMonitoringObjectiveConfig.TrainingDataset  # noqa: E501
-# for the expected schema.
-path = args.model / TRAINING_DATASET_INFO
-training_dataset_for_monitoring = {
-    "gcsSource": {"uris": [args.train_data]},
-    "dataFormat": "csv",
-    "targetField": label,
-}
-logging.info(f"Save training dataset info for model monitoring: {path}")
-logging.info(f"Training dataset: {training_dataset_for_monitoring}")
-
-with open(path, "w") as fp:
-    json.dump(training_dataset_for_monitoring, fp)
+if __name__ == "__main__":
+    main()
@@ -80,6 +80,15 @@ def tensorflow_pipeline(
     valid_table = "valid_data" + table_suffix
     test_table = "test_data" + table_suffix
     primary_metric = "rootMeanSquaredError"
+    # the ingestion queries are rendered when the pipeline is compiled, so the
+    # partitioning of the ingested data table is set here rather than by pipeline
+    # parameters. Set `partition_column` (e.g. "trip_date") to partition it by day,
+    # and `ingestion_write_disposition` to "WRITE_APPEND" to ingest it
+    # incrementally. By default it is unpartitioned and rebuilt on each run
+    partition_column = None
+    ingestion_write_disposition = "WRITE_TRUNCATE"
+    if ingestion_write_disposition == "WRITE_APPEND" and not partition_column:
+        raise ValueError("Incremental ingestion requires a partition_column")
     train_script_uri = f"{pipeline_files_gcs_path}/training/assets/train_tf_model.py"
     hparams = dict(
         batch_size=100,
@@ -104,27 +113,24 @@ def tensorflow_pipeline(
         filter_column=time_column,
         target_column=label_column_name,
         filter_start_value=timestamp,
+        destination_dataset=dataset_id,
+        destination_table=ingested_table,
+        partition_column=partition_column,
+        write_disposition=ingestion_write_disposition,
     )
-    split_train_query = generate_query(
-        queries_folder / "sample.sql",
-        source_dataset=dataset_id,
-        source_table=ingested_table,
-        num_lots=10,
-        lots=tuple(range(8)),
-    )
-    split_valid_query = generate_query(
-        queries_folder / "sample.sql",
-        source_dataset=dataset_id,
-        source_table=ingested_table,
-        num_lots=10,
-        lots="(8)",
-    )
-    split_test_query = generate_query(
-        queries_folder / "sample.sql",
+    split_query = generate_query(
+        queries_folder / "split.sql",
         source_dataset=dataset_id,
         source_table=ingested_table,
+        destination_dataset=dataset_id,
+        filter_start_value=timestamp,
+        partition_column=partition_column,
         num_lots=10,
-        lots="(9)",
+        splits={
+            train_table: tuple(range(8)),
+            valid_table: "(8)",
+            test_table: "(9)",
+        },
     )
     data_cleaning_query = generate_query(
         queries_folder / "engineer_features.sql",
@@ -141,35 +147,46 @@ def tensorflow_pipeline(
         dataset_location=dataset_location,
         query_job_config=json.dumps(dict(write_disposition="WRITE_TRUNCATE")),
     )
+    ingest_kwargs = dict(
+        kwargs,
+        query_job_config=json.dumps(
+            dict(write_disposition=ingestion_write_disposition)
+        ),
+    )
+    if partition_column:
+        # an incremental run only appends the new days, and the split only reads
+        # the partitions of the trailing window
+        ingest_kwargs.update(
+            time_partitioning=json.dumps(dict(type_="DAY", field=partition_column)),
+            clustering_fields=json.dumps(["payment_type", "company"]),
+        )
     ingest = bq_query_to_table(
-        query=ingest_query, table_id=ingested_table, **kwargs
+        query=ingest_query, table_id=ingested_table, **ingest_kwargs
     ).set_display_name("Ingest data")
 
     # exporting data to GCS from BQ
-    split_train_data = (
-        bq_query_to_table(query=split_train_query, table_id=train_table, **kwargs)
-        .after(ingest)
-        .set_display_name("Split train data")
-    )
-    split_valid_data = (
-        bq_query_to_table(query=split_valid_query, table_id=valid_table, **kwargs)
-        .after(ingest)
-        .set_display_name("Split validation data")
-    )
-    split_test_data = (
-        bq_query_to_table(query=split_test_query, table_id=test_table, **kwargs)
+    # the script creates the three split tables from a single scan of the data
+    split_data = (
+        bq_query_to_table(
+            query=split_query,
+            bq_client_project_id=project_id,
+            destination_project_id=project_id,
+            dataset_location=dataset_location,
+        )
         .after(ingest)
-        .set_display_name("Split test data")
+        .set_display_name("Split data")
     )
     data_cleaning = (
         bq_query_to_table(
             query=data_cleaning_query, table_id=preprocessed_table, **kwargs
         )
-        .after(split_train_data)
+        .after(split_data)
         .set_display_name("Clean data")
     )
 
     # data extraction to gcs
+    # training data is exported as uncompressed CSV because it is also used as the
+    # training dataset for model monitoring in the prediction pipeline
 
     train_dataset = (
         extract_bq_to_dataset(
@@ -178,6 +195,7 @@ def tensorflow_pipeline(
             dataset_id=dataset_id,
             table_name=preprocessed_table,
             dataset_location=dataset_location,
+            sharded=True,
         )
         .after(data_cleaning)
         .set_display_name("Extract train data to storage")
@@ -189,8 +207,11 @@ def tensorflow_pipeline(
             dataset_id=dataset_id,
             table_name=valid_table,
             dataset_location=dataset_location,
+            sharded=True,
+            destination_format="CSV",
+            compression="GZIP",
         )
-        .after(split_valid_data)
+        .after(split_data)
         .set_display_name("Extract validation data to storage")
     ).outputs["dataset"]
     test_dataset = (
@@ -201,8 +222,10 @@ def tensorflow_pipeline(
             table_name=test_table,
             dataset_location=dataset_location,
             destination_gcs_uri=test_dataset_uri,
+            destination_format="CSV",
+            compression="GZIP",
         )
-        .after(split_test_data)
+        .after(split_data)
         .set_display_name("Extract test data to storage")
         .set_caching_options(False)
     ).outputs["dataset"]
@@ -18,15 +18,36 @@ with filter_start_values as (
     SELECT 
     IF("{{ filter_start_value }}" = '', CURRENT_DATETIME(), CAST("{{ filter_start_value }}" AS DATETIME)) as filter_start_value
 )
+{% set incremental = partition_column and write_disposition == "WRITE_APPEND" %}
+{% if incremental %}
+-- The destination table is partitioned by day and the query results are appended
+-- to it (incremental ingestion), so only the days after its last partition (the
+-- watermark) are ingested. The watermark is read from the partitions metadata,
+-- which is empty when the table does not exist yet.
+,watermarks as (
+    SELECT
+    MAX(PARSE_DATE('%Y%m%d', partition_id)) as watermark
+    FROM `{{ destination_dataset }}.INFORMATION_SCHEMA.PARTITIONS`
+    WHERE
+        table_name = '{{ destination_table }}'
+        AND partition_id NOT IN ('__NULL__', '__UNPARTITIONED__')
+)
+{% endif %}
 -- Ingest data between 2 and 3 months ago
 ,filtered_data as (
     SELECT
     *
-    FROM `{{ source_dataset }}.{{ source_table }}`, filter_start_values
+    FROM `{{ source_dataset }}.{{ source_table }}`, filter_start_values{% if incremental %}, watermarks{% endif %}
     WHERE
          DATE({{ filter_column }}) BETWEEN
          DATE_SUB(DATE(CAST(filter_start_values.filter_start_value as DATETIME)), INTERVAL 3 MONTH) AND
          DATE_SUB(DATE(filter_start_value), INTERVAL 2 MONTH)
+         {% if incremental %}
+         AND (
+             watermarks.watermark IS NULL
+             OR DATE({{ filter_column }}) > watermarks.watermark
+         )
+         {% endif %}
 )
 -- Use the average trip_seconds as a replacement for NULL or 0 values
 ,mean_time as (
@@ -48,6 +69,9 @@ SELECT
     payment_type,
     company,
     (fare + tips + tolls + extras) AS `{{ target_column }}`,
+    {% if partition_column %}
+    DATE({{ filter_column }}) AS `{{ partition_column }}`,
+    {% endif %}
 FROM filtered_data as t, mean_time as m
 WHERE
     trip_miles > 0 AND fare > 0 AND fare < 1500
@@ -0,0 +1,49 @@
+-- Copyright 2022 Google LLC
+
+-- Licensed under the Apache License, Version 2.0 (the "License");
+-- you may not use this file except in compliance with the License.
+-- You may obtain a copy of the License at
+
+--     https://www.apache.org/licenses/LICENSE-2.0
+
+-- Unless required by applicable law or agreed to in writing, software
+-- distributed under the License is distributed on an "AS IS" BASIS,
+-- WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+-- See the License for the specific language governing permissions and
+-- limitations under the License.
+
+-- Assign each row of the source table to one of {{ num_lots }} lots in a single
+-- scan, then write each split table from the lots assigned to it. The lot of a row
+-- is the fingerprint of the whole row, so it does not depend on the order of the
+-- rows. The fingerprint leaves out the partition column, so that a row is assigned
+-- to the same split whether the table is rebuilt or ingested incrementally. The
+-- lots are partitioned so that each split only reads its own lots.
+CREATE TEMP TABLE lots
+PARTITION BY RANGE_BUCKET(_lot, GENERATE_ARRAY(0, {{ num_lots }}, 1))
+AS
+SELECT
+    t.*,
+    {% if partition_column %}
+    MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(
+        (SELECT AS STRUCT t.* EXCEPT (`{{ partition_column }}`))
+    ))), {{ num_lots }}) AS _lot
+    {% else %}
+    MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t))), {{ num_lots }}) AS _lot
+    {% endif %}
+FROM
+ `{{ source_dataset }}.{{ source_table }}` AS t
+{% if partition_column %}
+-- the ingested table also holds the days ingested by former runs: only the
+-- partitions of the trailing window (the same as in ingest.sql) are split
+WHERE
+    t.`{{ partition_column }}` BETWEEN
+    DATE_SUB(DATE(IF("{{ filter_start_value }}" = '', CURRENT_DATETIME(), CAST("{{ filter_start_value }}" AS DATETIME))), INTERVAL 3 MONTH) AND
+    DATE_SUB(DATE(IF("{{ filter_start_value }}" = '', CURRENT_DATETIME(), CAST("{{ filter_start_value }}" AS DATETIME))), INTERVAL 2 MONTH)
+{% endif %}
+;
+{% for table, lots in splits.items() %}
+CREATE OR REPLACE TABLE `{{ destination_dataset }}.{{ table }}` AS
+SELECT * EXCEPT (_lot{% if partition_column %}, `{{ partition_column }}`{% endif %})
+FROM lots
+WHERE _lot IN {{ lots }};
+{% endfor %}
@@ -1,14 +1,24 @@
 import argparse
+import glob
+import gzip
+import itertools
+import math
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterator
 
 import joblib
 import json
 import os
 import logging
+import resource
 
 import numpy as np
 import pandas as pd
-from sklearn import metrics
+import xgboost as xgb
 from sklearn.compose import ColumnTransformer
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, OrdinalEncoder, OneHotEncoder
@@ -18,15 +28,392 @@ logging.basicConfig(level=logging.DEBUG)
 
 # used for monitoring during prediction time
 TRAINING_DATASET_INFO = "training_dataset.json"
+# training throughput per boosting round, saved next to the metrics file
+THROUGHPUT_FILE = "throughput.json"
 # numeric/categorical features in Chicago trips dataset to be preprocessed
 NUM_COLS = ["dayofweek", "hourofday", "trip_distance", "trip_miles", "trip_seconds"]
 ORD_COLS = ["company"]
 OHE_COLS = ["payment_type"]
+# explicit dtypes of the feature columns, columns which are not listed are not read
+FEATURE_DTYPES = {
+    **{col: np.float32 for col in NUM_COLS},
+    **{col: object for col in ORD_COLS + OHE_COLS},
+}
+# leading bytes used to detect the format of input files, CSV is the fallback
+MAGIC_BYTES = {
+    b"PAR1": "parquet",
+    b"Obj\x01": "avro",
+    b"ARROW1": "arrow",
+    b"\x1f\x8b": "csv.gz",
+}
+# number of rows per record batch when reading parquet and arrow files
+RECORD_BATCH_SIZE = 16384
+PARQUET_BUFFER_SIZE = 1 << 20
+# number of rows per chunk when training in streaming mode
+DEFAULT_CHUNK_SIZE = 100000
+# root of the cgroup filesystem which holds the CPU quota of the container
+CGROUP_ROOT = "/sys/fs/cgroup"
+# ranked candidates of the hyperparameter search, saved next to the model
+TRIALS_TABLE = "trials.csv"
+# model artifacts: the whole sklearn pipeline (served by the sklearn container), or
+# the preprocessing steps and the booster in a native XGBoost format
+MODEL_FILE = "model.joblib"
+PREPROCESSOR_FILE = "preprocessor.joblib"
+MODEL_FORMATS = ("joblib", "ubj", "json")
 
 
 def split_xy(df: pd.DataFrame, label: str) -> (pd.DataFrame, pd.Series):
-    """Split dataframe into X and y."""
-    return df.drop(columns=[label]), df[label]
+    """Split dataframe into X and y (in place to avoid copying the features)."""
+    y = df.pop(label)
+    return df, y
+
+
+def list_files(path: str) -> list:
+    """List input files given a single file, a directory of shards or a wildcard
+    pattern. Hidden files and files starting with an underscore are ignored."""
+    if os.path.isdir(path):
+        files = [str(p) for p in Path(path).iterdir() if p.is_file()]
+    else:
+        files = glob.glob(path) if "*" in path else [path]
+    files = [f for f in files if not Path(f).name.startswith(("_", "."))]
+    if not files:
+        raise FileNotFoundError(f"No input files found at {path}")
+    return sorted(files)
+
+
+def detect_format(path: str) -> str:
+    """Detect the format of a file (parquet, avro, arrow, csv or gzip compressed
+    csv) from its header."""
+    with open(path, "rb") as fp:
+        header = fp.read(max(len(magic) for magic in MAGIC_BYTES))
+    for magic, file_format in MAGIC_BYTES.items():
+        if header.startswith(magic):
+            return file_format
+    return "csv"
+
+
+def read_file(path: str, columns: list, dtypes: dict) -> pd.DataFrame:
+    """Read the given columns of a single file into a dataframe.
+    Args:
+        path (str): path of a parquet, avro, arrow or (gzip compressed) csv file
+        columns (list): names of the columns to read
+        dtypes (dict): mapping of column names to dtypes
+    Returns:
+        df (pd.DataFrame): dataframe with the selected columns
+    """
+    file_format = detect_format(path)
+    logging.info(f"Read {file_format} file {path}")
+    if file_format in ("csv", "csv.gz"):
+        return pd.read_csv(
+            path, usecols=columns, dtype=dtypes, compression=_compression(file_format)
+        )
+
+    if file_format in ("parquet", "arrow"):
+        num_rows, batches = read_record_batches(path, file_format, columns, dtypes)
+        return batches_to_frame(batches, num_rows, columns, dtypes)
+
+    import fastavro
+
+    with open(path, "rb") as fp:
+        df = pd.DataFrame.from_records(fastavro.reader(fp), columns=columns)
+    return df.astype(dtypes)
+
+
+def read_record_batches(
+    path: str,
+    file_format: str,
+    columns: list,
+    dtypes: dict,
+    batch_size: int = RECORD_BATCH_SIZE,
+) -> (int, Iterator):
+    """Read the given columns of a parquet or arrow file in record batches. The
+    categorical columns are read dictionary encoded, which avoids materializing
+    one string per row.
+    Args:
+        path (str): path of a parquet or arrow file
+        file_format (str): parquet or arrow
+        columns (list): names of the columns to read
+        dtypes (dict): mapping of column names to dtypes
+        batch_size (int): maximum number of rows per batch
+    Returns:
+        num_rows (int): number of rows of the file
+        batches (Iterator[pyarrow.RecordBatch]): batches with the selected columns
+    """
+    categorical = [col for col in columns if dtypes.get(col) is object]
+    if file_format == "parquet":
+        from pyarrow import parquet
+
+        # the column chunks are streamed in buffers instead of read whole
+        parquet_file = parquet.ParquetFile(
+            path,
+            read_dictionary=categorical,
+            pre_buffer=False,
+            buffer_size=PARQUET_BUFFER_SIZE,
+        )
+        batches = parquet_file.iter_batches(batch_size, columns=columns)
+        return parquet_file.metadata.num_rows, batches
+
+    import pyarrow as pa
+    from pyarrow import ipc
+
+    reader = ipc.open_file(path)
+
+    def batches():
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, batch_size):
+                chunk = batch.slice(offset, batch_size)
+                yield pa.RecordBatch.from_arrays(
+                    [
+                        (
+                            chunk.column(col).dictionary_encode()
+                            if col in categorical
+                            else chunk.column(col)
+                        )
+                        for col in columns
+                    ],
+                    names=columns,
+                )
+
+    num_rows = sum(
+        reader.get_batch(i).num_rows for i in range(reader.num_record_batches)
+    )
+    return num_rows, batches()
+
+
+def batches_to_frame(
+    batches: Iterator, num_rows: int, columns: list, dtypes: dict
+) -> pd.DataFrame:
+    """Copy record batches into columns allocated once with their final dtypes, so
+    that neither the whole Arrow table nor a second copy of the dataframe is held
+    in memory.
+    Args:
+        batches (Iterator[pyarrow.RecordBatch]): batches with the given columns
+        num_rows (int): total number of rows of the batches
+        columns (list): names of the columns
+        dtypes (dict): mapping of column names to dtypes
+    Returns:
+        df (pd.DataFrame): dataframe with the given columns
+    """
+    data = {col: np.empty(num_rows, dtype=dtypes[col]) for col in columns}
+    offset = 0
+    for batch in batches:
+        for col in columns:
+            array = batch.column(col)
+            if dtypes[col] is object:
+                # the rows share the string objects of the dictionary
+                values = np.array(array.dictionary.to_pylist() + [np.nan], object)
+                array = values[array.indices.fill_null(len(values) - 1).to_numpy()]
+            else:
+                array = array.to_numpy(zero_copy_only=False)
+            data[col][offset : offset + batch.num_rows] = array
+        offset += batch.num_rows
+    return pd.DataFrame(
+        {col: pd.Series(data[col], dtype=dtypes[col], copy=False) for col in columns},
+        copy=False,
+    )
+
+
+def read_file_chunks(
+    path: str, columns: list, dtypes: dict, chunk_size: int
+) -> Iterator[pd.DataFrame]:
+    """Read the given columns of a single file in chunks.
+    Args:
+        path (str): path of a parquet, avro, arrow or (gzip compressed) csv file
+        columns (list): names of the columns to read
+        dtypes (dict): mapping of column names to dtypes
+        chunk_size (int): maximum number of rows per chunk
+    Returns:
+        chunks (Iterator[pd.DataFrame]): dataframes with the selected columns
+    """
+    file_format = detect_format(path)
+    logging.info(f"Read {file_format} file {path} in chunks of {chunk_size} rows")
+    if file_format in ("csv", "csv.gz"):
+        yield from pd.read_csv(
+            path,
+            usecols=columns,
+            dtype=dtypes,
+            compression=_compression(file_format),
+            chunksize=chunk_size,
+        )
+        return
+
+    if file_format in ("parquet", "arrow"):
+        _, batches = read_record_batches(path, file_format, columns, dtypes, chunk_size)
+        for batch in batches:
+            yield batches_to_frame([batch], batch.num_rows, columns, dtypes)
+    else:
+        import fastavro
+
+        with open(path, "rb") as fp:
+            records = fastavro.reader(fp)
+            while True:
+                chunk = pd.DataFrame.from_records(
+                    itertools.islice(records, chunk_size), columns=columns
+                )
+                if chunk.empty:
+                    break
+                yield chunk.astype(dtypes)
+
+
+def _compression(file_format: str) -> str:
+    """Compression argument of `pd.read_csv` for a detected file format."""
+    return "gzip" if file_format == "csv.gz" else None
+
+
+def read_data(path: str, label: str) -> pd.DataFrame:
+    """Read features and label from one or more files into a single dataframe.
+    Multiple files (shards) are read in parallel.
+    Args:
+        path (str): path to a file, a directory of shards or a wildcard pattern
+        label (str): name of the label column
+    Returns:
+        df (pd.DataFrame): dataframe with features and label
+    """
+    columns = list(FEATURE_DTYPES) + [label]
+    dtypes = {**FEATURE_DTYPES, label: np.float64}
+    files = list_files(path)
+    with ThreadPoolExecutor(max_workers=min(len(files), os.cpu_count())) as pool:
+        frames = list(pool.map(lambda f: read_file(f, columns, dtypes), files))
+    if len(frames) == 1:
+        return frames[0]
+    return pd.concat(frames, ignore_index=True)
+
+
+def iter_chunks(path: str, label: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """Read features and label from one or more files in chunks, so that at most
+    one chunk is held in memory at a time.
+    Args:
+        path (str): path to a file, a directory of shards or a wildcard pattern
+        label (str): name of the label column
+        chunk_size (int): maximum number of rows per chunk
+    Returns:
+        chunks (Iterator[pd.DataFrame]): dataframes with features and label
+    """
+    columns = list(FEATURE_DTYPES) + [label]
+    dtypes = {**FEATURE_DTYPES, label: np.float64}
+    for f in list_files(path):
+        yield from read_file_chunks(f, columns, dtypes, chunk_size)
+
+
+def cgroup_cpu_quota(root: str = CGROUP_ROOT) -> float:
+    """Read the CPU quota of the container from cgroup v2 (`cpu.max`) or cgroup v1
+    (`cpu.cfs_quota_us` and `cpu.cfs_period_us`).
+    Args:
+        root (str): root of the cgroup filesystem
+    Returns:
+        quota (float): number of CPUs the container may use, None if unlimited
+    """
+    cpu_max = Path(root) / "cpu.max"
+    if cpu_max.is_file():
+        quota, period = cpu_max.read_text().split()
+    else:
+        cpu_dir = Path(root) / "cpu"
+        try:
+            quota = (cpu_dir / "cpu.cfs_quota_us").read_text().strip()
+            period = (cpu_dir / "cpu.cfs_period_us").read_text().strip()
+        except OSError:
+            return None
+    if quota in ("max", "-1"):
+        return None
+    return int(quota) / int(period)
+
+
+def available_cpus(root: str = CGROUP_ROOT) -> int:
+    """Number of CPUs available to the training process, i.e. the CPUs it is pinned
+    to (CPU affinity) capped by the CPU quota of the container (cgroup)."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_quota(root)
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB (Linux)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# the callback API (XGBoost >= 1.3) and the data iterator (XGBoost >= 1.5) are
+# optional, so that the script can still be imported and train in memory with
+# older versions
+TrainingCallback = getattr(xgb.callback, "TrainingCallback", object)
+DataIter = getattr(xgb, "DataIter", object)
+
+
+class IterationTimer(TrainingCallback):
+    """XGBoost callback which logs the wall time of each boosting round, and
+    with `monitor` records the peak RSS after each round (see `result`)."""
+
+    def __init__(self, verbose: bool = True, monitor: bool = False):
+        self.verbose = verbose
+        self.monitor = monitor
+        self.times = []
+        self.peak_rss = []
+        # number of training rows, which each boosting round goes through
+        self.num_examples = 0
+        self._start = None
+        super().__init__()
+
+    def before_iteration(self, model, epoch: int, evals_log: dict) -> bool:
+        self._start = time.perf_counter()
+        return False
+
+    def after_iteration(self, model, epoch: int, evals_log: dict) -> bool:
+        self.times.append(time.perf_counter() - self._start)
+        if self.monitor:
+            self.peak_rss.append(peak_rss_mb())
+        if self.verbose:
+            logging.info(f"Boosting round {epoch}: {self.times[-1]:.3f}s")
+        return False
+
+    def after_training(self, model):
+        if self.times:
+            logging.info(
+                f"Trained {len(self.times)} boosting rounds in {sum(self.times):.2f}s "
+                f"({np.median(self.times):.3f}s median per round)"
+            )
+        return model
+
+    def result(self, training_seconds: float) -> dict:
+        """Throughput of each boosting round and of the whole training (requires
+        `monitor`). The boosting rounds read the data from memory, the time
+        blocked on input is the time spent reading and preprocessing the data.
+        Args:
+            training_seconds (float): wall time of training, including reading and
+                preprocessing the data
+        Returns:
+            throughput (dict): `epochs` (one per boosting round) and totals
+        """
+        compute_seconds = float(sum(self.times))
+        input_seconds = max(training_seconds - compute_seconds, 0.0)
+        busy = max(input_seconds + compute_seconds, 1e-9)
+        return {
+            "unit": "boosting_round",
+            "epochs": [
+                {
+                    "epoch": epoch,
+                    "seconds": seconds,
+                    "examples": self.num_examples,
+                    "examplesPerSecond": self.num_examples / max(seconds, 1e-9),
+                    "inputSeconds": 0.0,
+                    "computeSeconds": seconds,
+                    "peakRssMb": peak_rss,
+                }
+                for epoch, (seconds, peak_rss) in enumerate(
+                    zip(self.times, self.peak_rss)
+                )
+            ],
+            "trainingSeconds": float(training_seconds),
+            "examplesPerSecond": self.num_examples * len(self.times) / busy,
+            "inputSeconds": input_seconds,
+            "computeSeconds": compute_seconds,
+            "inputStallFraction": input_seconds / busy,
+            "peakRssMb": peak_rss_mb(),
+        }
 
 
 def indices_in_list(elements: list, base_list: list) -> list:
@@ -34,109 +421,802 @@ def indices_in_list(elements: list, base_list: list) -> list:
     return [idx for idx, elem in enumerate(base_list) if elem in elements]
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--train_data", type=str, required=True)
-parser.add_argument("--valid_data", type=str, required=True)
-parser.add_argument("--test_data", type=str, required=True)
-parser.add_argument("--model", default=os.getenv("AIP_MODEL_DIR"), type=str, help="")
-parser.add_argument("--metrics", type=str, required=True)
-parser.add_argument("--hparams", default={}, type=json.loads)
-args = parser.parse_args()
-
-if args.model.startswith("gs://"):
-    args.model = Path("/gcs/" + args.model[5:])
-
-logging.info("Read csv files into dataframes")
-df_train = pd.read_csv(args.train_data)
-df_valid = pd.read_csv(args.valid_data)
-df_test = pd.read_csv(args.test_data)
-
-logging.info("Split dataframes")
-label = args.hparams["label"]
-X_train, y_train = split_xy(df_train, label)
-X_valid, y_valid = split_xy(df_valid, label)
-X_test, y_test = split_xy(df_test, label)
-
-logging.info("Get the number of unique categories for ordinal encoded columns")
-ordinal_columns = X_train[ORD_COLS]
-n_unique_cat = ordinal_columns.nunique()
-
-logging.info("Get indices of columns in base data")
-col_list = X_train.columns.tolist()
-num_indices = indices_in_list(NUM_COLS, col_list)
-cat_indices_onehot = indices_in_list(OHE_COLS, col_list)
-cat_indices_ordinal = indices_in_list(ORD_COLS, col_list)
-
-ordinal_transformers = [
-    (
-        f"ordinal encoding for {ord_col}",
-        OrdinalEncoder(
-            handle_unknown="use_encoded_value", unknown_value=n_unique_cat[ord_col]
+def build_preprocessor(
+    col_list: list, categories: dict, native_categorical: bool = False
+) -> ColumnTransformer:
+    """Build the sklearn preprocessing steps.
+    Args:
+        col_list (list): names of the input columns
+        categories (dict): sorted list of known categories of each categorical column
+        native_categorical (bool): encode all categorical columns as category codes
+            for the native categorical support of XGBoost instead of one-hot and
+            ordinal encoding. Unknown categories are encoded as missing values.
+    Returns:
+        preprocessor (ColumnTransformer): unfitted preprocessing steps
+    """
+    logging.info("Get indices of columns in base data")
+    num_indices = indices_in_list(NUM_COLS, col_list)
+    cat_indices_onehot = indices_in_list(OHE_COLS, col_list)
+
+    if native_categorical:
+        cat_indices = indices_in_list(ORD_COLS + OHE_COLS, col_list)
+        logging.info("Build sklearn preprocessing steps for native categorical support")
+        return ColumnTransformer(
+            transformers=[
+                ("numeric", "passthrough", num_indices),
+                (
+                    "category_codes",
+                    OrdinalEncoder(
+                        categories=[categories[col_list[i]] for i in cat_indices],
+                        handle_unknown="use_encoded_value",
+                        unknown_value=np.nan,
+                    ),
+                    cat_indices,
+                ),
+            ]
+        )
+
+    ordinal_transformers = [
+        (
+            f"ordinal encoding for {ord_col}",
+            OrdinalEncoder(
+                categories=[categories[ord_col]],
+                handle_unknown="use_encoded_value",
+                unknown_value=len(categories[ord_col]),
+            ),
+            [col_list.index(ord_col)],
+        )
+        for ord_col in ORD_COLS
+    ]
+    all_transformers = [
+        ("numeric_scaling", StandardScaler(), num_indices),
+        (
+            "one_hot_encoding",
+            OneHotEncoder(
+                categories=[categories[col_list[i]] for i in cat_indices_onehot],
+                handle_unknown="ignore",
+            ),
+            cat_indices_onehot,
         ),
-        [ord_index],
-    )
-    for ord_col in ORD_COLS
-    for ord_index in cat_indices_ordinal
-]
-all_transformers = [
-    ("numeric_scaling", StandardScaler(), num_indices),
-    (
-        "one_hot_encoding",
-        OneHotEncoder(handle_unknown="ignore"),
-        cat_indices_onehot,
-    ),
-] + ordinal_transformers
-
-logging.info("Build sklearn preprocessing steps")
-preprocesser = ColumnTransformer(transformers=all_transformers)
-logging.info("Build sklearn pipeline with XGBoost model")
-xgb_model = XGBRegressor(**args.hparams)
-
-pipeline = Pipeline(
-    steps=[("feature_engineering", preprocesser), ("train_model", xgb_model)]
-)
-
-logging.info("Transform validation data")
-valid_preprocesser = preprocesser.fit(X_train)
-X_valid_transformed = valid_preprocesser.transform(X_valid)
-
-logging.info("Fit model")
-pipeline.fit(X_train, y_train, train_model__eval_set=[(X_valid_transformed, y_valid)])
-
-logging.info("Predict test data")
-y_pred = pipeline.predict(X_test)
-y_pred = y_pred.clip(0)
-
-metrics = {
-    "problemType": "regression",
-    "rootMeanSquaredError": np.sqrt(metrics.mean_squared_error(y_test, y_pred)),
-    "meanAbsoluteError": metrics.mean_absolute_error(y_test, y_pred),
-    "meanAbsolutePercentageError": metrics.mean_absolute_percentage_error(
-        y_test, y_pred
-    ),
-    "rSquared": metrics.r2_score(y_test, y_pred),
-    "rootMeanSquaredLogError": np.sqrt(metrics.mean_squared_log_error(y_test, y_pred)),
-}
+    ] + ordinal_transformers
+
+    logging.info("Build sklearn preprocessing steps")
+    return ColumnTransformer(transformers=all_transformers)
+
+
+def is_native_categorical(xgb_model: XGBRegressor) -> bool:
+    """Check whether the model is configured for native categorical support.
+    Raises:
+        RuntimeError: if it is, but the installed XGBoost cannot fit the model on
+            category codes (`feature_types` was added in XGBoost 1.7)
+    """
+    if not xgb_model.get_params().get("enable_categorical"):
+        return False
+    if "feature_types" not in xgb_model.get_params():
+        raise RuntimeError(
+            f"Native categorical support requires xgboost>=1.7 (found "
+            f"{xgb.__version__}), which requires a training container with "
+            "Python>=3.8. Remove enable_categorical from the hyperparameters to "
+            "one-hot encode the categorical columns instead"
+        )
+    return True
+
+
+def set_feature_types(xgb_model: XGBRegressor, preprocessor: ColumnTransformer) -> list:
+    """Set the feature types of the output of the native categorical preprocessing
+    steps on the model, so that the model can be fitted on and serve plain arrays.
+    Args:
+        xgb_model (XGBRegressor): model with `enable_categorical=True`
+        preprocessor (ColumnTransformer): native categorical preprocessing steps
+    Returns:
+        feature_types (list): "q" for numeric and "c" for categorical features
+    """
+    feature_types = [
+        "c" if name == "category_codes" else "q"
+        for name, _, indices in preprocessor.transformers
+        for _ in indices
+    ]
+    xgb_model.set_params(
+        feature_types=feature_types, tree_method=xgb_model.tree_method or "hist"
+    )
+    return feature_types
+
+
+def fit_preprocessor_streaming(
+    chunks: Callable[[], Iterator[pd.DataFrame]], native_categorical: bool = False
+) -> ColumnTransformer:
+    """Fit the preprocessing steps in a single pass over chunks of the features.
+    The scaler is fitted incrementally and the categories of the encoders are
+    collected from all chunks.
+    Args:
+        chunks (Callable): function returning an iterator over feature chunks
+        native_categorical (bool): build the preprocessing steps for the native
+            categorical support of XGBoost
+    Returns:
+        preprocessor (ColumnTransformer): fitted preprocessing steps
+    """
+    scaler = StandardScaler()
+    categories = {col: set() for col in ORD_COLS + OHE_COLS}
+    for X in chunks():
+        if not native_categorical:
+            scaler.partial_fit(X[[col for col in X.columns if col in NUM_COLS]])
+        for col, values in categories.items():
+            values.update(X[col].unique())
+
+    categories = {col: sorted(values) for col, values in categories.items()}
+    preprocessor = build_preprocessor(
+        X.columns.tolist(), categories, native_categorical
+    )
+    # the encoders only use the given categories, the scaler fitted on the last
+    # chunk is replaced by the scaler fitted on all chunks
+    preprocessor.fit(X)
+    if not native_categorical:
+        name, _, num_indices = preprocessor.transformers_[0]
+        preprocessor.transformers_[0] = (name, scaler, num_indices)
+    return preprocessor
+
+
+class DataFrameIter(DataIter):
+    """XGBoost data iterator over preprocessed chunks of a dataset."""
+
+    def __init__(
+        self,
+        chunks: Callable[[], Iterator[pd.DataFrame]],
+        preprocessor: ColumnTransformer,
+        label: str,
+        cache_prefix: str = None,
+        feature_types: list = None,
+    ):
+        self._chunks = chunks
+        self._preprocessor = preprocessor
+        self._label = label
+        self._feature_types = feature_types
+        self._iterator = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data: Callable) -> int:
+        if self._iterator is None:
+            self._iterator = self._chunks()
+        chunk = next(self._iterator, None)
+        if chunk is None:
+            return 0
+        X, y = split_xy(chunk, self._label)
+        input_data(
+            data=self._preprocessor.transform(X),
+            label=y.to_numpy(),
+            feature_types=self._feature_types,
+        )
+        return 1
+
+    def reset(self) -> None:
+        self._iterator = None
+
+
+def train_streaming(
+    train_data: str,
+    valid_data: str,
+    label: str,
+    xgb_model: XGBRegressor,
+    chunk_size: int,
+    timer: IterationTimer = None,
+) -> Pipeline:
+    """Train the model without loading the data into memory. The preprocessing
+    steps are fitted and applied chunk by chunk, and the preprocessed chunks are
+    fed to XGBoost through a data iterator (`QuantileDMatrix`, or an external memory
+    `DMatrix` for XGBoost < 1.7).
+    Args:
+        train_data (str): path to the training data
+        valid_data (str): path to the validation data
+        label (str): name of the label column
+        xgb_model (XGBRegressor): model whose parameters are used for training
+        chunk_size (int): maximum number of rows per chunk
+        timer (IterationTimer): callback timing the boosting rounds, a new one if
+            None
+    Returns:
+        pipeline (Pipeline): fitted sklearn pipeline of preprocessor and model
+    """
+
+    if DataIter is object:
+        raise RuntimeError("Streaming requires xgboost>=1.5")
+
+    def features(path: str) -> Callable[[], Iterator[pd.DataFrame]]:
+        return lambda: (c.drop(columns=[label]) for c in chunks(path)())
+
+    def chunks(path: str) -> Callable[[], Iterator[pd.DataFrame]]:
+        return lambda: iter_chunks(path, label, chunk_size)
+
+    native_categorical = is_native_categorical(xgb_model)
+    logging.info("Fit preprocessing steps on chunks of training data")
+    preprocessor = fit_preprocessor_streaming(features(train_data), native_categorical)
+    feature_types = None
+    if native_categorical:
+        feature_types = set_feature_types(xgb_model, preprocessor)
+
+    params = xgb_model.get_xgb_params()
+    if params.get("tree_method") is None:
+        params["tree_method"] = "hist"
+
+    def data_iter(path: str, cache_prefix: str = None) -> DataFrameIter:
+        return DataFrameIter(
+            chunks(path), preprocessor, label, cache_prefix, feature_types
+        )
+
+    dmatrix_args = {"enable_categorical": True} if native_categorical else {}
+    if hasattr(xgb, "QuantileDMatrix"):
+        logging.info("Build quantile DMatrix from chunks of data")
+        if params.get("max_bin"):
+            dmatrix_args["max_bin"] = params["max_bin"]
+        dtrain = xgb.QuantileDMatrix(data_iter(train_data), **dmatrix_args)
+        dvalid = xgb.QuantileDMatrix(data_iter(valid_data), ref=dtrain, **dmatrix_args)
+    else:
+        cache_dir = tempfile.mkdtemp()
+        logging.info(f"Build external memory DMatrix from chunks of data: {cache_dir}")
+        train_iter = data_iter(train_data, os.path.join(cache_dir, "train"))
+        valid_iter = data_iter(valid_data, os.path.join(cache_dir, "valid"))
+        dtrain = xgb.DMatrix(train_iter, **dmatrix_args)
+        dvalid = xgb.DMatrix(valid_iter, **dmatrix_args)
+
+    logging.info("Fit model")
+    timer = timer or IterationTimer()
+    timer.num_examples = dtrain.num_row()
+    booster = xgb.train(
+        params,
+        dtrain,
+        num_boost_round=xgb_model.get_num_boosting_rounds(),
+        evals=[(dvalid, "validation_0")],
+        early_stopping_rounds=xgb_model.early_stopping_rounds,
+        callbacks=[timer],
+    )
+    # attach the booster to the sklearn model so that the pipeline can be served
+    # by the sklearn prediction container
+    xgb_model._Booster = booster
+
+    return Pipeline(
+        steps=[("feature_engineering", preprocessor), ("train_model", xgb_model)]
+    )
+
+
+def transform(preprocessor: ColumnTransformer, X: pd.DataFrame):
+    """Transform features into a compact float32 (dense or sparse) matrix."""
+    return preprocessor.transform(X).astype(np.float32)
+
+
+def preprocess_in_memory(
+    X_train: pd.DataFrame, X_valid: pd.DataFrame, xgb_model: XGBRegressor
+) -> (ColumnTransformer, np.ndarray, np.ndarray):
+    """Fit the preprocessing steps once on the training data and transform the
+    training and validation data.
+    Args:
+        X_train (pd.DataFrame): training features
+        X_valid (pd.DataFrame): validation features
+        xgb_model (XGBRegressor): model to train, its feature types are set for
+            native categorical support
+    Returns:
+        preprocessor, X_train_transformed, X_valid_transformed: fitted
+            preprocessing steps and transformed float32 (dense or sparse) matrices
+    """
+    logging.info("Get the categories of categorical columns")
+    categories = {col: sorted(X_train[col].unique()) for col in ORD_COLS + OHE_COLS}
+    native_categorical = is_native_categorical(xgb_model)
+    preprocessor = build_preprocessor(
+        X_train.columns.tolist(), categories, native_categorical
+    )
+    if native_categorical:
+        set_feature_types(xgb_model, preprocessor)
+
+    logging.info("Fit preprocessing steps and transform training data")
+    X_train_transformed = preprocessor.fit_transform(X_train).astype(np.float32)
+
+    logging.info("Transform validation data")
+    X_valid_transformed = transform(preprocessor, X_valid)
+    return preprocessor, X_train_transformed, X_valid_transformed
+
+
+def fit_model(
+    xgb_model: XGBRegressor,
+    X_train,
+    y_train,
+    X_valid,
+    y_valid,
+    timer: IterationTimer = None,
+) -> None:
+    """Fit the model on preprocessed data and log the wall time of each boosting
+    round (with `timer`, or a new `IterationTimer` if None)."""
+    logging.info("Fit model")
+    if TrainingCallback is object:
+        logging.warning("Timing boosting rounds requires xgboost>=1.3")
+        xgb_model.fit(X_train, y_train, eval_set=[(X_valid, y_valid)])
+        return
+    timer = timer or IterationTimer()
+    timer.num_examples = X_train.shape[0]
+    # the callback is removed after training so that it is not pickled with the model
+    # (callbacks are passed to fit for XGBoost < 1.6)
+    fit_args = {}
+    if "callbacks" in xgb_model.get_params():
+        xgb_model.set_params(callbacks=[timer])
+    else:
+        fit_args["callbacks"] = [timer]
+    xgb_model.fit(X_train, y_train, eval_set=[(X_valid, y_valid)], **fit_args)
+    if not fit_args:
+        xgb_model.set_params(callbacks=None)
+
+
+def train_in_memory(
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_valid: pd.DataFrame,
+    y_valid: pd.Series,
+    xgb_model: XGBRegressor,
+    timer: IterationTimer = None,
+) -> Pipeline:
+    """Train the model on dataframes. The preprocessing steps are fitted once and
+    the transformed train and validation matrices are fed straight to XGBoost.
+    Args:
+        X_train, y_train (pd.DataFrame, pd.Series): training features and labels
+        X_valid, y_valid (pd.DataFrame, pd.Series): validation features and labels
+        xgb_model (XGBRegressor): model to train
+        timer (IterationTimer): callback timing the boosting rounds, a new one if
+            None
+    Returns:
+        pipeline (Pipeline): fitted sklearn pipeline of preprocessor and model
+    """
+    preprocessor, X_train_transformed, X_valid_transformed = preprocess_in_memory(
+        X_train, X_valid, xgb_model
+    )
+    fit_model(
+        xgb_model, X_train_transformed, y_train, X_valid_transformed, y_valid, timer
+    )
+
+    # both steps are already fitted, the pipeline is only used for serving
+    return Pipeline(
+        steps=[("feature_engineering", preprocessor), ("train_model", xgb_model)]
+    )
+
+
+def is_search_range(value) -> bool:
+    """Check whether a hyperparameter value is a search range, i.e. a list of
+    choices or a dict with `min` and `max` (and optionally `log`)."""
+    return isinstance(value, list) or (
+        isinstance(value, dict) and {"min", "max"} <= value.keys()
+    )
+
+
+def sample_candidates(space: dict, budget: int, seed: int = 0) -> list:
+    """Sample candidate hyperparameters at random from a search space.
+    Args:
+        space (dict): search range of each hyperparameter, either a list of
+            choices or a dict with `min`, `max` and optionally `log` (sample on a
+            log scale). Integers are sampled if both `min` and `max` are integers.
+        budget (int): number of candidates
+        seed (int): random seed
+    Returns:
+        candidates (list): hyperparameters of each candidate
+    """
+    rng = np.random.default_rng(seed)
+    candidates = []
+    for _ in range(budget):
+        params = {}
+        for name, values in space.items():
+            if isinstance(values, list):
+                params[name] = values[rng.integers(len(values))]
+                continue
+            low, high = values["min"], values["max"]
+            if values.get("log"):
+                value = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                value = float(rng.uniform(low, high))
+            if isinstance(low, int) and isinstance(high, int):
+                value = min(int(round(value)), high)
+            params[name] = value
+        candidates.append(params)
+    return candidates
+
+
+# preprocessed training and validation data of the hyperparameter search workers
+_search_data = None
+
+
+def _init_search_worker(data: tuple) -> None:
+    global _search_data
+    _search_data = data
+
+
+def evaluate_candidate(params: dict) -> (float, int):
+    """Train a candidate on the data of the search worker.
+    Args:
+        params (dict): parameters of the model
+    Returns:
+        score, best_iteration (float, int): best validation score (lower is better)
+            and the number of boosting rounds at which it was reached
+    """
+    X_train, y_train, X_valid, y_valid = _search_data
+    model = XGBRegressor(**params)
+    model.fit(X_train, y_train, eval_set=[(X_valid, y_valid)], verbose=False)
+    scores = next(iter(model.evals_result()["validation_0"].values()))
+    best_iteration = int(np.argmin(scores))
+    return float(scores[best_iteration]), best_iteration + 1
+
+
+def search_in_memory(
+    X_train: pd.DataFrame,
+    y_train: pd.Series,
+    X_valid: pd.DataFrame,
+    y_valid: pd.Series,
+    xgb_model: XGBRegressor,
+    space: dict,
+    budget: int,
+    n_workers: int = None,
+    reduction_factor: int = 3,
+    seed: int = 0,
+) -> (Pipeline, pd.DataFrame):
+    """Search hyperparameters with successive halving and train the best model.
+    The data is preprocessed once and handed to a pool of worker processes which
+    train the candidates concurrently. Each rung trains the remaining candidates
+    for `reduction_factor` times more boosting rounds than the previous rung (up
+    to `n_estimators` in the last rung) and keeps the best `1 / reduction_factor`
+    of them.
+    Args:
+        X_train, y_train (pd.DataFrame, pd.Series): training features and labels
+        X_valid, y_valid (pd.DataFrame, pd.Series): validation features and labels
+        xgb_model (XGBRegressor): model whose parameters are used for all candidates
+        space (dict): search range of each hyperparameter, see `sample_candidates`
+        budget (int): number of candidates
+        n_workers (int): number of worker processes, defaults to one per candidate
+            up to the number of threads of the model
+        reduction_factor (int): factor by which the candidates are reduced per rung
+        seed (int): random seed of the candidates
+    Returns:
+        pipeline, trials (Pipeline, pd.DataFrame): fitted sklearn pipeline of the
+            best candidate and the candidates ranked from best to worst
+    """
+    preprocessor, X_train_transformed, X_valid_transformed = preprocess_in_memory(
+        X_train, X_valid, xgb_model
+    )
+    candidates = sample_candidates(space, budget, seed)
+    n_threads = xgb_model.get_params()["n_jobs"] or available_cpus()
+    n_workers = n_workers or max(1, min(budget, n_threads))
+    base_params = {
+        **xgb_model.get_params(),
+        "n_jobs": max(1, n_threads // n_workers),
+        "callbacks": None,
+    }
+    max_rounds = xgb_model.get_num_boosting_rounds()
+    # the last rung keeps more than one candidate, the best one is refitted anyway
+    n_rungs = 1
+    while budget // reduction_factor**n_rungs > 1:
+        n_rungs += 1
+    trials = [{"trial": i, **params} for i, params in enumerate(candidates)]
+
+    logging.info(
+        f"Search {budget} candidates in {n_rungs} rungs with {n_workers} workers"
+    )
+    data = (X_train_transformed, y_train, X_valid_transformed, y_valid)
+    survivors = list(range(budget))
+    with ProcessPoolExecutor(
+        max_workers=n_workers, initializer=_init_search_worker, initargs=(data,)
+    ) as pool:
+        for rung in range(n_rungs):
+            n_rounds = max(1, max_rounds // reduction_factor ** (n_rungs - rung - 1))
+            params = [
+                {**base_params, **candidates[i], "n_estimators": n_rounds}
+                for i in survivors
+            ]
+            for i, (score, best_iteration) in zip(
+                survivors, pool.map(evaluate_candidate, params)
+            ):
+                trials[i].update(
+                    rung=rung,
+                    n_rounds=n_rounds,
+                    score=score,
+                    best_iteration=best_iteration,
+                )
+            survivors.sort(key=lambda i: trials[i]["score"])
+            logging.info(
+                f"Rung {rung}: best score {trials[survivors[0]]['score']:.4f} "
+                f"of {len(survivors)} candidates trained for {n_rounds} rounds"
+            )
+            survivors = survivors[: max(1, len(survivors) // reduction_factor)]
+
+    trials = pd.DataFrame(trials).sort_values(
+        ["rung", "score"], ascending=[False, True], ignore_index=True
+    )
+    best_params = candidates[trials["trial"][0]]
+    logging.info(f"Train best candidate: {best_params}")
+    xgb_model.set_params(**best_params)
+    fit_model(xgb_model, X_train_transformed, y_train, X_valid_transformed, y_valid)
+
+    pipeline = Pipeline(
+        steps=[("feature_engineering", preprocessor), ("train_model", xgb_model)]
+    )
+    return pipeline, trials
+
+
+class RegressionMetrics:
+    """Accumulator of regression metrics over chunks of labels and predictions.
+    Each chunk is reduced in a single vectorized pass to a handful of sums, so the
+    memory use does not depend on the size of the test set. Kept in sync with the
+    other training scripts, which are uploaded to Vertex AI as single files.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum_squared_error = 0.0
+        self.sum_absolute_error = 0.0
+        self.sum_absolute_percentage_error = 0.0
+        self.sum_squared_log_error = 0.0
+        # running mean and sum of squared deviations of the labels for R squared
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, y_true, y_pred) -> None:
+        """Add a chunk of labels and predictions (negative predictions are
+        clipped to zero for the squared log error)."""
+        y_true = np.asarray(y_true, dtype=np.float64).ravel()
+        y_pred = np.asarray(y_pred, dtype=np.float64).ravel()
+        if not len(y_true):
+            return
+        error = y_pred - y_true
+        abs_error = np.abs(error)
+        log_error = np.log1p(np.clip(y_pred, 0, None)) - np.log1p(y_true)
+        self.sum_squared_error += error @ error
+        self.sum_absolute_error += abs_error.sum()
+        self.sum_absolute_percentage_error += (
+            abs_error / np.maximum(np.abs(y_true), np.finfo(np.float64).eps)
+        ).sum()
+        self.sum_squared_log_error += log_error @ log_error
+
+        # merge mean and sum of squared deviations of chunk (Chan et al.)
+        count = len(y_true)
+        mean = y_true.mean()
+        deviation = y_true - mean
+        delta = mean - self.mean
+        total = self.count + count
+        self.m2 += deviation @ deviation + delta**2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+
+    def result(self) -> dict:
+        """Metrics in the schema of Vertex AI regression model evaluations."""
+        n = max(self.count, 1)
+        return {
+            "problemType": "regression",
+            "rootMeanSquaredError": float(np.sqrt(self.sum_squared_error / n)),
+            "meanAbsoluteError": float(self.sum_absolute_error / n),
+            "meanAbsolutePercentageError": float(
+                self.sum_absolute_percentage_error / n
+            ),
+            "rSquared": (
+                float(1 - self.sum_squared_error / self.m2) if self.m2 else None
+            ),
+            "rootMeanSquaredLogError": float(np.sqrt(self.sum_squared_log_error / n)),
+        }
+
+
+def predict_chunks(
+    pipeline: Pipeline, path: str, label: str, chunk_size: int
+) -> Iterator[tuple]:
+    """Predict the data in chunks.
+    Args:
+        pipeline (Pipeline): fitted sklearn pipeline
+        path (str): path to the data
+        label (str): name of the label column
+        chunk_size (int): maximum number of rows per chunk
+    Returns:
+        chunks (Iterator[tuple]): labels and predictions (np.ndarray) of each chunk
+    """
+    for chunk in iter_chunks(path, label, chunk_size):
+        X, y = split_xy(chunk, label)
+        yield y.to_numpy(), pipeline.predict(X)
+
+
+def save_pipeline(
+    pipeline: Pipeline, model_dir: Path, model_format: str = "joblib", compress: int = 0
+) -> None:
+    """Save the pipeline to a model directory.
+    Args:
+        pipeline (Pipeline): fitted sklearn pipeline of preprocessor and model
+        model_dir (Path): existing model directory
+        model_format (str): "joblib" to pickle the whole pipeline (default, can be
+            served by the sklearn prediction container), "ubj" or "json" to save the
+            booster in a native XGBoost format next to the pickled preprocessing
+            steps (load with `load_pipeline`)
+        compress (int): compression level (0-9) of the joblib files and of the
+            gzip compressed booster, 0 for no compression
+    """
+    if model_format not in MODEL_FORMATS:
+        raise ValueError(f"Model format {model_format} not in {MODEL_FORMATS}")
+    if model_format == "joblib":
+        joblib.dump(pipeline, str(model_dir / MODEL_FILE), compress=compress)
+        return
+
+    joblib.dump(
+        pipeline["feature_engineering"],
+        str(model_dir / PREPROCESSOR_FILE),
+        compress=compress,
+    )
+    booster_path = model_dir / f"model.{model_format}"
+    pipeline["train_model"].save_model(str(booster_path))
+    if compress:
+        with open(booster_path, "rb") as src, gzip.open(
+            f"{booster_path}.gz", "wb", compresslevel=int(compress)
+        ) as dst:
+            shutil.copyfileobj(src, dst)
+        booster_path.unlink()
+
+
+def load_pipeline(model_dir: Path) -> Pipeline:
+    """Load a pipeline saved by `save_pipeline` in any format.
+    Args:
+        model_dir (Path): model directory
+    Returns:
+        pipeline (Pipeline): fitted sklearn pipeline of preprocessor and model
+    """
+    if (model_dir / MODEL_FILE).exists():
+        return joblib.load(str(model_dir / MODEL_FILE))
+
+    preprocessor = joblib.load(str(model_dir / PREPROCESSOR_FILE))
+    xgb_model = XGBRegressor()
+    for model_format in MODEL_FORMATS[1:]:
+        path = model_dir / f"model.{model_format}"
+        if path.exists():
+            xgb_model.load_model(str(path))
+            break
+        if Path(f"{path}.gz").exists():
+            with gzip.open(f"{path}.gz", "rb") as fp:
+                xgb_model.load_model(bytearray(fp.read()))
+            break
+    else:
+        raise FileNotFoundError(f"No model found in {model_dir}")
+    return Pipeline(
+        steps=[("feature_engineering", preprocessor), ("train_model", xgb_model)]
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--train_data", type=str, required=True)
+    parser.add_argument("--valid_data", type=str, required=True)
+    parser.add_argument("--test_data", type=str, required=True)
+    parser.add_argument(
+        "--model", default=os.getenv("AIP_MODEL_DIR"), type=str, help=""
+    )
+    parser.add_argument("--metrics", type=str, required=True)
+    parser.add_argument("--hparams", default={}, type=json.loads)
+    args = parser.parse_args()
+
+    if args.model.startswith("gs://"):
+        args.model = "/gcs/" + args.model[5:]
+    args.model = Path(args.model)
+
+    hparams = dict(args.hparams)
+    label = hparams.pop("label")
+    streaming = hparams.pop("streaming", False)
+    chunk_size = hparams.pop("chunk_size", DEFAULT_CHUNK_SIZE)
+    model_format = hparams.pop("model_format", "joblib")
+    model_compress = hparams.pop("model_compress", 0)
+    # the model saved to AIP_MODEL_DIR is uploaded with the sklearn prediction
+    # container, which only serves the joblib format
+    if model_format != "joblib" and os.getenv("AIP_MODEL_DIR"):
+        raise ValueError(
+            f"The sklearn prediction container cannot serve {model_format} models, "
+            "use the joblib model format to train a model which is uploaded"
+        )
+    throughput_monitor = hparams.pop("throughput_monitor", False)
+    search_budget = hparams.pop("search_budget", None)
+    search_workers = hparams.pop("search_workers", None)
+    search_space = {}
+    if search_budget:
+        search_space = {k: v for k, v in hparams.items() if is_search_range(v)}
+        for name in search_space:
+            hparams.pop(name)
+        if streaming:
+            raise ValueError("Hyperparameter search is not supported in streaming mode")
+    hparams.setdefault("tree_method", "hist")
+    if hparams.get("n_jobs") is None:
+        hparams["n_jobs"] = available_cpus()
+    logging.info(
+        f"Train with tree method {hparams['tree_method']} "
+        f"and {hparams['n_jobs']} threads"
+    )
+
+    logging.info("Build sklearn pipeline with XGBoost model")
+    xgb_model = XGBRegressor(**hparams)
+    # fail before the data is read if native categorical support is unavailable
+    is_native_categorical(xgb_model)
+
+    trials = None
+    test_metrics = RegressionMetrics()
+    # the throughput is only recorded on request, and not for the hyperparameter
+    # search, whose candidates are trained by other processes
+    timer = None
+    if throughput_monitor and not search_budget:
+        timer = IterationTimer(monitor=True)
+    start = time.perf_counter()
+    if streaming:
+        logging.info("Train model on chunks of data (streaming mode)")
+        pipeline = train_streaming(
+            args.train_data, args.valid_data, label, xgb_model, chunk_size, timer
+        )
+        training_seconds = time.perf_counter() - start
+
+        logging.info("Predict test data in chunks")
+        for y_test, y_pred in predict_chunks(
+            pipeline, args.test_data, label, chunk_size
+        ):
+            test_metrics.update(y_test, y_pred.clip(0))
+    else:
+        logging.info("Read train and validation data into dataframes")
+        X_train, y_train = split_xy(read_data(args.train_data, label), label)
+        X_valid, y_valid = split_xy(read_data(args.valid_data, label), label)
+
+        if search_budget:
+            logging.info(f"Search hyperparameters {list(search_space)}")
+            pipeline, trials = search_in_memory(
+                X_train,
+                y_train,
+                X_valid,
+                y_valid,
+                xgb_model,
+                search_space,
+                search_budget,
+                search_workers,
+            )
+        else:
+            pipeline = train_in_memory(
+                X_train, y_train, X_valid, y_valid, xgb_model, timer
+            )
+        training_seconds = time.perf_counter() - start
+
+        # free training data before the test data is loaded
+        del X_train, y_train, X_valid, y_valid
+
+        logging.info("Read test data into dataframe")
+        X_test, y_test = split_xy(read_data(args.test_data, label), label)
+
+        logging.info("Predict test data in chunks")
+        for start in range(0, len(X_test), chunk_size):
+            rows = slice(start, start + chunk_size)
+            X = transform(pipeline["feature_engineering"], X_test.iloc[rows])
+            test_metrics.update(y_test.iloc[rows], xgb_model.predict(X).clip(0))
+
+    eval_metrics = test_metrics.result()
+
+    logging.info(f"Save model to: {args.model}")
+    args.model.mkdir(parents=True)
+    start = time.perf_counter()
+    save_pipeline(pipeline, args.model, model_format, model_compress)
+    logging.info(f"Saved {model_format} model in {time.perf_counter() - start:.2f}s")
+    if trials is not None:
+        logging.info(f"Trials:\n{trials.to_string()}")
+        trials.to_csv(args.model / TRIALS_TABLE, index=False)
+
+    logging.info(f"Metrics: {eval_metrics}")
+    with open(args.metrics, "w") as fp:
+        json.dump(eval_metrics, fp)
+
+    if timer:
+        path = os.path.join(os.path.dirname(args.metrics), THROUGHPUT_FILE)
+        logging.info(f"Save training throughput to: {path}")
+        with open(path, "w") as fp:
+            json.dump(timer.result(training_seconds), fp)
+
+    # Persist URIs of training file(s) for model monitoring in batch predictions
+    # See https://cloud.google.com/python/docs/reference/aiplatform/latest/google.cloud.aiplatform_v1beta1.types.ModelMonitoringObjectiveConfig.TrainingDataset  # noqa: E501
+    # for the expected schema.
+    if detect_format(list_files(args.train_data)[0]) != "csv":
+        logging.warning("Model monitoring requires training data in CSV format")
+    path = args.model / TRAINING_DATASET_INFO
+    training_dataset_for_monitoring = {
+        "gcsSource": {"uris": [args.train_data]},
+        "dataFormat": "csv",
+        "targetField": label,
+    }
+    logging.info(f"Training dataset info: {training_dataset_for_monitoring}")
+
+    with open(path, "w") as fp:
+        logging.info(f"Save training dataset info for model monitoring: {path}")
+        json.dump(training_dataset_for_monitoring, fp)
 
-logging.info(f"Save model to: {args.model}")
-args.model.mkdir(parents=True)
-joblib.dump(pipeline, str(args.model / "model.joblib"))
-
-logging.info(f"Metrics: {metrics}")
-with open(args.metrics, "w") as fp:
-    json.dump(metrics, fp)
-
-# Persist URIs of training file(s) for model monitoring in batch predictions
-# See https://cloud.google.com/python/docs/reference/aiplatform/latest/google.cloud.aiplatform_v1beta1.types.ModelMonitoringObjectiveConfig.TrainingDataset  # noqa: E501
-# for the expected schema.
-path = args.model / TRAINING_DATASET_INFO
-training_dataset_for_monitoring = {
-    "gcsSource": {"uris": [args.train_data]},
-    "dataFormat": "csv",
-    "targetField": label,
-}
-logging.info(f"Training dataset info: {training_dataset_for_monitoring}")
 
-with open(path, "w") as fp:
-    logging.info(f"Save training dataset info for model monitoring: {path}")
-    json.dump(training_dataset_for_monitoring, fp)
+if __name__ == "__main__":
+    main()
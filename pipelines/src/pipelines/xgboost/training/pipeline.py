@@ -78,6 +78,15 @@ def xgboost_pipeline(
     valid_table = "valid_data" + table_suffix
     test_table = "test_data" + table_suffix
     primary_metric = "rootMeanSquaredError"
+    # the ingestion queries are rendered when the pipeline is compiled, so the
+    # partitioning of the ingested data table is set here rather than by pipeline
+    # parameters. Set `partition_column` (e.g. "trip_date") to partition it by day,
+    # and `ingestion_write_disposition` to "WRITE_APPEND" to ingest it
+    # incrementally. By default it is unpartitioned and rebuilt on each run
+    partition_column = None
+    ingestion_write_disposition = "WRITE_TRUNCATE"
+    if ingestion_write_disposition == "WRITE_APPEND" and not partition_column:
+        raise ValueError("Incremental ingestion requires a partition_column")
     train_script_uri = f"{pipeline_files_gcs_path}/training/assets/train_xgb_model.py"
     hparams = dict(
         n_estimators=200,
@@ -87,6 +96,9 @@ def xgboost_pipeline(
         learning_rate=0.3,
         min_split_loss=0,
         max_depth=6,
+        # n_jobs defaults to the number of CPUs available to the training container
+        tree_method="hist",
+        max_bin=256,
         label=label_column_name,
     )
 
@@ -102,33 +114,30 @@ def xgboost_pipeline(
         filter_column=time_column,
         target_column=label_column_name,
         filter_start_value=timestamp,
+        destination_dataset=dataset_id,
+        destination_table=ingested_table,
+        partition_column=partition_column,
+        write_disposition=ingestion_write_disposition,
     )
-    split_train_query = generate_query(
-        queries_folder / "sample.sql",
-        source_dataset=dataset_id,
-        source_table=ingested_table,
-        num_lots=10,
-        lots=tuple(range(8)),
-    )
-    split_valid_query = generate_query(
-        queries_folder / "sample.sql",
+    split_query = generate_query(
+        queries_folder / "split.sql",
         source_dataset=dataset_id,
         source_table=ingested_table,
+        destination_dataset=dataset_id,
+        filter_start_value=timestamp,
+        partition_column=partition_column,
         num_lots=10,
-        lots="(8)",
+        splits={
+            train_table: tuple(range(8)),
+            valid_table: "(8)",
+            test_table: "(9)",
+        },
     )
     data_cleaning_query = generate_query(
         queries_folder / "engineer_features.sql",
         source_dataset=dataset_id,
         source_table=train_table,
     )
-    split_test_query = generate_query(
-        queries_folder / "sample.sql",
-        source_dataset=dataset_id,
-        source_table=ingested_table,
-        num_lots=10,
-        lots="(9)",
-    )
 
     # data ingestion and preprocessing operations
 
@@ -139,34 +148,45 @@ def xgboost_pipeline(
         dataset_location=dataset_location,
         query_job_config=json.dumps(dict(write_disposition="WRITE_TRUNCATE")),
     )
+    ingest_kwargs = dict(
+        kwargs,
+        query_job_config=json.dumps(
+            dict(write_disposition=ingestion_write_disposition)
+        ),
+    )
+    if partition_column:
+        # an incremental run only appends the new days, and the split only reads
+        # the partitions of the trailing window
+        ingest_kwargs.update(
+            time_partitioning=json.dumps(dict(type_="DAY", field=partition_column)),
+            clustering_fields=json.dumps(["payment_type", "company"]),
+        )
     ingest = bq_query_to_table(
-        query=ingest_query, table_id=ingested_table, **kwargs
+        query=ingest_query, table_id=ingested_table, **ingest_kwargs
     ).set_display_name("Ingest data")
 
-    split_train_data = (
-        bq_query_to_table(query=split_train_query, table_id=train_table, **kwargs)
-        .after(ingest)
-        .set_display_name("Split train data")
-    )
-    split_valid_data = (
-        bq_query_to_table(query=split_valid_query, table_id=valid_table, **kwargs)
-        .after(ingest)
-        .set_display_name("Split validation data")
-    )
-    split_test_data = (
-        bq_query_to_table(query=split_test_query, table_id=test_table, **kwargs)
+    # the script creates the three split tables from a single scan of the data
+    split_data = (
+        bq_query_to_table(
+            query=split_query,
+            bq_client_project_id=project_id,
+            destination_project_id=project_id,
+            dataset_location=dataset_location,
+        )
         .after(ingest)
-        .set_display_name("Split test data")
+        .set_display_name("Split data")
     )
     data_cleaning = (
         bq_query_to_table(
             query=data_cleaning_query, table_id=preprocessed_table, **kwargs
         )
-        .after(split_train_data)
+        .after(split_data)
         .set_display_name("Clean data")
     )
 
     # data extraction to gcs
+    # training data is exported as uncompressed CSV because it is also used as the
+    # training dataset for model monitoring in the prediction pipeline
 
     train_dataset = (
         extract_bq_to_dataset(
@@ -175,6 +195,7 @@ def xgboost_pipeline(
             dataset_id=dataset_id,
             table_name=preprocessed_table,
             dataset_location=dataset_location,
+            sharded=True,
         )
         .after(data_cleaning)
         .set_display_name("Extract train data to storage")
@@ -186,8 +207,11 @@ def xgboost_pipeline(
             dataset_id=dataset_id,
             table_name=valid_table,
             dataset_location=dataset_location,
+            sharded=True,
+            destination_format="PARQUET",
+            compression="SNAPPY",
         )
-        .after(split_valid_data)
+        .after(split_data)
         .set_display_name("Extract validation data to storage")
     ).outputs["dataset"]
     test_dataset = (
@@ -198,8 +222,10 @@ def xgboost_pipeline(
             table_name=test_table,
             dataset_location=dataset_location,
             destination_gcs_uri=test_dataset_uri,
+            destination_format="PARQUET",
+            compression="SNAPPY",
         )
-        .after(split_test_data)
+        .after(split_data)
         .set_display_name("Extract test data to storage")
         .set_caching_options(False)
     ).outputs["dataset"]
@@ -227,7 +253,12 @@ def xgboost_pipeline(
         train_container_uri="europe-docker.pkg.dev/vertex-ai/training/scikit-learn-cpu.0-23:latest",  # noqa: E501
         serving_container_uri="europe-docker.pkg.dev/vertex-ai/prediction/sklearn-cpu.0-24:latest",  # noqa: E501
         hparams=hparams,
-        requirements=["scikit-learn==0.24.0"],
+        requirements=[
+            "scikit-learn==0.24.0",
+            "pyarrow==12.0.1",
+            "fastavro==1.7.4",
+            "cramjam==2.6.2",
+        ],
         staging_bucket=staging_bucket,
         parent_model=existing_model,
     ).set_display_name("Train model")
@@ -0,0 +1,211 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the TensorFlow training script on synthetic Chicago taxi trips data,
+or on a sample of the training data (`--data`).
+
+Run from the pipelines directory (with TF_USE_LEGACY_KERAS=1 on TF >= 2.16):
+
+    PYTHONPATH=src python -m tests.tensorflow.training.benchmark_train_tf_model \
+        training_modes --rows 100000
+
+The `training_modes` benchmark trains a model with mixed precision and XLA each on
+and off, to find the fastest training mode that does not degrade the model. The
+`serving` benchmark measures the predictions/sec of the Keras SavedModel and of
+the SavedModel optimized for serving, on a batch of `batch_size` rows.
+"""
+
+import argparse
+import json
+import logging
+import tempfile
+import time
+from pathlib import Path
+
+import tensorflow as tf
+from tensorflow.data import Dataset
+from tensorflow.keras import Model
+
+from pipelines.tensorflow.training.assets import train_tf_model
+from tests.tensorflow.training.test_train_tf_model import make_taxi_data
+
+# mixed precision policy benchmarked if none is set, supported by recent CPUs
+BENCHMARK_MIXED_PRECISION = "mixed_bfloat16"
+
+
+class StepTimer(tf.keras.callbacks.Callback):
+    """Keras callback recording the wall time at the end of each training step."""
+
+    def __init__(self):
+        super().__init__()
+        self.times = []
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.times.append(time.perf_counter())
+
+    def steps_per_second(self) -> float:
+        """Training steps per second, excluding the first step (which includes the
+        tracing and compilation of the training step)."""
+        if len(self.times) < 2:
+            return 0.0
+        return (len(self.times) - 1) / max(self.times[-1] - self.times[0], 1e-9)
+
+
+def benchmark_training_modes(
+    train_ds: Dataset, valid_ds: Dataset, feature_stats: dict, model_params: dict
+) -> dict:
+    """Train a model with mixed precision and XLA each on and off to find the
+    fastest training mode that does not degrade the model.
+    Args:
+        train_ds (Dataset): train dataset
+        valid_ds (Dataset): validation dataset, used to compute the RMSE
+        feature_stats (dict): statistics of the training data
+        model_params (dict): model parameters, the mixed precision policy is
+            `mixed_precision` or BENCHMARK_MIXED_PRECISION if not set
+    Returns:
+        results (dict): training steps per second and validation RMSE by mode
+    """
+    policy = model_params.get("mixed_precision") or BENCHMARK_MIXED_PRECISION
+    results = {}
+    for mixed_precision in (None, policy):
+        for jit_compile in (False, True):
+            mode = (mixed_precision or "float32") + ("+xla" if jit_compile else "")
+            tf_model = train_tf_model.build_and_compile_model(
+                feature_stats,
+                {
+                    **model_params,
+                    "mixed_precision": mixed_precision,
+                    "jit_compile": jit_compile,
+                },
+            )
+            timer = StepTimer()
+            tf_model.fit(
+                train_ds,
+                epochs=model_params["epochs"],
+                steps_per_epoch=model_params.get("steps_per_epoch"),
+                callbacks=[timer],
+                verbose=0,
+            )
+            valid_metrics = train_tf_model.evaluate_model(tf_model, valid_ds)
+            results[mode] = {
+                "stepsPerSecond": timer.steps_per_second(),
+                "rootMeanSquaredError": valid_metrics["rootMeanSquaredError"],
+            }
+            logging.info(f"{mode}: {results[mode]}")
+    return results
+
+
+def benchmark_serving(
+    tf_model: Model, feature_stats: dict, features: dict, num_runs: int = 20
+) -> dict:
+    """Measure the predictions per second of the default signature of the Keras
+    SavedModel and of the signatures of the optimized SavedModel, once loaded.
+    Args:
+        tf_model (Model): trained model
+        feature_stats (dict): statistics of the training data
+        features (dict): batch of features to predict
+        num_runs (int): number of predictions of the batch
+    Returns:
+        predictions_per_second (dict): predictions per second by signature
+    """
+    columns = {name: values.numpy() for name, values in features.items()}
+    examples = [
+        train_tf_model.to_example(dict(zip(columns, row))).SerializeToString()
+        for row in zip(*columns.values())
+    ]
+    batch_size = len(examples)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tf_model.save(f"{tmp_dir}/keras", save_format="tf", include_optimizer=False)
+        train_tf_model.export_serving_model(
+            tf_model, feature_stats, f"{tmp_dir}/optimized"
+        )
+        keras_model = tf.saved_model.load(f"{tmp_dir}/keras")
+        optimized_model = tf.saved_model.load(f"{tmp_dir}/optimized")
+        signatures = {
+            "keras": (keras_model.signatures["serving_default"], features),
+            "optimized": (optimized_model.signatures["serving_default"], features),
+            "optimizedExamples": (
+                optimized_model.signatures["serving_examples"],
+                {"examples": tf.constant(examples)},
+            ),
+        }
+        for name, (signature, inputs) in signatures.items():
+            signature(**inputs)  # the first call includes the loading of the graph
+            start = time.perf_counter()
+            for _ in range(num_runs):
+                signature(**inputs)
+            results[name] = batch_size * num_runs / (time.perf_counter() - start)
+            logging.info(f"Serving {name}: {results[name]:.0f} predictions/sec")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("benchmark", choices=["training_modes", "serving"])
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument(
+        "--data",
+        type=str,
+        help="Training data (CSV file or directory) to benchmark on, instead of "
+        "synthetic data.",
+    )
+    parser.add_argument("--hparams", default={}, type=json.loads)
+    args = parser.parse_args()
+
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "feature_stats_cache": False,
+        **args.hparams,
+    }
+    label = model_params["label"]
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        data = Path(args.data or f"{data_dir}/data.csv")
+        if not args.data:
+            make_taxi_data(args.rows).to_csv(data, index=False)
+        feature_stats = train_tf_model.get_feature_stats(data, label, model_params)
+        # the same data is used for validation: only the relative RMSE matters
+        train_ds = train_tf_model.create_dataset(data, label, model_params)
+        valid_ds = train_tf_model.create_dataset(data, label, model_params)
+        if args.benchmark == "training_modes":
+            results = benchmark_training_modes(
+                train_ds, valid_ds, feature_stats, model_params
+            )
+        else:
+            tf_model = train_tf_model.build_and_compile_model(
+                feature_stats, model_params
+            )
+            tf_model.fit(train_ds, epochs=model_params["epochs"], verbose=0)
+            features, _ = next(iter(valid_ds))
+            results = benchmark_serving(tf_model, feature_stats, features)
+
+    print(f"{args.benchmark}, {data}")
+    if args.benchmark == "training_modes":
+        print(f"{'mode':<40} {'steps/sec':>10} {'RMSE':>8}")
+        for mode, result in results.items():
+            print(
+                f"{mode:<40} {result['stepsPerSecond']:>10.1f} "
+                f"{result['rootMeanSquaredError']:>8.3f}"
+            )
+    else:
+        print(f"{'signature':<40} {'predictions/sec':>16}")
+        for name, predictions_per_second in results.items():
+            print(f"{name:<40} {predictions_per_second:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
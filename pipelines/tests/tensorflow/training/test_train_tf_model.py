@@ -0,0 +1,941 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from unittest import mock
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+tf = pytest.importorskip("tensorflow")
+
+from pipelines.tensorflow.training.assets import train_tf_model  # noqa: E402
+
+LABEL = "total_fare"
+
+# the model is built with the Keras 2 API of the training container (TF 2.6), run
+# with TF_USE_LEGACY_KERAS=1 on later TF versions
+requires_keras_2 = pytest.mark.skipif(
+    not getattr(tf.keras, "__version__", "2.").startswith("2."),
+    reason="requires Keras 2",
+)
+
+
+def make_taxi_data(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a dataframe shaped like the Chicago taxi trips training data.
+
+    Args:
+        n_rows (int): number of rows to generate
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: generated features and label
+    """
+    rng = np.random.default_rng(seed)
+    trip_seconds = rng.integers(60, 3600, n_rows).astype(float)
+    trip_miles = trip_seconds / 200 * rng.uniform(0.5, 1.5, n_rows)
+    return pd.DataFrame(
+        {
+            "dayofweek": rng.integers(1, 8, n_rows).astype(float),
+            "hourofday": rng.integers(0, 24, n_rows).astype(float),
+            "trip_distance": trip_miles * 1600 * rng.uniform(0.6, 1.0, n_rows),
+            "trip_miles": trip_miles,
+            "trip_seconds": trip_seconds,
+            "payment_type": rng.choice(["Cash", "Credit Card", "Mobile"], n_rows),
+            "company": rng.choice([f"Company {i}" for i in range(20)], n_rows),
+            LABEL: 3.25 + 2.25 * trip_miles + rng.exponential(2, n_rows),
+        }
+    )
+
+
+def make_dataset(tmp_path, n_rows: int = 1000, **hparams):
+    """
+    Write generated data to a CSV file and create a dataset from it.
+
+    Args:
+        tmp_path: directory of the CSV file
+        n_rows (int): number of rows to generate
+        hparams: model parameters overriding the default ones
+
+    Returns:
+        tuple: generated dataframe and dataset
+    """
+    df = make_taxi_data(n_rows)
+    df.to_csv(tmp_path / "data.csv", index=False)
+    model_params = {**train_tf_model.DEFAULT_HPARAMS, **hparams}
+    dataset = train_tf_model.create_dataset(tmp_path / "data.csv", LABEL, model_params)
+    return df, dataset
+
+
+def test_compute_feature_stats(tmp_path):
+    """
+    Asserts that the statistics computed in a single pass normalize like adapted
+    Normalization layers and that vocabularies are sorted by descending frequency.
+    """
+    df, dataset = make_dataset(tmp_path, batch_size=250, epochs=1)
+
+    stats = train_tf_model.compute_feature_stats(dataset)
+
+    for name in train_tf_model.NUM_COLS:
+        layer = tf.keras.layers.Normalization(axis=None)
+        layer.adapt(dataset.map(lambda x, _: x[name]))
+        expected = layer(df[name].to_numpy()).numpy().ravel()
+        actual = train_tf_model.normalization(name, stats)(df[name].to_numpy())
+        np.testing.assert_allclose(
+            actual.numpy().ravel(), expected, rtol=1e-4, atol=1e-4
+        )
+    for name in train_tf_model.ORD_COLS + train_tf_model.OHE_COLS:
+        counts = df[name].value_counts()
+        assert set(stats[name]["vocabulary"]) == set(counts.index)
+        assert [counts[t] for t in stats[name]["vocabulary"]] == sorted(
+            counts, reverse=True
+        )
+
+
+@pytest.mark.parametrize("sharded", [False, True])
+def test_get_feature_stats_cache(tmp_path, sharded):
+    """
+    Asserts that a warm cache run reuses the cached statistics without reading the
+    data, and that the statistics are recomputed when the data changes.
+    """
+    df = make_taxi_data(1000)
+    if sharded:
+        (tmp_path / "dataset").mkdir()
+        df.iloc[:500].to_csv(tmp_path / "dataset" / "part-0.csv", index=False)
+        df.iloc[500:].to_csv(tmp_path / "dataset" / "part-1.csv", index=False)
+        input_data = tmp_path / "dataset" / "part-*.csv"
+    else:
+        input_data = tmp_path / "dataset"
+        df.to_csv(input_data, index=False)
+    model_params = {**train_tf_model.DEFAULT_HPARAMS, "feature_stats_cache": True}
+    cache_dir = str(tmp_path / "cache")
+    compute_feature_stats = train_tf_model.compute_feature_stats
+
+    with mock.patch.object(
+        train_tf_model, "compute_feature_stats", side_effect=compute_feature_stats
+    ) as spy:
+        cold = train_tf_model.get_feature_stats(
+            input_data, LABEL, model_params, cache_dir
+        )
+        assert spy.call_count == 1
+        assert sorted(p.name for p in tmp_path.iterdir()) == ["cache", "dataset"]
+        if sharded:
+            assert len(list((tmp_path / "dataset").iterdir())) == 2
+
+        with mock.patch.object(train_tf_model, "create_dataset") as create_dataset:
+            warm = train_tf_model.get_feature_stats(
+                input_data, LABEL, model_params, cache_dir
+            )
+        create_dataset.assert_not_called()
+        assert spy.call_count == 1
+        assert warm == cold
+
+        changed = train_tf_model.list_files(input_data)[0]
+        df.iloc[:100].to_csv(changed, index=False)
+        train_tf_model.get_feature_stats(input_data, LABEL, model_params, cache_dir)
+        assert spy.call_count == 2
+
+
+def test_get_feature_stats_cache_read_only(tmp_path):
+    """
+    Asserts that the statistics computed by a worker other than the chief are not
+    written to the cache, but that it reads the cache written by the chief.
+    """
+    make_taxi_data(1000).to_csv(tmp_path / "data.csv", index=False)
+    model_params = {**train_tf_model.DEFAULT_HPARAMS, "feature_stats_cache": True}
+    input_data, cache_dir = tmp_path / "data.csv", str(tmp_path / "cache")
+    path = Path(
+        train_tf_model.cache_path(
+            cache_dir, input_data, train_tf_model.FEATURE_STATS_FILE
+        )
+    )
+
+    worker = train_tf_model.get_feature_stats(
+        input_data, LABEL, model_params, cache_dir, write_cache=False
+    )
+    assert not path.exists()
+
+    chief = train_tf_model.get_feature_stats(input_data, LABEL, model_params, cache_dir)
+    assert path.exists()
+    with mock.patch.object(train_tf_model, "create_dataset") as create_dataset:
+        cached = train_tf_model.get_feature_stats(
+            input_data, LABEL, model_params, cache_dir, write_cache=False
+        )
+    create_dataset.assert_not_called()
+    assert cached == chief
+    # the rows are shuffled, so the sums of the statistics differ by rounding
+    for name in train_tf_model.NUM_COLS:
+        assert worker[name] == pytest.approx(chief[name])
+
+
+@pytest.mark.parametrize("cache", [None, "memory", "disk"])
+def test_create_dataset(tmp_path, cache):
+    """
+    Asserts that all rows of all shards are read once with the expected types,
+    whatever the number of epochs, with or without caching.
+    """
+    df = make_taxi_data(500)
+    df["unused"] = "not parsed"
+    (tmp_path / "dataset").mkdir()
+    for i in range(3):
+        shard = df.iloc[i * 167 : (i + 1) * 167]
+        shard.to_csv(tmp_path / "dataset" / f"part-{i}.csv", index=False)
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": 2,
+        "batch_size": 64,
+        "cache": str(tmp_path / "cache") if cache == "disk" else cache,
+    }
+
+    dataset = train_tf_model.create_dataset(tmp_path / "dataset", LABEL, model_params)
+    batches = list(dataset)
+
+    features, labels = batches[0]
+    assert list(features) == [c for c in df.columns if c not in (LABEL, "unused")]
+    assert features["company"].dtype == tf.string
+    assert features["trip_miles"].dtype == tf.float32
+    labels = np.concatenate([labels.numpy() for _, labels in batches])
+    np.testing.assert_allclose(np.sort(labels), np.sort(df[LABEL].to_numpy(np.float32)))
+    if cache == "disk":
+        assert list((tmp_path / "cache").iterdir())
+
+
+@pytest.mark.parametrize(
+    "num_files,num_parallel_reads,expected",
+    [(3, None, 3), (1000, None, 16), (1000, 64, 64)],
+)
+def test_parallel_reads(num_files, num_parallel_reads, expected):
+    """
+    Asserts that all files are read in parallel up to a bound, unless the number
+    of parallel reads is set.
+    """
+    files = [f"part-{i}.csv" for i in range(num_files)]
+    model_params = {"num_parallel_reads": num_parallel_reads}
+
+    assert train_tf_model.parallel_reads(files, model_params) == expected
+
+
+def test_measure_throughput(tmp_path):
+    """
+    Asserts that the throughput of the input pipeline is measured.
+    """
+    _, dataset = make_dataset(tmp_path, batch_size=10)
+
+    assert train_tf_model.measure_throughput(dataset, num_batches=5) > 0
+
+
+def test_convert_to_tfrecord(tmp_path):
+    """
+    Asserts that the datasets created from the CSV file and from the TFRecord files
+    it was converted to produce identical batches, and that outdated TFRecord
+    files are not read.
+    """
+    df = make_taxi_data(1000)
+    input_data = tmp_path / "data.csv"
+    df.to_csv(input_data, index=False)
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": 2,
+        "batch_size": 64,
+        "shuffle_buffer_size": 1,
+    }
+    cache_dir = str(tmp_path / "cache")
+    csv_batches = list(train_tf_model.create_dataset(input_data, LABEL, model_params))
+
+    tfrecord_dir = train_tf_model.convert_to_tfrecord(input_data, LABEL, 1, cache_dir)
+    files = train_tf_model.tfrecord_files(input_data, cache_dir)
+    assert [f.rsplit("/", 1)[1] for f in files] == ["part-00000-of-00001.tfrecord.gz"]
+    assert tfrecord_dir.startswith(cache_dir)
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["cache", "data.csv"]
+    tfrecord_batches = list(
+        train_tf_model.create_dataset(
+            input_data, LABEL, model_params, cache_dir=cache_dir
+        )
+    )
+
+    assert len(tfrecord_batches) == len(csv_batches)
+    for (csv_features, csv_labels), (features, labels) in zip(
+        csv_batches, tfrecord_batches
+    ):
+        assert sorted(features) == sorted(csv_features)
+        for name, values in csv_features.items():
+            assert features[name].dtype == values.dtype
+            np.testing.assert_array_equal(features[name].numpy(), values.numpy())
+        np.testing.assert_array_equal(labels.numpy(), csv_labels.numpy())
+
+    # conversion is skipped while the CSV file is unchanged
+    with mock.patch.object(train_tf_model, "read_csv_rows") as read_csv_rows:
+        assert (
+            train_tf_model.convert_to_tfrecord(input_data, LABEL, 1, cache_dir)
+            == tfrecord_dir
+        )
+    read_csv_rows.assert_not_called()
+
+    df.iloc[:100].to_csv(input_data, index=False)
+    assert train_tf_model.tfrecord_files(input_data, cache_dir) == []
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_convert_to_tfrecord_sharded(tmp_path, compression):
+    """
+    Asserts that the rows of all (gzip compressed) CSV shards are written to the
+    TFRecord shards.
+    """
+    df = make_taxi_data(25000)
+    (tmp_path / "dataset").mkdir()
+    for i in range(2):
+        shard = df.iloc[i * 12500 : (i + 1) * 12500]
+        shard.to_csv(
+            tmp_path / "dataset" / f"part-{i}.csv",
+            index=False,
+            compression=compression,
+        )
+    input_data = tmp_path / "dataset"
+    model_params = {**train_tf_model.DEFAULT_HPARAMS, "batch_size": 1000}
+    cache_dir = str(tmp_path / "cache")
+
+    train_tf_model.convert_to_tfrecord(input_data, LABEL, 3, cache_dir)
+
+    assert len(train_tf_model.tfrecord_files(input_data, cache_dir)) == 3
+    assert len(train_tf_model.list_files(input_data)) == 2
+    dataset = train_tf_model.create_dataset(
+        input_data, LABEL, model_params, cache_dir=cache_dir
+    )
+    labels = np.concatenate([labels.numpy() for _, labels in dataset])
+    np.testing.assert_array_equal(
+        np.sort(labels), np.sort(df[LABEL].to_numpy(np.float32))
+    )
+
+
+def test_wait_for_tfrecord(tmp_path):
+    """
+    Asserts that a worker waits until the chief has converted the data to TFRecord
+    files, and gives up after the timeout.
+    """
+    input_data, cache_dir = tmp_path / "data.csv", str(tmp_path / "cache")
+    make_taxi_data(100).to_csv(input_data, index=False)
+
+    with pytest.raises(TimeoutError):
+        train_tf_model.wait_for_tfrecord(
+            input_data, cache_dir, timeout=0.2, interval=0.05
+        )
+
+    chief = threading.Timer(
+        0.2, train_tf_model.convert_to_tfrecord, (input_data, LABEL, 2, cache_dir)
+    )
+    chief.start()
+    files = train_tf_model.wait_for_tfrecord(
+        input_data, cache_dir, timeout=60, interval=0.05
+    )
+    chief.join()
+
+    assert files == train_tf_model.tfrecord_files(input_data, cache_dir)
+    assert len(files) == 2
+
+
+def test_wait_for_tfrecord_timeout(tmp_path):
+    """
+    Asserts that by default the workers wait for longer on larger data.
+    """
+    make_taxi_data(100).to_csv(tmp_path / "small.csv", index=False)
+    make_taxi_data(10000).to_csv(tmp_path / "large.csv", index=False)
+    timeouts = {}
+    for name in ("small", "large"):
+        with mock.patch.object(train_tf_model.time, "sleep"), mock.patch.object(
+            train_tf_model.time, "monotonic", side_effect=[0.0, 1e9]
+        ):
+            with pytest.raises(TimeoutError) as error:
+                train_tf_model.wait_for_tfrecord(
+                    tmp_path / f"{name}.csv", str(tmp_path / "cache")
+                )
+        timeouts[name] = float(str(error.value).rsplit(" ", 1)[1].rstrip("s"))
+
+    size = (tmp_path / "large.csv").stat().st_size
+    assert timeouts["large"] == pytest.approx(
+        train_tf_model.TFRECORD_WAIT_SECONDS
+        + size / train_tf_model.TFRECORD_WAIT_BYTES_PER_SECOND,
+        abs=1,
+    )
+    assert timeouts["large"] > timeouts["small"]
+
+
+@requires_keras_2
+@pytest.mark.parametrize("epochs,steps_per_epoch", [(1, None), (3, None), (3, 4)])
+def test_fit_model(tmp_path, epochs, steps_per_epoch):
+    """
+    Asserts that each epoch consumes the train data once, or `steps_per_epoch`
+    batches of the repeated train data.
+    """
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": epochs,
+        "batch_size": 100,
+        "steps_per_epoch": steps_per_epoch,
+    }
+    df = make_taxi_data(1000)
+    df.to_csv(tmp_path / "data.csv", index=False)
+    train_ds = train_tf_model.create_dataset(
+        tmp_path / "data.csv", LABEL, model_params, repeat=bool(steps_per_epoch)
+    )
+    valid_ds = train_tf_model.create_dataset(tmp_path / "data.csv", LABEL, model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, {**model_params, "feature_stats_cache": False}
+    )
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+
+    examples = tf.Variable(0, dtype=tf.int64)
+
+    def count(features, labels):
+        examples.assign_add(tf.shape(labels, out_type=tf.int64)[0])
+        return features, labels
+
+    history = train_tf_model.fit_model(
+        tf_model, train_ds.map(count), valid_ds, model_params
+    )
+
+    assert len(history.history["loss"]) == epochs
+    if steps_per_epoch:
+        # batches prefetched by the input pipeline are not all consumed
+        assert int(examples.numpy()) >= epochs * steps_per_epoch * 100
+    else:
+        assert int(examples.numpy()) == epochs * len(df)
+
+
+@requires_keras_2
+@pytest.mark.parametrize("mixed_precision", [None, "mixed_bfloat16", "mixed_float16"])
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_build_and_compile_model_modes(tmp_path, mixed_precision, jit_compile):
+    """
+    Asserts that only the hidden layers compute in 16 bits with mixed precision,
+    and that the model trains with mixed precision and XLA.
+    """
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "batch_size": 100,
+        "mixed_precision": mixed_precision,
+        "jit_compile": jit_compile,
+        "feature_stats_cache": False,
+    }
+    df, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    history = tf_model.fit(dataset, epochs=2, verbose=0)
+
+    compute_dtypes = {
+        layer.name: layer.compute_dtype
+        for layer in tf_model.submodules
+        if isinstance(layer, tf.keras.layers.Dense)
+    }
+    assert compute_dtypes.pop("output") == "float32"
+    expected = {None: "float32", "mixed_bfloat16": "bfloat16"}
+    assert set(compute_dtypes.values()) == {expected.get(mixed_precision, "float16")}
+    assert tf_model.predict_on_batch(next(iter(dataset))[0]).dtype == np.float32
+    assert np.isfinite(history.history["loss"]).all()
+    assert history.history["loss"][-1] < history.history["loss"][0]
+
+
+@requires_keras_2
+def test_benchmark_training_modes(tmp_path):
+    """
+    Asserts that the steps per second and RMSE are measured for each mode.
+    """
+    from tests.tensorflow.training.benchmark_train_tf_model import (
+        benchmark_training_modes,
+    )
+
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "batch_size": 100,
+        "feature_stats_cache": False,
+    }
+    _, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+
+    results = benchmark_training_modes(dataset, dataset, feature_stats, model_params)
+
+    assert list(results) == [
+        "float32",
+        "float32+xla",
+        "mixed_bfloat16",
+        "mixed_bfloat16+xla",
+    ]
+    for result in results.values():
+        assert result["stepsPerSecond"] > 0
+        assert result["rootMeanSquaredError"] > 0
+
+
+@pytest.mark.parametrize("num_files", [1, 4])
+def test_create_dataset_sharded(tmp_path, num_files):
+    """
+    Asserts that the workers read disjoint shards of the dataset covering all rows:
+    their own files if there are enough files, their own rows otherwise.
+    """
+    df = make_taxi_data(600)
+    (tmp_path / "dataset").mkdir()
+    rows_per_file = len(df) // num_files
+    for i in range(num_files):
+        shard = df.iloc[i * rows_per_file : (i + 1) * rows_per_file]
+        shard.to_csv(tmp_path / "dataset" / f"part-{i}.csv", index=False)
+    model_params = {**train_tf_model.DEFAULT_HPARAMS, "batch_size": 50}
+
+    labels = []
+    for worker in range(2):
+        input_context = tf.distribute.InputContext(
+            num_input_pipelines=2, input_pipeline_id=worker
+        )
+        with mock.patch.object(
+            train_tf_model, "read_csv_rows", wraps=train_tf_model.read_csv_rows
+        ) as read_csv_rows:
+            dataset = train_tf_model.create_dataset(
+                tmp_path / "dataset", LABEL, model_params, input_context=input_context
+            )
+        assert len(read_csv_rows.call_args.args[0]) == max(num_files // 2, 1)
+        assert (
+            dataset.options().experimental_distribute.auto_shard_policy
+            == tf.data.experimental.AutoShardPolicy.OFF
+        )
+        labels.append(np.concatenate([labels.numpy() for _, labels in dataset]))
+
+    assert len(labels[0]) == len(labels[1]) == len(df) // 2
+    np.testing.assert_array_equal(
+        np.sort(np.concatenate(labels)), np.sort(df[LABEL].to_numpy(np.float32))
+    )
+
+
+def test_warm_up():
+    """
+    Asserts that the learning rate increases linearly during the warm up steps,
+    then stays constant.
+    """
+    schedule = train_tf_model.WarmUp(learning_rate=0.01, warmup_steps=4)
+
+    learning_rates = [float(schedule(step)) for step in range(6)]
+
+    np.testing.assert_allclose(
+        learning_rates, [0.0025, 0.005, 0.0075, 0.01, 0.01, 0.01], rtol=1e-6
+    )
+    assert train_tf_model.WarmUp(**schedule.get_config())(0) == schedule(0)
+
+
+@pytest.mark.parametrize(
+    "task,expected", [("chief", 0), ("worker", 1), ("worker", 2), ("evaluator", None)]
+)
+def test_input_context(task, expected):
+    """
+    Asserts that the chief and the workers each read their own input pipeline, and
+    that the other tasks read none.
+    """
+    cluster_resolver = tf.distribute.cluster_resolver.SimpleClusterResolver(
+        tf.train.ClusterSpec(
+            {
+                "chief": ["localhost:2222"],
+                "worker": ["localhost:2223", "localhost:2224"],
+                "evaluator": ["localhost:2225"],
+            }
+        ),
+        task_type=task,
+        task_id=expected - 1 if task == "worker" else 0,
+    )
+    strategy = mock.Mock(cluster_resolver=cluster_resolver, num_replicas_in_sync=3)
+
+    input_context = train_tf_model._input_context(strategy)
+
+    if expected is None:
+        assert input_context is None
+    else:
+        assert input_context.num_input_pipelines == 3
+        assert input_context.input_pipeline_id == expected
+
+
+def test_create_dataset_no_shuffle(tmp_path):
+    """
+    Asserts that without shuffling the rows are read in the order of the file.
+    """
+    df, dataset = make_dataset(tmp_path, batch_size=100)
+    dataset = train_tf_model.create_dataset(
+        tmp_path / "data.csv",
+        LABEL,
+        {**train_tf_model.DEFAULT_HPARAMS, "batch_size": 100},
+        shuffle=False,
+    )
+
+    labels = np.concatenate([labels.numpy() for _, labels in dataset])
+
+    np.testing.assert_allclose(labels, df[LABEL], rtol=1e-6)
+
+
+def free_port() -> int:
+    """Get a free local port for a task of a TF cluster."""
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+@requires_keras_2
+def test_main_multi_worker_metrics(tmp_path):
+    """
+    Asserts that with the `multi` strategy the test metrics saved by the chief are
+    the metrics of the trained model on the whole test data, as computed by a
+    single worker.
+    """
+    for split, seed in [("train", 0), ("valid", 1), ("test", 2)]:
+        make_taxi_data(1000, seed).to_csv(tmp_path / f"{split}.csv", index=False)
+    hparams = {
+        "distribute_strategy": "multi",
+        "batch_size": 100,
+        "feature_stats_cache": False,
+    }
+    cluster = {
+        "chief": [f"localhost:{free_port()}"],
+        "worker": [f"localhost:{free_port()}"],
+    }
+    processes = []
+    for task_type in cluster:
+        tf_config = {"cluster": cluster, "task": {"type": task_type, "index": 0}}
+        argv = [sys.executable, train_tf_model.__file__]
+        for split in ("train", "valid", "test"):
+            argv.append(f"--{split}_data={tmp_path / f'{split}.csv'}")
+        argv.append(f"--model={tmp_path / task_type / 'model'}")
+        argv.append(f"--metrics={tmp_path / task_type / 'metrics.json'}")
+        argv.append(f"--hparams={json.dumps(hparams)}")
+        env = {**os.environ, "TF_CONFIG": json.dumps(tf_config)}
+        env.pop("AIP_CHECKPOINT_DIR", None)
+        (tmp_path / task_type).mkdir()
+        processes.append(subprocess.Popen(argv, env=env))
+    for process in processes:
+        assert process.wait(timeout=600) == 0
+
+    with open(tmp_path / "chief" / "metrics.json") as fp:
+        metrics = json.load(fp)
+    tf_model = tf.keras.models.load_model(tmp_path / "chief" / "model", compile=False)
+    test_ds = train_tf_model.create_dataset(
+        tmp_path / "test.csv",
+        LABEL,
+        {**train_tf_model.DEFAULT_HPARAMS, **hparams},
+        shuffle=False,
+    )
+
+    assert not (tmp_path / "worker" / "metrics.json").exists()
+    assert metrics == pytest.approx(
+        train_tf_model.evaluate_model(tf_model, test_ds), rel=1e-5
+    )
+
+
+@requires_keras_2
+def test_main_parameter_server(tmp_path):
+    """
+    Asserts that with the `parameter_server` strategy the chief trains the model
+    on the workers, with its variables on the parameter servers, and saves the
+    model and its test metrics.
+    """
+    for split, seed in [("train", 0), ("valid", 1), ("test", 2)]:
+        make_taxi_data(1000, seed).to_csv(tmp_path / f"{split}.csv", index=False)
+    hparams = {
+        "distribute_strategy": "parameter_server",
+        "batch_size": 100,
+        "epochs": 2,
+        "steps_per_epoch": 5,
+        "feature_stats_cache": False,
+    }
+    cluster = {
+        "chief": [f"localhost:{free_port()}"],
+        "worker": [f"localhost:{free_port()}"],
+        "ps": [f"localhost:{free_port()}"],
+    }
+    processes = {}
+    try:
+        # the worker and parameter server run until they are killed
+        for task_type in ("worker", "ps", "chief"):
+            tf_config = {"cluster": cluster, "task": {"type": task_type, "index": 0}}
+            argv = [sys.executable, train_tf_model.__file__]
+            for split in ("train", "valid", "test"):
+                argv.append(f"--{split}_data={tmp_path / f'{split}.csv'}")
+            argv.append(f"--model={tmp_path / task_type / 'model'}")
+            argv.append(f"--metrics={tmp_path / task_type / 'metrics.json'}")
+            argv.append(f"--hparams={json.dumps(hparams)}")
+            env = {**os.environ, "TF_CONFIG": json.dumps(tf_config)}
+            env.pop("AIP_CHECKPOINT_DIR", None)
+            (tmp_path / task_type).mkdir()
+            processes[task_type] = subprocess.Popen(argv, env=env)
+        assert processes["chief"].wait(timeout=600) == 0
+        assert processes["worker"].poll() is None
+        assert processes["ps"].poll() is None
+    finally:
+        for process in processes.values():
+            process.kill()
+            process.wait()
+
+    with open(tmp_path / "chief" / "metrics.json") as fp:
+        metrics = json.load(fp)
+    tf_model = tf.keras.models.load_model(tmp_path / "chief" / "model", compile=False)
+    test_ds = train_tf_model.create_dataset(
+        tmp_path / "test.csv",
+        LABEL,
+        {**train_tf_model.DEFAULT_HPARAMS, **hparams},
+        shuffle=False,
+    )
+
+    assert not (tmp_path / "worker" / "model").exists()
+    assert metrics == pytest.approx(
+        train_tf_model.evaluate_model(tf_model, test_ds), rel=1e-5
+    )
+
+
+class Interrupt(tf.keras.callbacks.Callback):
+    """Interrupt training at the given step (simulating a preemption) and count
+    the steps trained."""
+
+    def __init__(self, at_step: int = None):
+        super().__init__()
+        self.at_step = at_step
+        self.steps = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.steps == self.at_step:
+            raise RuntimeError("Interrupted")
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+
+
+@requires_keras_2
+@pytest.mark.parametrize("checkpoint_steps", [None, 4])
+def test_fit_model_resumes(tmp_path, checkpoint_steps):
+    """
+    Asserts that interrupted training resumes from the last backup of the training
+    state, at the end of an epoch or every `checkpoint_steps` steps.
+    """
+    if checkpoint_steps and "save_freq" not in str(
+        tf.keras.callbacks.BackupAndRestore.__init__.__code__.co_varnames
+    ):
+        pytest.skip("backups every n steps require TF >= 2.11")
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": 3,
+        "batch_size": 100,
+        "steps_per_epoch": 10 if checkpoint_steps else None,
+        "checkpoint_steps": checkpoint_steps,
+        "feature_stats_cache": False,
+    }
+    make_taxi_data(1000).to_csv(tmp_path / "data.csv", index=False)
+    dataset = train_tf_model.create_dataset(
+        tmp_path / "data.csv", LABEL, model_params, repeat=bool(checkpoint_steps)
+    )
+    valid_ds = train_tf_model.create_dataset(tmp_path / "data.csv", LABEL, model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+    checkpoint_dir = str(tmp_path / "checkpoints")
+
+    # 10 steps per epoch, interrupted during the second epoch
+    interrupt = Interrupt(at_step=15)
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    with pytest.raises(RuntimeError, match="Interrupted"):
+        train_tf_model.fit_model(
+            tf_model, dataset, valid_ds, model_params, checkpoint_dir, [interrupt]
+        )
+    assert list((tmp_path / "checkpoints").iterdir())
+
+    resumed = Interrupt()
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    history = train_tf_model.fit_model(
+        tf_model, dataset, valid_ds, model_params, checkpoint_dir, [resumed]
+    )
+
+    # resumed from step 12 or from the end of the first epoch (step 10)
+    assert resumed.steps == 30 - (12 if checkpoint_steps else 10)
+    assert len(history.history["loss"]) == 2
+    assert not (tmp_path / "checkpoints").exists() or not list(
+        (tmp_path / "checkpoints").iterdir()
+    )
+
+
+@requires_keras_2
+@pytest.mark.parametrize("distribute_strategy", ["single", "default"])
+def test_fit_model_strategy_backup(tmp_path, distribute_strategy):
+    """
+    Asserts that the single strategy places the model on one device and trains
+    without backing up the training state, which only the default strategy
+    supports.
+    """
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": 2,
+        "batch_size": 100,
+        "feature_stats_cache": False,
+    }
+    _, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+    strategy = train_tf_model.get_distribution_strategy(distribute_strategy)
+    with strategy.scope():
+        tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    # 10 steps per epoch, interrupted during the second epoch
+    interrupt = Interrupt(at_step=15)
+
+    with pytest.raises(RuntimeError, match="Interrupted"):
+        train_tf_model.fit_model(
+            tf_model,
+            dataset,
+            None,
+            model_params,
+            str(tmp_path / "checkpoints"),
+            [interrupt],
+        )
+
+    if distribute_strategy == "single":
+        assert isinstance(strategy, tf.distribute.OneDeviceStrategy)
+        assert not (tmp_path / "checkpoints").exists()
+    else:
+        assert strategy is tf.distribute.get_strategy()
+        assert list((tmp_path / "checkpoints").iterdir())
+
+
+@requires_keras_2
+@pytest.mark.parametrize("jit_compile", [False, True])
+def test_export_serving_model(tmp_path, jit_compile):
+    """
+    Asserts that both signatures of the serving model predict like the Keras
+    model, also for unknown categories, and that the weights are constants.
+    """
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "batch_size": 100,
+        "jit_compile": jit_compile,
+        "feature_stats_cache": False,
+    }
+    _, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    tf_model.fit(dataset, epochs=1, verbose=0)
+    features, _ = next(iter(dataset))
+    features = {name: values.numpy() for name, values in features.items()}
+    features["company"][:10] = b"Unknown company"
+    features = {name: tf.constant(values) for name, values in features.items()}
+
+    train_tf_model.export_serving_model(tf_model, feature_stats, str(tmp_path / "m"))
+    serving_model = tf.saved_model.load(str(tmp_path / "m"))
+
+    assert serving_model.signatures["serving_default"].variables == ()
+    expected = tf_model.predict_on_batch(features)
+    predictions = serving_model.signatures["serving_default"](**features)
+    np.testing.assert_allclose(predictions["output"], expected, rtol=1e-5, atol=1e-6)
+    examples = [
+        train_tf_model.to_example(
+            {name: values[i].numpy() for name, values in features.items()}
+        ).SerializeToString()
+        for i in range(len(expected))
+    ]
+    predictions = serving_model.signatures["serving_examples"](
+        examples=tf.constant(examples)
+    )
+    np.testing.assert_allclose(predictions["output"], expected, rtol=1e-5, atol=1e-6)
+
+
+@requires_keras_2
+def test_benchmark_serving(tmp_path):
+    """
+    Asserts that the predictions per second are measured for each signature.
+    """
+    from tests.tensorflow.training.benchmark_train_tf_model import benchmark_serving
+
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "batch_size": 100,
+        "feature_stats_cache": False,
+    }
+    _, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+    tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+    features, _ = next(iter(dataset))
+
+    results = benchmark_serving(tf_model, feature_stats, features, num_runs=2)
+
+    assert list(results) == ["keras", "optimized", "optimizedExamples"]
+    assert all(
+        predictions_per_second > 0 for predictions_per_second in results.values()
+    )
+
+
+@requires_keras_2
+def test_throughput_monitor(tmp_path):
+    """
+    Asserts that the throughput of each epoch is recorded, counting only the
+    training examples and timing all steps but the first one (which traces the
+    training function), and that a slow input pipeline shows as more input stall
+    than a fast one.
+    """
+    model_params = {
+        **train_tf_model.DEFAULT_HPARAMS,
+        "epochs": 2,
+        "batch_size": 100,
+        "feature_stats_cache": False,
+    }
+    df, dataset = make_dataset(tmp_path, **model_params)
+    feature_stats = train_tf_model.get_feature_stats(
+        tmp_path / "data.csv", LABEL, model_params
+    )
+
+    def train(input_delay: float) -> dict:
+        def delay(features, labels):
+            sleep = tf.py_function(
+                lambda: time.sleep(input_delay) or 0.0, [], tf.float32
+            )
+            with tf.control_dependencies([sleep]):
+                return features, tf.identity(labels)
+
+        tf_model = train_tf_model.build_and_compile_model(feature_stats, model_params)
+        monitor = train_tf_model.ThroughputMonitor()
+        train_tf_model.fit_model(
+            tf_model,
+            monitor.timed(dataset.unbatch().batch(100).map(delay)),
+            dataset,
+            model_params,
+            callbacks=[monitor],
+        )
+        return monitor.result()
+
+    fast, slow = train(0.0), train(0.1)
+
+    for result in (fast, slow):
+        assert [epoch["examples"] for epoch in result["epochs"]] == [len(df)] * 2
+        assert [epoch["timedExamples"] for epoch in result["epochs"]] == [
+            len(df) - 100,
+            len(df),
+        ]
+        assert [epoch["steps"] for epoch in result["epochs"]] == [10] * 2
+        assert result["examplesPerSecond"] > 0
+        assert result["peakRssMb"] > 0
+    assert slow["inputSeconds"] > fast["inputSeconds"]
+    assert slow["inputStallFraction"] > fast["inputStallFraction"]
+    assert slow["examplesPerSecond"] < fast["examplesPerSecond"]
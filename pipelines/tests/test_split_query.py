@@ -0,0 +1,244 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import random
+import re
+import sqlite3
+from pathlib import Path
+
+import pytest
+from jinja2 import Template
+
+import pipelines
+from pipelines import generate_query
+
+COLUMNS = ["dayofweek", "trip_miles", "payment_type", "total_fare"]
+SPLITS = {"train_data": tuple(range(8)), "valid_data": "(8)", "test_data": "(9)"}
+
+# the former sample.sql, rendered once per split
+SAMPLE_QUERY = """
+SELECT *
+FROM
+ `{{ source_dataset }}.{{ source_table }}` AS t
+WHERE
+    MOD(ABS(FARM_FINGERPRINT(TO_JSON_STRING(t))),
+        {{ num_lots }}) IN {{ lots }}
+"""
+
+
+def farm_fingerprint(value: str) -> int:
+    """
+    Stand-in of the BigQuery FARM_FINGERPRINT function.
+
+    Args:
+        value (str): value to hash
+
+    Returns:
+        int: signed 64 bit hash of the value
+    """
+    digest = hashlib.sha256(value.encode()).digest()
+    return int.from_bytes(digest[:8], "big", signed=True)
+
+
+def to_sqlite(query: str, columns: list = COLUMNS) -> str:
+    """
+    Translate the BigQuery SQL of the split queries to SQLite.
+
+    Args:
+        query (str): BigQuery SQL
+        columns (list): columns of the source table
+
+    Returns:
+        str: SQLite SQL
+    """
+
+    def json_object(columns: list) -> str:
+        row = ", ".join(f"'{column}', t.{column}" for column in columns)
+        return f"json_object({row})"
+
+    data_columns = [column for column in columns if column != "trip_date"]
+    query = re.sub(r"PARTITION BY RANGE_BUCKET\(.*\)\n", "", query)
+    query = query.replace("CREATE OR REPLACE TABLE", "CREATE TABLE")
+    query = query.replace("* EXCEPT (_lot)", ", ".join(columns))
+    query = query.replace("* EXCEPT (_lot, `trip_date`)", ", ".join(data_columns))
+    # trailing window cutoff of a timestamp
+    query = re.sub(
+        r'DATE_SUB\(DATE\(IF\("(.*?)" = .*? AS DATETIME\)\)\), INTERVAL (\d) MONTH\)',
+        r"date('\1', '-\2 months')",
+        query,
+    )
+    # fingerprint of the row without the partition column
+    query = re.sub(
+        r"TO_JSON_STRING\(\s*\(SELECT AS STRUCT t\.\* EXCEPT \(`trip_date`\)\)\s*\)",
+        json_object(data_columns),
+        query,
+    )
+    return query.replace("TO_JSON_STRING(t)", json_object(columns))
+
+
+@pytest.fixture
+def db() -> sqlite3.Connection:
+    """
+    SQLite database standing in for BigQuery, with an ingested data table.
+
+    Returns:
+        sqlite3.Connection: database connection
+    """
+    db = sqlite3.connect(":memory:")
+    db.create_function("FARM_FINGERPRINT", 1, farm_fingerprint, deterministic=True)
+    db.create_function("MOD", 2, lambda x, y: x % y, deterministic=True)
+    db.execute(f"CREATE TABLE `preprocessing.ingested_data` ({', '.join(COLUMNS)})")
+    rng = random.Random(0)
+    rows = [
+        (
+            float(rng.randint(1, 7)),
+            round(rng.uniform(0.1, 20), 2),
+            rng.choice(["Cash", "Credit Card", None]),
+            round(rng.uniform(3, 80), 2),
+        )
+        for _ in range(1000)
+    ]
+    db.executemany(
+        "INSERT INTO `preprocessing.ingested_data` VALUES (?, ?, ?, ?)", rows
+    )
+    return db
+
+
+@pytest.mark.parametrize("framework", ["tensorflow", "xgboost"])
+def test_split_query(db, framework):
+    """
+    Asserts that the split script scans the source table once and assigns every
+    row to the same split as the former per-split queries.
+    """
+    queries_folder = Path(pipelines.__file__).parent / framework / "training/queries"
+    split_query = generate_query(
+        queries_folder / "split.sql",
+        source_dataset="preprocessing",
+        source_table="ingested_data",
+        destination_dataset="preprocessing",
+        num_lots=10,
+        splits=SPLITS,
+    )
+
+    db.executescript(to_sqlite(split_query))
+
+    assert split_query.count("`preprocessing.ingested_data`") == 1
+    num_rows = 0
+    for table, lots in SPLITS.items():
+        expected = db.execute(
+            to_sqlite(
+                Template(SAMPLE_QUERY).render(
+                    source_dataset="preprocessing",
+                    source_table="ingested_data",
+                    num_lots=10,
+                    lots=lots,
+                )
+            )
+        ).fetchall()
+        rows = db.execute(f"SELECT * FROM `preprocessing.{table}`").fetchall()
+        assert sorted(rows, key=str) == sorted(expected, key=str)
+        assert len(rows) > 0
+        num_rows += len(rows)
+    assert num_rows == 1000
+
+
+@pytest.mark.parametrize("framework", ["tensorflow", "xgboost"])
+def test_split_query_partition_filter(db, framework):
+    """
+    Asserts that the split script of an incrementally ingested table only splits
+    the partitions of the trailing window, without the partition column, and
+    assigns every row to the same split as for a table without it.
+    """
+    db.execute(
+        "CREATE TABLE `preprocessing.ingested_history` AS "
+        "SELECT *, date('2022-08-01', '+' || (rowid % 120) || ' days') AS trip_date "
+        "FROM `preprocessing.ingested_data`"
+    )
+    queries_folder = Path(pipelines.__file__).parent / framework / "training/queries"
+    split_query = generate_query(
+        queries_folder / "split.sql",
+        source_dataset="preprocessing",
+        source_table="ingested_history",
+        destination_dataset="preprocessing",
+        filter_start_value="2022-12-01 00:00:00",
+        partition_column="trip_date",
+        num_lots=10,
+        splits=SPLITS,
+    )
+
+    db.executescript(to_sqlite(split_query, COLUMNS + ["trip_date"]))
+
+    db.execute(
+        f"CREATE TABLE `preprocessing.ingested_window` AS "
+        f"SELECT {', '.join(COLUMNS)} FROM `preprocessing.ingested_history` "
+        "WHERE trip_date BETWEEN '2022-09-01' AND '2022-10-01'"
+    )
+    num_rows = 0
+    for table, lots in SPLITS.items():
+        expected = db.execute(
+            to_sqlite(
+                Template(SAMPLE_QUERY).render(
+                    source_dataset="preprocessing",
+                    source_table="ingested_window",
+                    num_lots=10,
+                    lots=lots,
+                )
+            )
+        ).fetchall()
+        cursor = db.execute(f"SELECT * FROM `preprocessing.{table}`")
+        assert [column[0] for column in cursor.description] == COLUMNS
+        rows = cursor.fetchall()
+        assert sorted(rows, key=str) == sorted(expected, key=str)
+        num_rows += len(rows)
+    assert 0 < num_rows < 1000
+    assert num_rows == len(
+        db.execute("SELECT * FROM `preprocessing.ingested_window`").fetchall()
+    )
+
+
+@pytest.mark.parametrize("framework", ["tensorflow", "xgboost"])
+@pytest.mark.parametrize(
+    "partition_column, write_disposition, incremental",
+    [
+        (None, "WRITE_TRUNCATE", False),
+        ("trip_date", "WRITE_TRUNCATE", False),
+        ("trip_date", "WRITE_APPEND", True),
+    ],
+)
+def test_ingest_query_incremental(
+    framework, partition_column, write_disposition, incremental
+):
+    """
+    Asserts that the ingest query only has the partition column of a partitioned
+    table, and only filters the days after the watermark when it is ingested
+    incrementally.
+    """
+    queries_folder = Path(pipelines.__file__).parent / framework / "training/queries"
+    ingest_query = generate_query(
+        queries_folder / "ingest.sql",
+        source_dataset="chicago_taxi_trips",
+        source_table="taxi_trips",
+        filter_column="trip_start_timestamp",
+        target_column="total_fare",
+        filter_start_value="2022-12-01 00:00:00",
+        destination_dataset="preprocessing",
+        destination_table="ingested_data",
+        partition_column=partition_column,
+        write_disposition=write_disposition,
+    )
+
+    assert ("AS `trip_date`" in ingest_query) == bool(partition_column)
+    assert ("watermarks.watermark" in ingest_query) == incremental
+    assert "WRITE_" not in ingest_query
@@ -0,0 +1,359 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the XGBoost training script on synthetic Chicago taxi trips data.
+Each case runs in its own process, so that its peak RSS is measured alone.
+
+Run from the pipelines directory:
+
+    PYTHONPATH=src python -m tests.xgboost.training.benchmark_train_xgb_model \
+        read --rows 2000000
+
+The `preprocess` benchmark compares training in memory with the preprocessing
+steps fitted once against the former training, which fitted them twice. The
+`categorical` benchmark compares one-hot encoding with the native categorical
+support of XGBoost. The `threads` benchmark trains a few boosting rounds with
+each thread count (`--threads`), on synthetic data or on a sample of the
+training data (`--data`), to right-size the `machine_type` of the training job.
+The `model_formats` benchmark trains a model on the same data and measures the
+size, write time and load time of the model in each format.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from sklearn.pipeline import Pipeline
+
+from pipelines.xgboost.training.assets import train_xgb_model
+from tests.xgboost.training.test_train_xgb_model import (
+    LABEL,
+    make_taxi_data,
+    write_data,
+)
+
+# number of boosting rounds trained for each thread count
+BENCHMARK_ROUNDS = 20
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the process in MB (Linux). Read from the high
+    water mark of the process memory, unlike `ru_maxrss` it is not inherited
+    from the parent process."""
+    with open("/proc/self/status") as fp:
+        for line in fp:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def read_csv_all_columns(path: str, label: str) -> pd.DataFrame:
+    """Reader of the training script before column pruning: all columns of the
+    CSV file are parsed with inferred dtypes (the label is one of them)."""
+    return pd.read_csv(path)
+
+
+def xgb_model() -> train_xgb_model.XGBRegressor:
+    """Model with few boosting rounds, so that preprocessing dominates."""
+    return train_xgb_model.XGBRegressor(n_estimators=5, tree_method="hist")
+
+
+def train_in_memory_former(path: str, label: str) -> Pipeline:
+    """Training of the script before the preprocessing steps were fitted once:
+    they were fitted to transform the validation data, then fitted again (and
+    the training data transformed again) by the pipeline."""
+    X_train, y_train = train_xgb_model.split_xy(
+        train_xgb_model.read_data(path, label), label
+    )
+    X_valid, y_valid = X_train.iloc[:1000], y_train.iloc[:1000]
+    categories = {
+        col: sorted(X_train[col].unique())
+        for col in train_xgb_model.ORD_COLS + train_xgb_model.OHE_COLS
+    }
+    preprocessor = train_xgb_model.build_preprocessor(
+        X_train.columns.tolist(), categories
+    )
+    pipeline = Pipeline(
+        steps=[("feature_engineering", preprocessor), ("train_model", xgb_model())]
+    )
+    X_valid_transformed = preprocessor.fit(X_train).transform(X_valid)
+    pipeline.fit(
+        X_train, y_train, train_model__eval_set=[(X_valid_transformed, y_valid)]
+    )
+    return pipeline
+
+
+def train_in_memory(path: str, label: str) -> Pipeline:
+    """Training of the script, see `train_xgb_model.train_in_memory`."""
+    X_train, y_train = train_xgb_model.split_xy(
+        train_xgb_model.read_data(path, label), label
+    )
+    X_valid, y_valid = X_train.iloc[:1000], y_train.iloc[:1000]
+    return train_xgb_model.train_in_memory(
+        X_train, y_train, X_valid, y_valid, xgb_model()
+    )
+
+
+def train_categorical(path: str, label: str, native_categorical: bool) -> Pipeline:
+    """Training of the script with the categorical columns one-hot encoded, or
+    passed as category codes to the native categorical support of XGBoost."""
+    X_train, y_train = train_xgb_model.split_xy(
+        train_xgb_model.read_data(path, label), label
+    )
+    X_valid, y_valid = X_train.iloc[:1000], y_train.iloc[:1000]
+    model = train_xgb_model.XGBRegressor(
+        n_estimators=50, tree_method="hist", enable_categorical=native_categorical
+    )
+    return train_xgb_model.train_in_memory(X_train, y_train, X_valid, y_valid, model)
+
+
+def run_case(func, args: tuple, queue: multiprocessing.Queue) -> None:
+    """Run a benchmark case and put its wall time and the increase of the peak
+    RSS of the process in the queue."""
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    func(*args)
+    queue.put((time.perf_counter() - start, peak_rss_mb() - baseline))
+
+
+def measure(func, *args) -> tuple:
+    """Measure the wall time and peak RSS increase of `func(*args)` in a new
+    process.
+    Returns:
+        seconds, peak_rss_mb (float, float): wall time and peak RSS increase
+    """
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=run_case, args=(func, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmark_read(rows: int, data_dir: Path) -> dict:
+    """Compare the former reader (all CSV columns, inferred dtypes) with
+    `read_data` on CSV, Parquet and Arrow files of the same data, with an unused
+    extra column."""
+    df = make_taxi_data(rows)
+    for file_format in ("csv", "parquet", "arrow"):
+        write_data(df, data_dir / f"data.{file_format}", file_format)
+    del df
+
+    cases = {
+        "csv, all columns (former reader)": (
+            read_csv_all_columns,
+            str(data_dir / "data.csv"),
+        ),
+        "csv, pruned columns": (train_xgb_model.read_data, str(data_dir / "data.csv")),
+        "parquet, pruned columns": (
+            train_xgb_model.read_data,
+            str(data_dir / "data.parquet"),
+        ),
+        "arrow, pruned columns": (
+            train_xgb_model.read_data,
+            str(data_dir / "data.arrow"),
+        ),
+    }
+    return {name: measure(func, path, LABEL) for name, (func, path) in cases.items()}
+
+
+def benchmark_preprocess(rows: int, data_dir: Path) -> dict:
+    """Compare training in memory with the preprocessing steps fitted twice
+    (former training) and once, on the same Parquet file. Reading the file is
+    measured alone as a baseline."""
+    path = str(data_dir / "data.parquet")
+    write_data(make_taxi_data(rows), path, "parquet")
+    cases = {
+        "read only": train_xgb_model.read_data,
+        "preprocessing fitted twice (former)": train_in_memory_former,
+        "preprocessing fitted once": train_in_memory,
+    }
+    return {name: measure(func, path, LABEL) for name, func in cases.items()}
+
+
+def benchmark_categorical(rows: int, data_dir: Path) -> dict:
+    """Compare training in memory with the categorical columns one-hot encoded
+    and with native categorical support (XGBoost >= 1.7), on the same Parquet
+    file."""
+    path = str(data_dir / "data.parquet")
+    write_data(make_taxi_data(rows), path, "parquet")
+    cases = {"one-hot encoding": False, "native categorical": True}
+    return {
+        name: measure(train_categorical, path, LABEL, native_categorical)
+        for name, native_categorical in cases.items()
+    }
+
+
+def benchmark_threads(
+    X: pd.DataFrame,
+    y: pd.Series,
+    xgb_model: train_xgb_model.XGBRegressor,
+    thread_counts: list,
+    num_boost_round: int = BENCHMARK_ROUNDS,
+) -> dict:
+    """Train a few boosting rounds with each number of threads to find the
+    thread count (and hence the `machine_type`) beyond which training stops scaling.
+    Args:
+        X, y (pd.DataFrame, pd.Series): training features and labels
+        xgb_model (XGBRegressor): model whose parameters are used for training
+        thread_counts (list): numbers of threads to benchmark
+        num_boost_round (int): number of boosting rounds per thread count
+    Returns:
+        seconds_per_round (dict): median wall time of a boosting round by number
+            of threads
+    """
+    categories = {
+        col: sorted(X[col].unique())
+        for col in train_xgb_model.ORD_COLS + train_xgb_model.OHE_COLS
+    }
+    native_categorical = train_xgb_model.is_native_categorical(xgb_model)
+    preprocessor = train_xgb_model.build_preprocessor(
+        X.columns.tolist(), categories, native_categorical
+    )
+    dmatrix_args = {}
+    if native_categorical:
+        dmatrix_args["feature_types"] = train_xgb_model.set_feature_types(
+            xgb_model, preprocessor
+        )
+        dmatrix_args["enable_categorical"] = True
+    X_transformed = preprocessor.fit_transform(X).astype(np.float32)
+    dtrain = xgb.DMatrix(X_transformed, y, **dmatrix_args)
+
+    params = xgb_model.get_xgb_params()
+    params.pop("n_jobs", None)
+    if params.get("tree_method") is None:
+        params["tree_method"] = "hist"
+
+    seconds_per_round = {}
+    for n_threads in thread_counts:
+        timer = train_xgb_model.IterationTimer(verbose=False)
+        xgb.train(
+            {**params, "nthread": n_threads},
+            dtrain,
+            num_boost_round=num_boost_round,
+            callbacks=[timer],
+        )
+        seconds_per_round[n_threads] = float(np.median(timer.times))
+        logging.info(
+            f"{n_threads} threads: {seconds_per_round[n_threads]:.4f}s per round"
+        )
+    return seconds_per_round
+
+
+def benchmark_model_formats(pipeline: Pipeline, compress_levels=(0, 3)) -> pd.DataFrame:
+    """Measure the size, write time and load time of the model artifacts in each
+    format and joblib compression level. Artifacts are written to and loaded from
+    a local temporary directory in a warm process, so the load time excludes the
+    import of the libraries.
+    Args:
+        pipeline (Pipeline): fitted sklearn pipeline of preprocessor and model
+        compress_levels (tuple): joblib compression levels
+    Returns:
+        results (pd.DataFrame): size in bytes, write and load time in seconds by
+            format and compression level
+    """
+    results = []
+    for model_format in train_xgb_model.MODEL_FORMATS:
+        for compress in compress_levels:
+            with tempfile.TemporaryDirectory() as model_dir:
+                model_dir = Path(model_dir)
+                start = time.perf_counter()
+                train_xgb_model.save_pipeline(
+                    pipeline, model_dir, model_format, compress
+                )
+                write_seconds = time.perf_counter() - start
+                start = time.perf_counter()
+                train_xgb_model.load_pipeline(model_dir)
+                load_seconds = time.perf_counter() - start
+                size = sum(f.stat().st_size for f in model_dir.iterdir())
+            results.append(
+                dict(
+                    model_format=model_format,
+                    compress=compress,
+                    size_bytes=size,
+                    write_seconds=write_seconds,
+                    load_seconds=load_seconds,
+                )
+            )
+    return pd.DataFrame(results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "benchmark",
+        choices=["read", "preprocess", "categorical", "threads", "model_formats"],
+    )
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument(
+        "--data",
+        type=str,
+        help="Training data (file or directory) to benchmark the thread counts or "
+        "the model formats on, instead of synthetic data.",
+    )
+    parser.add_argument(
+        "--threads",
+        type=lambda s: [int(n) for n in s.split(",")],
+        default=[1, 2, 4, 8],
+        help="Comma separated thread counts to benchmark.",
+    )
+    parser.add_argument("--hparams", default={}, type=json.loads)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if args.benchmark in ("threads", "model_formats"):
+        hparams = dict(args.hparams)
+        label = hparams.pop("label", LABEL)
+        if args.data:
+            df = train_xgb_model.read_data(args.data, label)
+        else:
+            df = make_taxi_data(args.rows).drop(columns="unused")
+        X, y = train_xgb_model.split_xy(df, label)
+        xgb_model = train_xgb_model.XGBRegressor(**hparams)
+        print(f"{args.benchmark}, {len(X)} rows")
+        if args.benchmark == "threads":
+            seconds_per_round = benchmark_threads(X, y, xgb_model, args.threads)
+            print(f"{'threads':<40} {'seconds per round':>18}")
+            for n_threads, seconds in seconds_per_round.items():
+                print(f"{n_threads:<40} {seconds:>18.4f}")
+        else:
+            pipeline = train_xgb_model.train_in_memory(X, y, X, y, xgb_model)
+            print(benchmark_model_formats(pipeline).to_string(index=False))
+        return
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        benchmark = {
+            "read": benchmark_read,
+            "preprocess": benchmark_preprocess,
+            "categorical": benchmark_categorical,
+        }
+        results = benchmark[args.benchmark](args.rows, Path(data_dir))
+
+    print(f"{args.benchmark}, {args.rows} rows")
+    print(f"{'case':<40} {'seconds':>8} {'peak RSS MB':>12}")
+    for name, (seconds, rss) in results.items():
+        print(f"{name:<40} {seconds:>8.2f} {rss:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
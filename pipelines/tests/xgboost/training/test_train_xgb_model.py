@@ -0,0 +1,671 @@
+# Copyright 2022 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib.util
+import json
+import logging
+import math
+import pickle
+import sys
+import types
+from unittest import mock
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+pytest.importorskip("sklearn")
+pytest.importorskip("xgboost")
+
+from pipelines.xgboost.training.assets import train_xgb_model  # noqa: E402
+
+LABEL = "total_fare"
+
+
+def make_taxi_data(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Generate a dataframe shaped like the Chicago taxi trips training data.
+
+    Args:
+        n_rows (int): number of rows to generate
+        seed (int): random seed
+
+    Returns:
+        pd.DataFrame: generated features, label and an unused extra column
+    """
+    rng = np.random.default_rng(seed)
+    trip_seconds = rng.integers(60, 3600, n_rows).astype(float)
+    trip_miles = trip_seconds / 200 * rng.uniform(0.5, 1.5, n_rows)
+    return pd.DataFrame(
+        {
+            "dayofweek": rng.integers(1, 8, n_rows).astype(float),
+            "hourofday": rng.integers(0, 24, n_rows).astype(float),
+            "trip_distance": trip_miles * 1600 * rng.uniform(0.6, 1.0, n_rows),
+            "trip_miles": trip_miles,
+            "trip_seconds": trip_seconds,
+            "payment_type": rng.choice(["Cash", "Credit Card", "Mobile"], n_rows),
+            "company": rng.choice([f"Company {i}" for i in range(20)], n_rows),
+            LABEL: 3.25 + 2.25 * trip_miles + rng.exponential(2, n_rows),
+            "unused": rng.normal(size=n_rows),
+        }
+    )
+
+
+def write_data(df: pd.DataFrame, path, file_format: str) -> None:
+    """
+    Write a dataframe to a file of the given format.
+
+    Args:
+        df (pd.DataFrame): dataframe to write
+        path: output file path
+        file_format (str): one of csv, csv.gz, parquet, arrow, avro or avro.snappy
+
+    Returns:
+        None
+    """
+    if file_format == "csv":
+        df.to_csv(path, index=False)
+    elif file_format == "csv.gz":
+        df.to_csv(path, index=False, compression="gzip")
+    elif file_format == "parquet":
+        df.to_parquet(path, index=False)
+    elif file_format == "arrow":
+        df.to_feather(path)
+    elif file_format in ("avro", "avro.snappy"):
+        fastavro = pytest.importorskip("fastavro")
+        schema = fastavro.parse_schema(
+            {
+                "type": "record",
+                "name": "Root",
+                "fields": [
+                    {
+                        "name": c,
+                        "type": (
+                            "double" if pd.api.types.is_numeric_dtype(t) else "string"
+                        ),
+                    }
+                    for c, t in df.dtypes.items()
+                ],
+            }
+        )
+        with open(path, "wb") as fp:
+            codec = "snappy" if file_format == "avro.snappy" else "null"
+            fastavro.writer(fp, schema, df.to_dict("records"), codec=codec)
+
+
+@pytest.mark.parametrize("file_format", ["csv", "csv.gz", "parquet", "arrow", "avro"])
+def test_read_data(tmp_path, file_format):
+    """
+    Asserts that all formats are detected and read with pruned columns and
+    explicit dtypes, both from a single file and from a directory of shards.
+    """
+    if file_format in ("parquet", "arrow"):
+        pytest.importorskip("pyarrow")
+    df = make_taxi_data(100)
+    single_file = tmp_path / "data"
+    write_data(df, single_file, file_format)
+    shards = tmp_path / "shards"
+    shards.mkdir()
+    for i in range(3):
+        shard = df.iloc[i * 34 : (i + 1) * 34].reset_index(drop=True)
+        write_data(shard, shards / f"{i:012}", file_format)
+
+    assert train_xgb_model.detect_format(str(single_file)) == file_format
+
+    expected = df.drop(columns=["unused"]).astype(train_xgb_model.FEATURE_DTYPES)
+    for path in [single_file, shards, shards / "*"]:
+        actual = train_xgb_model.read_data(str(path), LABEL)
+        assert "unused" not in actual.columns
+        assert actual[train_xgb_model.NUM_COLS].dtypes.eq(np.float32).all()
+        pd.testing.assert_frame_equal(actual[expected.columns], expected)
+
+
+def test_read_data_snappy_avro(tmp_path):
+    """
+    Asserts that Avro files compressed with SNAPPY (as exported by BigQuery) are
+    read like uncompressed Avro files.
+    """
+    pytest.importorskip("cramjam")
+    df = make_taxi_data(100)
+    write_data(df, tmp_path / "data.avro", "avro")
+    write_data(df, tmp_path / "data.snappy.avro", "avro.snappy")
+
+    assert train_xgb_model.detect_format(str(tmp_path / "data.snappy.avro")) == "avro"
+    pd.testing.assert_frame_equal(
+        train_xgb_model.read_data(str(tmp_path / "data.snappy.avro"), LABEL),
+        train_xgb_model.read_data(str(tmp_path / "data.avro"), LABEL),
+    )
+
+
+@pytest.mark.parametrize("file_format", ["parquet", "arrow"])
+def test_read_data_missing_values(tmp_path, file_format):
+    """
+    Asserts that missing values of columnar files are read as in CSV files.
+    """
+    pytest.importorskip("pyarrow")
+    df = make_taxi_data(100)
+    df.loc[::7, "trip_miles"] = np.nan
+    df.loc[::5, "company"] = None
+    write_data(df, tmp_path / "data.csv", "csv")
+    write_data(df, tmp_path / "data", file_format)
+
+    pd.testing.assert_frame_equal(
+        train_xgb_model.read_data(str(tmp_path / "data"), LABEL),
+        train_xgb_model.read_data(str(tmp_path / "data.csv"), LABEL),
+        check_like=True,
+    )
+
+
+def test_list_files_ignores_hidden_files(tmp_path):
+    """
+    Asserts that files which are not data shards are not listed.
+    """
+    for name in ["000000000000.csv", "000000000001.csv", "_SUCCESS", ".hidden"]:
+        (tmp_path / name).touch()
+
+    files = train_xgb_model.list_files(str(tmp_path))
+
+    assert files == [
+        str(tmp_path / "000000000000.csv"),
+        str(tmp_path / "000000000001.csv"),
+    ]
+    with pytest.raises(FileNotFoundError):
+        train_xgb_model.list_files(str(tmp_path / "missing-*.csv"))
+
+
+@pytest.mark.parametrize("file_format", ["csv", "csv.gz", "parquet", "arrow", "avro"])
+def test_iter_chunks(tmp_path, file_format):
+    """
+    Asserts that chunks are never larger than the chunk size and add up to the
+    data read in one go.
+    """
+    if file_format in ("parquet", "arrow"):
+        pytest.importorskip("pyarrow")
+    df = make_taxi_data(250)
+    for i in range(2):
+        shard = df.iloc[i * 125 : (i + 1) * 125].reset_index(drop=True)
+        write_data(shard, tmp_path / f"{i:012}", file_format)
+
+    chunks = list(train_xgb_model.iter_chunks(str(tmp_path), LABEL, chunk_size=40))
+
+    assert max(len(chunk) for chunk in chunks) == 40
+    pd.testing.assert_frame_equal(
+        pd.concat(chunks, ignore_index=True),
+        train_xgb_model.read_data(str(tmp_path), LABEL),
+    )
+
+
+def test_fit_preprocessor_streaming():
+    """
+    Asserts that fitting the preprocessing steps chunk by chunk gives the same
+    transformation as fitting them on the whole dataframe.
+    """
+    X, _ = train_xgb_model.split_xy(make_taxi_data(1000).drop(columns="unused"), LABEL)
+    categories = {
+        col: sorted(X[col].unique())
+        for col in train_xgb_model.ORD_COLS + train_xgb_model.OHE_COLS
+    }
+    expected = train_xgb_model.build_preprocessor(X.columns.tolist(), categories)
+    expected.fit(X)
+
+    actual = train_xgb_model.fit_preprocessor_streaming(
+        lambda: (X.iloc[i : i + 300] for i in range(0, len(X), 300))
+    )
+
+    np.testing.assert_allclose(actual.transform(X), expected.transform(X), rtol=1e-5)
+
+
+def test_train_streaming_memory_bound(tmp_path):
+    """
+    Asserts that training in streaming mode never holds the dataset in memory: the
+    increase of the peak RSS of the training process, which includes the native
+    allocations of XGBoost, stays well below the size of the data files.
+    """
+    from tests.xgboost.training.benchmark_train_xgb_model import measure
+
+    n_rows, chunk_size = 500000, 5000
+    for split, seed in [("train", 0), ("valid", 1)]:
+        make_taxi_data(n_rows, seed).to_csv(tmp_path / f"{split}.csv", index=False)
+    data_size_mb = sum(
+        (tmp_path / f"{split}.csv").stat().st_size for split in ("train", "valid")
+    ) / (1024 * 1024)
+
+    _, peak_rss_mb = measure(
+        train_xgb_model.train_streaming,
+        str(tmp_path / "train.csv"),
+        str(tmp_path / "valid.csv"),
+        LABEL,
+        train_xgb_model.XGBRegressor(
+            n_estimators=10, early_stopping_rounds=5, n_jobs=1
+        ),
+        chunk_size,
+    )
+
+    assert peak_rss_mb < 0.75 * data_size_mb
+
+
+def test_train_streaming(tmp_path):
+    """
+    Asserts that the model trained in streaming mode predicts the data in chunks.
+    """
+    n_rows, chunk_size = 20000, 5000
+    for split, seed in [("train", 0), ("valid", 1)]:
+        make_taxi_data(n_rows, seed).to_csv(tmp_path / f"{split}.csv", index=False)
+
+    pipeline = train_xgb_model.train_streaming(
+        str(tmp_path / "train.csv"),
+        str(tmp_path / "valid.csv"),
+        LABEL,
+        train_xgb_model.XGBRegressor(n_estimators=10, early_stopping_rounds=5),
+        chunk_size,
+    )
+
+    y_true, y_pred = map(
+        np.concatenate,
+        zip(
+            *train_xgb_model.predict_chunks(
+                pipeline, str(tmp_path / "valid.csv"), LABEL, chunk_size
+            )
+        ),
+    )
+    assert len(y_pred) == n_rows
+    assert np.corrcoef(y_true, y_pred)[0, 1] > 0.9
+
+
+def test_train_in_memory_fits_preprocessor_once():
+    """
+    Asserts that the preprocessing steps are fitted once and that the returned
+    pipeline predicts raw dataframes like the model on the transformed data.
+    """
+    # ColumnTransformer.fit calls fit_transform, so this counts both
+    fit_transform = train_xgb_model.ColumnTransformer.fit_transform
+    df = make_taxi_data(500).drop(columns="unused")
+    X_train, y_train = train_xgb_model.split_xy(df.iloc[:400].copy(), LABEL)
+    X_valid, y_valid = train_xgb_model.split_xy(df.iloc[400:].copy(), LABEL)
+    xgb_model = train_xgb_model.XGBRegressor(n_estimators=5)
+
+    with mock.patch.object(
+        train_xgb_model.ColumnTransformer,
+        "fit_transform",
+        autospec=True,
+        side_effect=fit_transform,
+    ) as fit_transform_spy:
+        pipeline = train_xgb_model.train_in_memory(
+            X_train, y_train, X_valid, y_valid, xgb_model
+        )
+
+    assert fit_transform_spy.call_count == 1
+    X_valid_transformed = train_xgb_model.transform(
+        pipeline["feature_engineering"], X_valid
+    )
+    assert X_valid_transformed.dtype == np.float32
+    np.testing.assert_allclose(
+        pipeline.predict(X_valid), xgb_model.predict(X_valid_transformed), rtol=1e-6
+    )
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_native_categorical(tmp_path, streaming):
+    """
+    Asserts that with `enable_categorical=True` the categorical columns are passed
+    to XGBoost as category codes and that the pipeline serves raw arrays, including
+    unknown categories.
+    """
+    xgb_model = train_xgb_model.XGBRegressor(n_estimators=5, enable_categorical=True)
+    if "feature_types" not in xgb_model.get_params():
+        pytest.skip("native categorical support requires xgboost>=1.7")
+    train = make_taxi_data(500, seed=0).drop(columns="unused")
+    valid = make_taxi_data(100, seed=1).drop(columns="unused")
+    valid.loc[:9, "company"] = "Unknown company"
+
+    if streaming:
+        train.to_csv(tmp_path / "train.csv", index=False)
+        valid.to_csv(tmp_path / "valid.csv", index=False)
+        pipeline = train_xgb_model.train_streaming(
+            str(tmp_path / "train.csv"),
+            str(tmp_path / "valid.csv"),
+            LABEL,
+            xgb_model,
+            100,
+        )
+    else:
+        X_train, y_train = train_xgb_model.split_xy(train, LABEL)
+        X_valid, y_valid = train_xgb_model.split_xy(valid.copy(), LABEL)
+        pipeline = train_xgb_model.train_in_memory(
+            X_train, y_train, X_valid, y_valid, xgb_model
+        )
+
+    assert xgb_model.get_booster().feature_types == ["q"] * 5 + ["c"] * 2
+    X_valid, _ = train_xgb_model.split_xy(valid, LABEL)
+    y_pred = pipeline.predict(X_valid.to_numpy())
+    assert not np.isnan(y_pred).any()
+    np.testing.assert_allclose(y_pred, pipeline.predict(X_valid))
+
+
+def test_native_categorical_unsupported():
+    """
+    Asserts that native categorical support fails with a clear error when the
+    installed XGBoost cannot fit a model on category codes (before 1.7).
+    """
+    xgb_model = train_xgb_model.XGBRegressor(enable_categorical=True)
+    params = {k: v for k, v in xgb_model.get_params().items() if k != "feature_types"}
+    with mock.patch.object(xgb_model, "get_params", return_value=params):
+        with pytest.raises(RuntimeError, match="xgboost>=1.7"):
+            train_xgb_model.is_native_categorical(xgb_model)
+
+    assert not train_xgb_model.is_native_categorical(train_xgb_model.XGBRegressor())
+
+
+@pytest.mark.parametrize(
+    "files,expected",
+    [
+        ({"cpu.max": "max 100000\n"}, None),
+        ({"cpu.max": "150000 100000\n"}, 1.5),
+        ({"cpu/cpu.cfs_quota_us": "-1\n", "cpu/cpu.cfs_period_us": "100000\n"}, None),
+        ({"cpu/cpu.cfs_quota_us": "200000\n", "cpu/cpu.cfs_period_us": "100000\n"}, 2),
+        ({}, None),
+    ],
+)
+def test_available_cpus(tmp_path, files, expected):
+    """
+    Asserts that the CPU quota is read from cgroup v2 and v1 files and caps the
+    number of CPUs the process is pinned to.
+    """
+    for name, content in files.items():
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(content)
+
+    assert train_xgb_model.cgroup_cpu_quota(str(tmp_path)) == expected
+    with mock.patch.object(
+        train_xgb_model.os, "sched_getaffinity", return_value=set(range(8)), create=True
+    ):
+        n_threads = train_xgb_model.available_cpus(str(tmp_path))
+    assert n_threads == (8 if expected is None else math.ceil(expected))
+
+
+def test_train_in_memory_logs_iteration_times(caplog):
+    """
+    Asserts that the wall time of every boosting round is logged and that the
+    timing callback is not saved with the model.
+    """
+    df = make_taxi_data(500).drop(columns="unused")
+    X_train, y_train = train_xgb_model.split_xy(df.iloc[:400].copy(), LABEL)
+    X_valid, y_valid = train_xgb_model.split_xy(df.iloc[400:].copy(), LABEL)
+    xgb_model = train_xgb_model.XGBRegressor(
+        n_estimators=5, tree_method="hist", n_jobs=2
+    )
+
+    with caplog.at_level(logging.INFO):
+        pipeline = train_xgb_model.train_in_memory(
+            X_train, y_train, X_valid, y_valid, xgb_model
+        )
+
+    assert sum("Boosting round" in r.message for r in caplog.records) == 5
+    assert not xgb_model.get_params().get("callbacks")
+    pickle.loads(pickle.dumps(pipeline))
+
+
+def test_old_xgboost(monkeypatch):
+    """
+    Asserts that the script can be imported with an XGBoost version without the
+    callback API and the data iterator, and that it then trains in memory without
+    timing the boosting rounds and fails clearly in streaming mode.
+    """
+    old_xgb = types.ModuleType("xgboost")
+    old_xgb.XGBRegressor = train_xgb_model.XGBRegressor
+    old_xgb.callback = types.ModuleType("xgboost.callback")
+    monkeypatch.setitem(sys.modules, "xgboost", old_xgb)
+    spec = importlib.util.spec_from_file_location(
+        "old_train_xgb_model", train_xgb_model.__file__
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    X, y = module.split_xy(make_taxi_data(100).drop(columns="unused"), LABEL)
+    xgb_model = module.XGBRegressor(n_estimators=2)
+
+    module.train_in_memory(X, y, X, y, xgb_model)
+
+    assert module.TrainingCallback is object
+    assert not xgb_model.get_params().get("callbacks")
+    with pytest.raises(RuntimeError, match="xgboost>=1.5"):
+        module.train_streaming("train.csv", "valid.csv", LABEL, xgb_model, 100)
+
+
+@pytest.mark.parametrize("streaming", [False, True])
+def test_iteration_timer_result(tmp_path, streaming):
+    """
+    Asserts that the throughput of each boosting round is recorded, and that the
+    time which is not spent boosting counts as input.
+    """
+    df = make_taxi_data(500).drop(columns="unused")
+    df.iloc[:400].to_csv(tmp_path / "train.csv", index=False)
+    df.iloc[400:].to_csv(tmp_path / "valid.csv", index=False)
+    xgb_model = train_xgb_model.XGBRegressor(
+        n_estimators=5, tree_method="hist", n_jobs=2
+    )
+    timer = train_xgb_model.IterationTimer(monitor=True)
+
+    if streaming:
+        train_xgb_model.train_streaming(
+            str(tmp_path / "train.csv"),
+            str(tmp_path / "valid.csv"),
+            LABEL,
+            xgb_model,
+            chunk_size=100,
+            timer=timer,
+        )
+    else:
+        X_train, y_train = train_xgb_model.split_xy(df.iloc[:400].copy(), LABEL)
+        X_valid, y_valid = train_xgb_model.split_xy(df.iloc[400:].copy(), LABEL)
+        train_xgb_model.train_in_memory(
+            X_train, y_train, X_valid, y_valid, xgb_model, timer
+        )
+    result = timer.result(training_seconds=sum(timer.times) + 1.0)
+
+    assert result["unit"] == "boosting_round"
+    assert [r["examples"] for r in result["epochs"]] == [400] * 5
+    assert all(r["examplesPerSecond"] > 0 for r in result["epochs"])
+    assert result["inputSeconds"] == pytest.approx(1.0)
+    assert result["computeSeconds"] == pytest.approx(sum(timer.times))
+    assert 0 < result["inputStallFraction"] < 1
+    assert result["peakRssMb"] > 0
+
+
+def test_benchmark_threads():
+    """
+    Asserts that the benchmark measures the time per boosting round of each
+    thread count.
+    """
+    from tests.xgboost.training.benchmark_train_xgb_model import benchmark_threads
+
+    X, y = train_xgb_model.split_xy(make_taxi_data(500).drop(columns="unused"), LABEL)
+    xgb_model = train_xgb_model.XGBRegressor()
+
+    seconds_per_round = benchmark_threads(X, y, xgb_model, [1, 2], num_boost_round=3)
+
+    assert list(seconds_per_round) == [1, 2]
+    assert all(seconds > 0 for seconds in seconds_per_round.values())
+
+
+def test_benchmark_model_formats():
+    """
+    Asserts that the benchmark saves and loads the model in each format and
+    compression level.
+    """
+    from tests.xgboost.training.benchmark_train_xgb_model import (
+        benchmark_model_formats,
+    )
+
+    X, y = train_xgb_model.split_xy(make_taxi_data(500).drop(columns="unused"), LABEL)
+    pipeline = train_xgb_model.train_in_memory(
+        X, y, X, y, train_xgb_model.XGBRegressor(n_estimators=5)
+    )
+
+    results = benchmark_model_formats(pipeline, compress_levels=(0, 3))
+
+    assert results[["model_format", "compress"]].values.tolist() == [
+        [model_format, compress]
+        for model_format in train_xgb_model.MODEL_FORMATS
+        for compress in (0, 3)
+    ]
+    assert (results[["size_bytes", "write_seconds", "load_seconds"]] > 0).all().all()
+
+
+def test_sample_candidates():
+    """
+    Asserts that candidates are sampled within their ranges and from their choices.
+    """
+    space = {
+        "max_depth": {"min": 2, "max": 8},
+        "learning_rate": {"min": 0.01, "max": 0.3, "log": True},
+        "booster": ["gbtree", "dart"],
+    }
+
+    candidates = train_xgb_model.sample_candidates(space, budget=50)
+
+    assert len(candidates) == 50
+    assert all(isinstance(c["max_depth"], int) for c in candidates)
+    assert all(2 <= c["max_depth"] <= 8 for c in candidates)
+    assert all(0.01 <= c["learning_rate"] <= 0.3 for c in candidates)
+    assert {c["booster"] for c in candidates} == {"gbtree", "dart"}
+    assert candidates == train_xgb_model.sample_candidates(space, budget=50)
+
+
+def test_search_in_memory():
+    """
+    Asserts that successive halving evaluates every candidate, trains the best
+    ones for more rounds and returns the best candidate as a fitted pipeline.
+    """
+    df = make_taxi_data(500).drop(columns="unused")
+    X_train, y_train = train_xgb_model.split_xy(df.iloc[:400].copy(), LABEL)
+    X_valid, y_valid = train_xgb_model.split_xy(df.iloc[400:].copy(), LABEL)
+    xgb_model = train_xgb_model.XGBRegressor(
+        n_estimators=9, early_stopping_rounds=3, n_jobs=2
+    )
+
+    pipeline, trials = train_xgb_model.search_in_memory(
+        X_train,
+        y_train,
+        X_valid,
+        y_valid,
+        xgb_model,
+        space={"max_depth": {"min": 1, "max": 6}, "learning_rate": [0.1, 0.3]},
+        budget=9,
+        n_workers=2,
+    )
+
+    assert sorted(trials["trial"]) == list(range(9))
+    assert trials.groupby("rung")["n_rounds"].first().tolist() == [3, 9]
+    assert trials["rung"].value_counts().sort_index().tolist() == [6, 3]
+    assert xgb_model.get_params()["max_depth"] == trials["max_depth"][0]
+    assert xgb_model.get_params()["learning_rate"] == trials["learning_rate"][0]
+    assert pipeline.predict(X_valid).shape == (100,)
+
+
+def test_regression_metrics():
+    """
+    Asserts that the metrics accumulated over chunks match the sklearn metrics
+    computed on the whole test set.
+    """
+    metrics = pytest.importorskip("sklearn.metrics")
+    rng = np.random.default_rng(0)
+    y_true = rng.exponential(10, 10000) + 1
+    y_pred = (y_true + rng.normal(0, 2, 10000)).clip(0)
+
+    accumulator = train_xgb_model.RegressionMetrics()
+    for start in range(0, len(y_true), 3000):
+        accumulator.update(y_true[start : start + 3000], y_pred[start : start + 3000])
+    actual = accumulator.result()
+
+    expected = {
+        "problemType": "regression",
+        "rootMeanSquaredError": np.sqrt(metrics.mean_squared_error(y_true, y_pred)),
+        "meanAbsoluteError": metrics.mean_absolute_error(y_true, y_pred),
+        "meanAbsolutePercentageError": metrics.mean_absolute_percentage_error(
+            y_true, y_pred
+        ),
+        "rSquared": metrics.r2_score(y_true, y_pred),
+        "rootMeanSquaredLogError": np.sqrt(
+            metrics.mean_squared_log_error(y_true, y_pred)
+        ),
+    }
+    assert actual == pytest.approx(expected, rel=1e-9)
+
+
+@pytest.mark.parametrize("model_format", ["joblib", "ubj", "json"])
+@pytest.mark.parametrize("compress", [0, 3])
+def test_save_and_load_pipeline(tmp_path, model_format, compress):
+    """
+    Asserts that a pipeline saved in any format and compression level is loaded
+    back into a pipeline with the same predictions.
+    """
+    df = make_taxi_data(500).drop(columns="unused")
+    X_train, y_train = train_xgb_model.split_xy(df.iloc[:400].copy(), LABEL)
+    X_valid, y_valid = train_xgb_model.split_xy(df.iloc[400:].copy(), LABEL)
+    pipeline = train_xgb_model.train_in_memory(
+        X_train, y_train, X_valid, y_valid, train_xgb_model.XGBRegressor(n_estimators=5)
+    )
+
+    train_xgb_model.save_pipeline(pipeline, tmp_path, model_format, compress)
+    loaded = train_xgb_model.load_pipeline(tmp_path)
+
+    assert (tmp_path / train_xgb_model.MODEL_FILE).exists() == (
+        model_format == "joblib"
+    )
+    np.testing.assert_allclose(loaded.predict(X_valid), pipeline.predict(X_valid))
+
+
+@pytest.mark.parametrize("throughput_monitor", [False, True])
+def test_main_throughput_monitor(tmp_path, monkeypatch, throughput_monitor):
+    """
+    Asserts that the training throughput is only written next to the metrics with
+    the `throughput_monitor` hyperparameter.
+    """
+    make_taxi_data(300).to_csv(tmp_path / "data.csv", index=False)
+    hparams = {
+        "label": LABEL,
+        "n_estimators": 3,
+        "throughput_monitor": throughput_monitor,
+    }
+    argv = ["train_xgb_model.py", f"--model={tmp_path / 'model'}"]
+    argv.append(f"--metrics={tmp_path / 'metrics.json'}")
+    for name in ("train_data", "valid_data", "test_data"):
+        argv.append(f"--{name}={tmp_path / 'data.csv'}")
+    argv.append(f"--hparams={json.dumps(hparams)}")
+    monkeypatch.setattr(sys, "argv", argv)
+
+    train_xgb_model.main()
+
+    assert (tmp_path / "metrics.json").exists()
+    assert (tmp_path / train_xgb_model.THROUGHPUT_FILE).exists() == throughput_monitor
+
+
+@pytest.mark.parametrize("model_format", ["ubj", "json"])
+def test_native_model_format_uploaded(tmp_path, monkeypatch, model_format):
+    """
+    Asserts that training fails before reading the data if a native model format
+    is set for a model which is uploaded with the sklearn prediction container.
+    """
+    monkeypatch.setenv("AIP_MODEL_DIR", str(tmp_path / "model"))
+    hparams = {"label": LABEL, "model_format": model_format}
+    argv = ["train_xgb_model.py", "--metrics", str(tmp_path / "metrics.json")]
+    for name in ("train_data", "valid_data", "test_data"):
+        argv.append(f"--{name}={tmp_path / 'missing.csv'}")
+    argv.append(f"--hparams={json.dumps(hparams)}")
+    monkeypatch.setattr(sys, "argv", argv)
+
+    with mock.patch.object(train_xgb_model, "read_data") as read_data:
+        with pytest.raises(ValueError, match="cannot serve"):
+            train_xgb_model.main()
+    read_data.assert_not_called()